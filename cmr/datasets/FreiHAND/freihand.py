@@ -5,7 +5,6 @@ from utils.vis import base_transform, inv_base_tranmsform, cnt_area, uv2map
 from termcolor import cprint
 from utils.vis import crop_roi
 from utils.augmentation import Augmentation, crop_roi, rotate, get_m1to1_gaussian_rand
-from cmr.models.network import Pool
 import pickle
 import cv2
 import os
@@ -13,16 +12,14 @@ import numpy as np
 
 
 class FreiHAND(data.Dataset):
-    def __init__(self, root, phase, args, faces, writer=None, down_sample_list=None, img_std=0.5, img_mean=0.5, ms=True):
+    def __init__(self, root, phase, args, faces, writer=None, img_std=0.5, img_mean=0.5):
         super(FreiHAND, self).__init__()
         self.root = root
         self.phase = phase
-        self.down_sample_list = down_sample_list
         self.size = args.size
         self.faces = faces
         self.img_std = img_std
         self.img_mean = img_mean
-        self.ms = ms
         self.pos_aug = args.pos_aug if 'train' in self.phase else 0
         self.rot_aug = args.rot_aug if 'train' in self.phase else 0
         assert 0 <= self.rot_aug <= 180, 'rotaion limit must be in [0, 180]'
@@ -67,13 +64,8 @@ class FreiHAND(data.Dataset):
         xyz_root = xyz[0]
         v0 = (v0 - xyz_root) / self.std
         xyz = (xyz - xyz_root) / self.std
-        if self.ms:
-            v1 = Pool(v0.unsqueeze(0), self.down_sample_list[0])[0]
-            v2 = Pool(v1.unsqueeze(0), self.down_sample_list[1])[0]
-            v3 = Pool(v2.unsqueeze(0), self.down_sample_list[2])[0]
-            gt = [v0, v1, v2, v3]
-        else:
-            gt = [v0, ]
+        # coarser mesh levels are pooled on device for the whole batch, see Runner.train_a_epoch
+        gt = [v0, ]
 
         data = {'img': img,
                 'mesh_gt': gt,
@@ -182,15 +174,10 @@ if __name__ == '__main__':
     args = BaseOptions().parse()
     with open('../../template/transform.pkl', 'rb') as f:
         tmp = pickle.load(f, encoding='latin1')
-    down_transform_list = [
-        utils.to_sparse(down_transform)
-        for down_transform in tmp['down_transform']
-    ]
 
     args.phase = 'training'
     args.size = 224
     args.work_dir = os.path.join( os.path.dirname(os.path.realpath(__file__)), '../..' )
-    dataset = FreiHAND('../../data/FreiHAND', args.phase, args, tmp['face'], writer=None,
-                       down_sample_list=down_transform_list, ms=args.ms_mesh)
+    dataset = FreiHAND('../../data/FreiHAND', args.phase, args, tmp['face'], writer=None)
     for i in range(len(dataset)):
         data = dataset.get_training_sample(i)
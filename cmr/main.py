@@ -92,7 +92,7 @@ if __name__ == '__main__':
         if args.dataset=='FreiHAND':
             eval_dataset = FreiHAND(data_fp, 'evaluation', args, tmp['face'])
             eval_loader = DataLoader(eval_dataset, batch_size=1, shuffle=False, pin_memory=True, num_workers=0)
-            train_dataset = FreiHAND(data_fp, 'training', args, tmp['face'], writer=writer, down_sample_list=down_transform_list, ms=args.ms_mesh)
+            train_dataset = FreiHAND(data_fp, 'training', args, tmp['face'], writer=writer)
             train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, pin_memory=False, num_workers=8, drop_last=True)
         elif args.dataset=='Human36M':
             eval_dataset = Human36M(data_fp, 'test', args, down_transform_list, tmp['face'])
@@ -106,7 +106,9 @@ if __name__ == '__main__':
         scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, args.decay_step, gamma=args.lr_decay)
         # tensorboard
         board = SummaryWriter(osp.join(args.out_dir, 'board'))
-        runner.set_train_loader(train_loader, args.epochs, optimizer, scheduler, writer, board, start_epoch=epoch)
+        # multi-scale mesh GT of FreiHAND is pooled on device in the training step
+        ms_down_transform = down_transform_list[:-1] if args.dataset=='FreiHAND' and args.ms_mesh else None
+        runner.set_train_loader(train_loader, args.epochs, optimizer, scheduler, writer, board, start_epoch=epoch, down_transform=ms_down_transform)
         runner.set_eval_loader(eval_loader)
         runner.train()
     elif args.phase == 'eval':
@@ -20,6 +20,27 @@ def Pool(x, trans, dim=1):
     return out
 
 
+class MultiScalePool(object):
+    """
+    Batched multi-scale mesh down-sampling. The sparse matrices are moved to the device once,
+    so that the hierarchical mesh GT of a whole batch can be built right before the loss.
+    :param down_transform: list of sparse down-sample matrices, from the finest level to the coarsest
+    :param device: device of the mesh batches
+    """
+    def __init__(self, down_transform, device):
+        self.down_transform = [trans.coalesce().to(device) for trans in down_transform]
+
+    def __call__(self, x):
+        """
+        :param x: finest-level mesh, BxNxD
+        :return: list of meshes from the finest level to the coarsest
+        """
+        out = [x]
+        for trans in self.down_transform:
+            out.append(Pool(out[-1], trans))
+        return out
+
+
 class ParallelDeblock(nn.Module):
     """
     ISM in the paper. Note that "indices[:, :indices.size(1)//3]" is approximate and not-strict k-disk.
@@ -12,7 +12,9 @@ from utils.progress.bar import Bar
 from termcolor import colored, cprint
 import pickle
 import time
-from utils.transforms import rigid_align
+from utils.transforms import batch_rigid_align
+from cmr.models.network import MultiScalePool
+from utils.registration_pool import RegistrationPool
 
 
 class Runner(object):
@@ -24,7 +26,7 @@ class Runner(object):
         self.device = device
         self.face = torch.from_numpy(self.faces[0].astype(np.int64)).to(self.device)
 
-    def set_train_loader(self, train_loader, epochs, optimizer, scheduler, writer, board, start_epoch=0):
+    def set_train_loader(self, train_loader, epochs, optimizer, scheduler, writer, board, start_epoch=0, down_transform=None):
         self.train_loader = train_loader
         self.max_epochs = epochs
         self.optimizer = optimizer
@@ -35,6 +37,7 @@ class Runner(object):
         self.epoch = max(start_epoch - 1, 0)
         self.total_step = self.start_epoch * (len(self.train_loader.dataset) // self.writer.args.batch_size)
         self.loss = self.model.loss
+        self.ms_pool = MultiScalePool(down_transform, self.device) if down_transform is not None else None
         if self.args.dataset=='Human36M':
             self.j_regressor = self.train_loader.dataset.h36m_joint_regressor
             self.j_eval = self.train_loader.dataset.h36m_eval_joint
@@ -121,6 +124,8 @@ class Runner(object):
         for step, data in enumerate(self.train_loader):
             t = time.time()
             data = self.phrase_data(data)
+            if self.ms_pool is not None:
+                data['mesh_gt'] = self.ms_pool(data['mesh_gt'][0])
             self.optimizer.zero_grad()
             out = self.model(data['img'])
             loss = self.loss(pred=out['mesh_pred'], gt=data.get('mesh_gt'), uv_pred=out.get('uv_pred'), uv_gt=data.get('uv_gt'),
@@ -166,7 +171,18 @@ class Runner(object):
         args = self.args
         self.model.eval()
         xyz_pred_list, verts_pred_list = list(), list()
+
+        def track(meta, vertex):
+            step, img, mask_pred, poly, K, uv_point_pred = meta
+            vertex2xyz = mano_to_mpii(np.matmul(self.j_regressor, vertex))
+            xyz_pred_list.append(vertex2xyz)
+            verts_pred_list.append(vertex)
+            if args.phase == 'eval':
+                save_a_image_with_mesh_joints(img, mask_pred, poly, K, vertex, self.faces[0], uv_point_pred, vertex2xyz,
+                                              os. path.join(args.out_dir, 'eval', str(step) + '_plot.jpg'))
+
         bar = Bar(colored("EVAL", color='green'), max=len(self.eval_loader))
+        pool = RegistrationPool(args.registration_workers, args.registration_queue)
         with torch.no_grad():
             for step, data in enumerate(self.eval_loader):
                 data = self.phrase_data(data)
@@ -193,16 +209,18 @@ class Runner(object):
                     uv_point_pred, uv_pred_conf = map2uv(uv_pred.cpu().numpy(), (data['img'].size(2), data['img'].size(3)))
                 else:
                     uv_point_pred, uv_pred_conf = (uv_pred * args.size).cpu().numpy(), [None,]
-                vertex, align_state = registration(vertex, uv_point_pred[0], self.j_regressor, data['K'][0].cpu().numpy(), args.size, uv_conf=uv_pred_conf[0], poly=poly)
-
-                vertex2xyz = mano_to_mpii(np.matmul(self.j_regressor, vertex))
-                xyz_pred_list.append(vertex2xyz)
-                verts_pred_list.append(vertex)
-                if args.phase == 'eval':
-                    save_a_image_with_mesh_joints(inv_base_tranmsform(data['img'][0].cpu().numpy())[:, :, ::-1], mask_pred, poly, data['K'][0].cpu().numpy(), vertex, self.faces[0], uv_point_pred[0], vertex2xyz,
-                                              os. path.join(args.out_dir, 'eval', str(step) + '_plot.jpg'))
+                # registration runs in the pool while the next samples are forwarded
+                K = data['K'][0].cpu().numpy()
+                img = inv_base_tranmsform(data['img'][0].cpu().numpy())[:, :, ::-1] if args.phase == 'eval' else None
+                done = pool.submit(registration, vertex, uv_point_pred[0], self.j_regressor, K, args.size, uv_conf=uv_pred_conf[0], poly=poly,
+                                   meta=(step, img, mask_pred, poly, K, uv_point_pred[0]))
+                for meta, (vertex, align_state) in done:
+                    track(meta, vertex)
                 bar.suffix = '({batch}/{size})' .format(batch=step+1, size=len(self.eval_loader))
                 bar.next()
+        for meta, (vertex, align_state) in pool.drain():
+            track(meta, vertex)
+        pool.close()
         bar.finish()
         # save to a json
         xyz_pred_list = [x.tolist() for x in xyz_pred_list]
@@ -214,8 +232,11 @@ class Runner(object):
     def evaluation_withgt(self):
         # self.writer.print_str('Eval error on set')
         self.model.eval()
-        joint_errors = []
-        pa_joint_errors = []
+        j_regressor = torch.from_numpy(self.j_regressor[list(self.j_eval)]).to(self.device, torch.float64)
+        std = self.std.to(self.device).double()
+        joint_pred_list, joint_gt_list = [], []
+        pa_mesh_errors = []
+        j_sum, j_num = 0., 0
         duration = [0,]
         bar = Bar(colored("TEST", color='yellow'), max=len(self.eval_loader))
         with torch.no_grad():
@@ -229,29 +250,31 @@ class Runner(object):
                 gt = data['mesh_gt'][0] if isinstance(data['mesh_gt'], list) else data['mesh_gt']
                 xyz_gt = data['xyz_gt']
                 pred = out['mesh_pred'][0] if isinstance(out['mesh_pred'], list) else out['mesh_pred']
-                pred = (pred[0].cpu() * self.std.cpu()).numpy()
-                joint_pred = np.dot(self.j_regressor, pred)
-                gt = (gt[0].cpu() * self.std.cpu()).numpy()
-                xyz_gt = (xyz_gt[0].cpu() * self.std.cpu()).numpy()
-
-                rel_joint_pred = joint_pred[self.j_eval, :] * 1000
-                rel_joint_gt = xyz_gt[self.j_eval, :] * 1000
-                joint_errors.append(np.sqrt(np.sum((rel_joint_gt - rel_joint_pred) ** 2, axis=1)))
-                pa_joint_errors.append(np.sqrt(np.sum((rel_joint_gt - rigid_align(rel_joint_pred, rel_joint_gt)) ** 2, axis=1)))
+                pred = pred.double() * std * 1000
+                gt = gt.double() * std * 1000
+                joint_pred_list.append(torch.matmul(j_regressor, pred))
+                joint_gt_list.append(xyz_gt[:, list(self.j_eval)].double() * std * 1000)
+                joint_error = (joint_gt_list[-1] - joint_pred_list[-1]).norm(dim=-1)
+                j_sum, j_num = j_sum + joint_error.sum().item(), j_num + joint_error.numel()
+                # meshes are too large to be kept for the whole set, align them batch by batch
+                pa_mesh_errors.append((gt - batch_rigid_align(pred, gt)).norm(dim=-1))
 
                 bar.suffix = (
                     '({batch}/{size}) '
                     'MPJPE:{j:.3f} '
-                    'PA-MPJPE:{pa_j:.3f} '
                     'T:{t:.0f}'
-                ).format(batch=i, size=len(self.eval_loader), j=np.array(joint_errors).mean(), pa_j=np.array(pa_joint_errors).mean(), t=np.array(duration).mean())
+                ).format(batch=i, size=len(self.eval_loader), j=j_sum / j_num, t=np.array(duration).mean())
                 bar.next()
         bar.finish()
 
-        j_error = np.array(joint_errors).mean()
-        pa_j_error = np.array(pa_joint_errors).mean()
+        # joints of the whole set are aligned with a single batched Procrustes call
+        joint_pred, joint_gt = torch.cat(joint_pred_list), torch.cat(joint_gt_list)
+        j_error = j_sum / j_num
+        pa_j_error = (joint_gt - batch_rigid_align(joint_pred, joint_gt)).norm(dim=-1).mean().item()
+        pa_v_error = torch.cat(pa_mesh_errors).mean().item()
+        cprint('MPJPE: {:.3f} PA-MPJPE: {:.3f} PA-MPVPE: {:.3f}'.format(j_error, pa_j_error, pa_v_error), 'yellow')
         if self.board is not None:
-            self.board_scalar('test', self.epoch, **{'j_loss': j_error, 'pa_j_loss': pa_j_error})
+            self.board_scalar('test', self.epoch, **{'j_loss': j_error, 'pa_j_loss': pa_j_error, 'pa_v_loss': pa_v_error})
             self.board_img('test', self.epoch, data['img'][0], uv_gt=data['uv_gt'], uv_pred=out['uv_pred'], mask_gt=data.get('mask_gt'), mask_pred=out.get('mask_pred'))
 
         return pa_j_error
@@ -261,7 +284,16 @@ class Runner(object):
         self.model.eval()
         image_fp = os.path.join(args.work_dir, 'images')
         image_files = [os.path.join(image_fp, i) for i in os.listdir(image_fp) if '_img.jpg' in i]
+
+        def track(meta, vertex):
+            image_name, image, mask_pred, poly, K, uv_point_pred = meta
+            vertex2xyz = mano_to_mpii(np.matmul(self.j_regressor, vertex))
+            save_a_image_with_mesh_joints(image[..., ::-1], mask_pred, poly, K, vertex, self.faces[0], uv_point_pred, vertex2xyz,
+                                          os.path.join(args.out_dir, 'demo', image_name + '_plot.jpg'))
+            save_mesh(os.path.join(args.out_dir, 'demo', image_name + '_mesh.ply'), vertex, self.faces[0])
+
         bar = Bar(colored("DEMO", color='blue'), max=len(image_files))
+        pool = RegistrationPool(args.registration_workers, args.registration_queue)
         with torch.no_grad():
             for step, image_path in enumerate(image_files):
                 image_name = image_path.split('/')[-1].split('_')[0]
@@ -297,13 +329,14 @@ class Runner(object):
                     uv_point_pred, uv_pred_conf = map2uv(uv_pred.cpu().numpy(), (input.size(2), input.size(3)))
                 else:
                     uv_point_pred, uv_pred_conf = (uv_pred * args.size).cpu().numpy(), [None,]
-                vertex, align_state = registration(vertex, uv_point_pred[0], self.j_regressor, K, args.size, uv_conf=uv_pred_conf[0], poly=poly)
-
-                vertex2xyz = mano_to_mpii(np.matmul(self.j_regressor, vertex))
-                save_a_image_with_mesh_joints(image[..., ::-1], mask_pred, poly, K, vertex, self.faces[0], uv_point_pred[0], vertex2xyz,
-                                              os.path.join(args.out_dir, 'demo', image_name + '_plot.jpg'))
-                save_mesh(os.path.join(args.out_dir, 'demo', image_name + '_mesh.ply'), vertex, self.faces[0])
+                done = pool.submit(registration, vertex, uv_point_pred[0], self.j_regressor, K, args.size, uv_conf=uv_pred_conf[0], poly=poly,
+                                   meta=(image_name, image, mask_pred, poly, K, uv_point_pred[0]))
+                for meta, (vertex, align_state) in done:
+                    track(meta, vertex)
 
                 bar.suffix = '({batch}/{size})' .format(batch=step+1, size=len(image_files))
                 bar.next()
+        for meta, (vertex, align_state) in pool.drain():
+            track(meta, vertex)
+        pool.close()
         bar.finish()
@@ -1,6 +1,19 @@
 from .spiralconv import SpiralConv
 from .dsconv import DSConv
+from .fusedconv import FusedSpiralConv, FusedDSConv
+
+# cfg.MODEL.SPIRAL.TYPE -> mesh convolution of the decoder
+MESHCONV = {
+    'Conv': SpiralConv,
+    'DSConv': DSConv,
+    'FusedConv': FusedSpiralConv,
+    'FusedDSConv': FusedDSConv,
+}
 
 __all__ = [
     'SpiralConv',
+    'DSConv',
+    'FusedSpiralConv',
+    'FusedDSConv',
+    'MESHCONV',
 ]
@@ -20,7 +20,8 @@ class DSConv(nn.Module):
     def __init__(self, in_channels, out_channels, indices, dim=1):
         super(DSConv, self).__init__()
         self.dim = dim
-        self.indices = indices
+        # mesh topology follows the module across devices and is saved in the state_dict
+        self.register_buffer('indices', indices)
         self.in_channels = in_channels
         self.out_channels = out_channels
         self.seq_length = indices.size(1)
@@ -35,7 +36,7 @@ class DSConv(nn.Module):
     def forward(self, x):
         n_nodes, _ = self.indices.size()
         bs = x.size(0)
-        x = torch.index_select(x, self.dim, self.indices.to(x.device).view(-1))
+        x = torch.index_select(x, self.dim, self.indices.reshape(-1))
         x = x.view(bs * n_nodes, self.seq_length, -1).transpose(1, 2)
         x = x.view(x.size(0), x.size(1), int(np.sqrt(self.seq_length)), int(np.sqrt(self.seq_length)))
         x = self.spatial_layer(x).view(bs, n_nodes, -1)
@@ -43,6 +44,11 @@ class DSConv(nn.Module):
 
         return x
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the spiral indices were a buffer
+        state_dict.setdefault(prefix + 'indices', self.indices)
+        super(DSConv, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def __repr__(self):
         return '{}({}, {}, seq_length={})'.format(self.__class__.__name__,
                                                   self.in_channels,
@@ -0,0 +1,194 @@
+"""
+ * @file fusedconv.py
+ * @brief Spiral convolutions without the gathered neighbourhood tensor. SpiralConv and DSConv gather
+ *        [B, N, seq_length, C] before their linear/depthwise layer and autograd keeps it for the backward; here the
+ *        neighbourhood sum is accumulated one spiral position at a time and the backward gathers again from x.
+ *        Parameters and buffers are those of SpiralConv/DSConv, so checkpoints are interchangeable.
+"""
+
+import torch
+from torch.autograd import Function
+from torch.autograd.function import once_differentiable
+from .spiralconv import SpiralConv
+from .dsconv import DSConv
+
+
+def spiral_linear(x, indices, weight, bias=None):
+    """out[:, n] = bias + sum_s x[:, indices[n, s]] @ weight[:, s*C:(s+1)*C]^T
+
+    Args:
+        x (tensor): BxVxC
+        indices (tensor): Nxseq_length spiral indices
+        weight (tensor): Ox(seq_length*C), as in SpiralConv.layer
+        bias (tensor, optional): O. Defaults to None.
+
+    Returns:
+        tensor: BxNxO
+    """
+    n_nodes, seq_length = indices.size()
+    weight = weight.view(weight.size(0), seq_length, -1)
+    if bias is None:
+        out = x.new_zeros(x.size(0) * n_nodes, weight.size(0))
+    else:
+        out = bias.expand(x.size(0) * n_nodes, -1).clone()
+    for s in range(seq_length):
+        out.addmm_(x.index_select(1, indices[:, s]).view(-1, x.size(-1)), weight[:, s].t())
+    return out.view(x.size(0), n_nodes, -1)
+
+
+def spiral_depthwise(x, indices, weight):
+    """out[:, n, c] = sum_s x[:, indices[n, s], c] * weight[c, s]
+
+    Args:
+        x (tensor): BxVxC
+        indices (tensor): Nxseq_length spiral indices
+        weight (tensor): Cxseq_length, DSConv.spatial_layer.weight flattened
+
+    Returns:
+        tensor: BxNxC
+    """
+    out = x.new_zeros(x.size(0), indices.size(0), x.size(-1))
+    for s in range(indices.size(1)):
+        out.addcmul_(x.index_select(1, indices[:, s]), weight[:, s])
+    return out
+
+
+class SpiralLinearFunction(Function):
+    @staticmethod
+    def forward(ctx, x, indices, weight, bias):
+        ctx.save_for_backward(x, indices, weight)
+        ctx.has_bias = bias is not None
+        return spiral_linear(x, indices, weight, bias)
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_out):
+        x, indices, weight = ctx.saved_tensors
+        seq_length = indices.size(1)
+        w = weight.view(weight.size(0), seq_length, -1)
+        grad = grad_out.reshape(-1, grad_out.size(-1))
+        grad_x = grad_weight = grad_bias = None
+        if ctx.needs_input_grad[0]:
+            grad_x = torch.zeros_like(x)
+            for s in range(seq_length):
+                grad_x.index_add_(1, indices[:, s], grad.mm(w[:, s]).view(x.size(0), indices.size(0), -1))
+        if ctx.needs_input_grad[2]:
+            grad_weight = torch.empty_like(w)
+            for s in range(seq_length):
+                grad_weight[:, s] = grad.t().mm(x.index_select(1, indices[:, s]).view(-1, x.size(-1)))
+            grad_weight = grad_weight.view_as(weight)
+        if ctx.has_bias and ctx.needs_input_grad[3]:
+            grad_bias = grad.sum(0)
+        return grad_x, None, grad_weight, grad_bias
+
+
+class SpiralDepthwiseFunction(Function):
+    @staticmethod
+    def forward(ctx, x, indices, weight):
+        ctx.save_for_backward(x, indices, weight)
+        return spiral_depthwise(x, indices, weight)
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_out):
+        x, indices, weight = ctx.saved_tensors
+        grad_x = grad_weight = None
+        if ctx.needs_input_grad[0]:
+            grad_x = torch.zeros_like(x)
+            for s in range(indices.size(1)):
+                grad_x.index_add_(1, indices[:, s], grad_out * weight[:, s])
+        if ctx.needs_input_grad[2]:
+            grad_weight = torch.empty_like(weight)
+            for s in range(indices.size(1)):
+                grad_weight[:, s] = (grad_out * x.index_select(1, indices[:, s])).sum((0, 1))
+        return grad_x, None, grad_weight
+
+
+class FusedSpiralConv(SpiralConv):
+    """SpiralConv computed by spiral_linear, the custom backward is used in training only so that
+    eval graphs stay plain aten ops for tracing and export"""
+    def forward(self, x):
+        if x.dim() not in (2, 3):
+            raise RuntimeError(
+                'x.dim() is expected to be 2 or 3, but received {}'.format(
+                    x.dim()))
+        if x.dim() == 3 and self.dim != 1:
+            return super(FusedSpiralConv, self).forward(x)
+        squeeze = x.dim() == 2
+        if squeeze:
+            x = x.unsqueeze(0)
+        if self.training:
+            x = SpiralLinearFunction.apply(x, self.indices, self.layer.weight, self.layer.bias)
+        else:
+            x = spiral_linear(x, self.indices, self.layer.weight, self.layer.bias)
+        return x[0] if squeeze else x
+
+
+class FusedDSConv(DSConv):
+    """DSConv with the depthwise spatial layer computed by spiral_depthwise"""
+    def forward(self, x):
+        weight = self.spatial_layer.weight.view(self.in_channels, self.seq_length)
+        if self.training:
+            x = SpiralDepthwiseFunction.apply(x, self.indices, weight)
+        else:
+            x = spiral_depthwise(x, self.indices, weight)
+        return self.channel_layer(x)
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import time
+    import openmesh as om
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    from utils.utils import preprocess_spiral
+
+    # gradients of the custom backward against finite differences and against the reference modules
+    torch.manual_seed(0)
+    indices = torch.randint(0, 12, (10, 9))
+    x = torch.randn(2, 12, 4, dtype=torch.double, requires_grad=True)
+    weight = torch.randn(5, 9 * 4, dtype=torch.double, requires_grad=True)
+    bias = torch.randn(5, dtype=torch.double, requires_grad=True)
+    assert torch.autograd.gradcheck(SpiralLinearFunction.apply, (x, indices, weight, bias))
+    assert torch.autograd.gradcheck(SpiralLinearFunction.apply, (x, indices, weight, None))
+    weight = torch.randn(4, 9, dtype=torch.double, requires_grad=True)
+    assert torch.autograd.gradcheck(SpiralDepthwiseFunction.apply, (x, indices, weight))
+
+    for ref_cls, fused_cls in [(SpiralConv, FusedSpiralConv), (DSConv, FusedDSConv)]:
+        ref = ref_cls(16, 8, indices).double()
+        fused = fused_cls(16, 8, indices).double()
+        fused.load_state_dict(ref.state_dict())
+        x = torch.randn(3, 12, 16, dtype=torch.double, requires_grad=True)
+        grads = []
+        for m in [ref, fused]:
+            out = m(x)
+            grads.append((out, ) + torch.autograd.grad(out.pow(2).sum(), [x] + list(m.parameters())))
+        for a, b in zip(*grads):
+            assert torch.allclose(a, b, atol=1e-10), fused_cls.__name__
+        print('{}: outputs and gradients match {}'.format(fused_cls.__name__, ref_cls.__name__))
+
+    # time and peak memory of a training step on the hand and body templates
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    template_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../template')
+    for template, batch in [('template.ply', 32), ('template_body.ply', 8)]:
+        mesh = om.read_trimesh(os.path.join(template_dir, template))
+        indices = preprocess_spiral(mesh.face_vertex_indices(), 9, mesh.points(), 1)
+        x = torch.randn(batch, indices.size(0), 64, device=device, requires_grad=True)
+        for ref_cls, fused_cls in [(SpiralConv, FusedSpiralConv), (DSConv, FusedDSConv)]:
+            stats = []
+            for cls in [ref_cls, fused_cls]:
+                m = cls(64, 64, indices).to(device)
+                m(x).sum().backward()
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                    torch.cuda.reset_peak_memory_stats()
+                    base = torch.cuda.memory_allocated()
+                t = time.time()
+                for _ in range(10):
+                    m(x).sum().backward()
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                stats.append(((time.time() - t) / 10 * 1000,
+                              (torch.cuda.max_memory_allocated() - base) / 2**20 if device.type == 'cuda' else float('nan')))
+            print('{} ({} verts, batch {}): {} {:.2f}ms {:.1f}MB -> {} {:.2f}ms {:.1f}MB'.format(
+                template, indices.size(0), batch, ref_cls.__name__, *stats[0], fused_cls.__name__, *stats[1]))
@@ -6,7 +6,8 @@ class SpiralConv(nn.Module):
     def __init__(self, in_channels, out_channels, indices, dim=1):
         super(SpiralConv, self).__init__()
         self.dim = dim
-        self.indices = indices
+        # mesh topology follows the module across devices and is saved in the state_dict
+        self.register_buffer('indices', indices)
         self.in_channels = in_channels
         self.out_channels = out_channels
         self.seq_length = indices.size(1)
@@ -21,11 +22,11 @@ class SpiralConv(nn.Module):
     def forward(self, x):
         n_nodes, _ = self.indices.size()
         if x.dim() == 2:
-            x = torch.index_select(x, 0, self.indices.to(x.device).view(-1))
+            x = torch.index_select(x, 0, self.indices.reshape(-1))
             x = x.view(n_nodes, -1)
         elif x.dim() == 3:
             bs = x.size(0)
-            x = torch.index_select(x, self.dim, self.indices.to(x.device).reshape(-1))
+            x = torch.index_select(x, self.dim, self.indices.reshape(-1))
             x = x.view(bs, n_nodes, -1)
         else:
             raise RuntimeError(
@@ -34,6 +35,11 @@ class SpiralConv(nn.Module):
         x = self.layer(x)
         return x
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the spiral indices were a buffer
+        state_dict.setdefault(prefix + 'indices', self.indices)
+        super(SpiralConv, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def __repr__(self):
         return '{}({}, {}, seq_length={})'.format(self.__class__.__name__,
                                                   self.in_channels,
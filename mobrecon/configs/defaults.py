@@ -14,11 +14,13 @@ _C.MODEL.KPTS_NUM = 21
 _C.MODEL.LATENT_SIZE = 256
 
 _C.MODEL.SPIRAL = CN()
-_C.MODEL.SPIRAL.TYPE = 'Conv'
+_C.MODEL.SPIRAL.TYPE = 'Conv'  # Conv, DSConv, FusedConv or FusedDSConv (same parameters, no gathered neighbourhood tensor)
 _C.MODEL.SPIRAL.OUT_CHANNELS = [32, 64, 128, 256]
 _C.MODEL.SPIRAL.DOWN_SCALE = [2, 2, 2, 2]
 _C.MODEL.SPIRAL.LEN = [9, 9, 9, 9]
 _C.MODEL.SPIRAL.DILATION = [1, 1, 1, 1]
+_C.MODEL.SPIRAL.UPSAMPLE = 'scatter'  # scatter, dense, sparse, gather or auto (opt-in, fastest for the shapes and device, timed in the first forward)
+_C.MODEL.SPIRAL.UPSAMPLE_CACHE = ''  # json of the autotuned backends, e.g. under the experiment out dir, '' keeps them in memory
 
 _C.DATA = CN()
 _C.DATA.SIZE = 128
@@ -28,6 +30,15 @@ _C.DATA.IMG_STD = 0.5
 _C.DATA.COLOR_AUG = True
 _C.DATA.CONTRASTIVE = False
 
+_C.DATA.TEXT = CN()
+_C.DATA.TEXT.CACHE = ''  # folder of precomputed text tokens (mobrecon/tools/text_cache.py), used in the eval and pred phases
+_C.DATA.TEXT.CODEBOOK = ''  # unique finger embeddings (mobrecon/tools/text_codebook.py), samples then carry [5] indices
+_C.DATA.TEXT.COMPRESS = ''  # PCA/PQ compressed embeddings (mobrecon/tools/text_compress.py), fc1 takes the PCA dim
+_C.DATA.TEXT.COMPRESS_DIM = 128
+_C.DATA.TEXT.COMPRESS_PQ = 0  # PQ subspaces of 256 centroids, 0 for float16 PCA codes
+_C.DATA.TEXT.COMPRESS_DIMS = [256, 128, 64, 32]  # levels of the report, multiples of 8
+_C.DATA.TEXT.LRU = 4096  # text tokens kept by the server, keyed by sample id
+
 _C.DATA.FREIHAND = CN()
 _C.DATA.FREIHAND.USE = True
 _C.DATA.FREIHAND.ROOT = 'data/FreiHAND'
@@ -40,6 +51,8 @@ _C.DATA.GE = CN()
 _C.DATA.GE.USE = True
 _C.DATA.GE.ROOT = 'data/Ge'
 _C.DATA.GE.BASE_SCALE = 1.3
+_C.DATA.GE.CACHE = True
+_C.DATA.GE.CACHE_DIR = ''  # folder of the preprocessed cache, '' for DATA.GE.ROOT
 
 _C.DATA.COMPHAND = CN()
 _C.DATA.COMPHAND.USE = True
@@ -62,7 +75,7 @@ _C.TRAIN.GPU_ID = [0, ]
 
 _C.VAL = CN()
 _C.VAL.DATASET = 'Ge'
-_C.VAL.BATCH_SIZE = 1
+_C.VAL.BATCH_SIZE = 32
 _C.VAL.SAVE_DIR = 'eval'
 _C.VAL.SAVE_PRED = False
 
@@ -71,4 +84,38 @@ _C.TEST.DATASET = 'FreiHAND'
 _C.TEST.BATCH_SIZE = 1
 _C.TEST.SAVE_DIR = 'test'
 _C.TEST.SAVE_PRED = False
+_C.TEST.BACKEND = 'torch'  # 'torch' or 'onnx'
+_C.TEST.FUSE = True  # fold BN into conv/linear layers of a copy of the model for eval and pred
+_C.TEST.ONNX_PATH = ''  # exported on the fly to the output dir if empty
+_C.TEST.ONNX_THREADS = 0
+_C.TEST.REGISTRATION = 'batch'  # 'batch' or 'slsqp'
+_C.TEST.REGISTRATION_WORKERS = 4  # processes for 'slsqp', 0 to register on the main process
+_C.TEST.REGISTRATION_QUEUE = 32  # max samples in flight
+
+_C.STREAM = CN()
+_C.STREAM.SOURCE = ''  # video file or image folder
+_C.STREAM.OUTPUT = ''  # rendered video, empty to skip
+_C.STREAM.TEXT = ''  # .npy of the [5x768] finger embeddings of the stream, zeros if empty
+_C.STREAM.FOCAL = 0.  # focal length of the full frame in pixels, 0 for the longer image side
+_C.STREAM.BASE_SCALE = 1.3
+_C.STREAM.QUEUE_SIZE = 2
+_C.STREAM.DROP = True
+_C.STREAM.THREADS = 4
+
+_C.SERVE = CN()
+_C.SERVE.HOST = '127.0.0.1'
+_C.SERVE.PORT = 8000
+_C.SERVE.MAX_BATCH = 16
+_C.SERVE.MAX_LATENCY = 0.005  # seconds the first request of a batch waits for others
+_C.SERVE.BENCH = False  # run the load generator instead of serving
+
+_C.EXPORT = CN()
+_C.EXPORT.MODE = 'trace'  # 'trace' for TorchScript, 'export' for torch.export or 'onnx'
+_C.EXPORT.PATH = ''
 
+_C.QUANT = CN()
+_C.QUANT.DATASET = 'FreiHAND'  # calibration dataset, any registered one
+_C.QUANT.PHASE = 'train'
+_C.QUANT.NUM = 256  # calibration samples
+_C.QUANT.BACKEND = 'fbgemm'  # 'fbgemm' for x86, 'qnnpack' for ARM
+_C.QUANT.PATH = ''  # pickled quantized model, empty to skip
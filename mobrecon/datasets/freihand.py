@@ -27,6 +27,8 @@ from mobrecon.tools.kinematics import MPIIHandJoints
 from mobrecon.models.loss import contrastive_loss_3d, contrastive_loss_2d
 import vctoolkit as vc
 from mobrecon.build import DATA_REGISTRY
+from mobrecon.tools.text_cache import EMBED_STORES, cache_path, finger_embedding, load_text_cache
+from mobrecon.tools.text_compress import decode
 
 
 @DATA_REGISTRY.register()
@@ -47,12 +49,29 @@ class FreiHAND(data.Dataset):
         self.color_aug = Augmentation() if cfg.DATA.COLOR_AUG and 'train' in self.phase else None
         self.one_version_len = len(self.db_data_anno)
         if 'train' in self.phase:
-            self.text_embeddings = np.load(os.path.join(self.cfg.DATA.FREIHAND.ROOT,"training_embed_angle.npy"), allow_pickle=True)
+            text_set = 'train'
         elif 'val' in self.phase or "eval" in self.phase:
-            self.text_embeddings = np.load(os.path.join(self.cfg.DATA.FREIHAND.ROOT,"val_embed_angle.npy"), allow_pickle=True)
+            text_set = 'val'
         elif "test" in self.phase:
-            self.text_embeddings = np.load(os.path.join(self.cfg.DATA.FREIHAND.ROOT,"evaluation_embed_angle.npy"), allow_pickle=True)
-        self.text_embeddings = self.text_embeddings.tolist()
+            text_set = 'test'
+        store = os.path.join(self.cfg.DATA.FREIHAND.ROOT, EMBED_STORES[text_set])
+        self.text_embeddings = self.text_tokens = self.text_indices = self.text_codes = None
+        if self.cfg.DATA.TEXT.CACHE and self.cfg.PHASE in ['eval', 'pred']:
+            # precomputed text tokens (mobrecon/tools/text_cache.py) instead of finger embeddings, only outside training:
+            # the tokens come from a fixed checkpoint, the per-epoch validation has to run the encoder being trained
+            cache = load_text_cache(cache_path(self.cfg.DATA.TEXT.CACHE, store), self.cfg)
+            self.text_tokens = dict(zip(cache['ids'], cache['tokens']))
+        elif self.cfg.DATA.TEXT.COMPRESS:
+            # PCA or PQ codes (mobrecon/tools/text_compress.py)
+            compressed = torch.load(self.cfg.DATA.TEXT.COMPRESS)
+            self.text_codes = dict(zip(compressed['sets'][text_set]['ids'], compressed['sets'][text_set]['codes']))
+            self.text_centroids = compressed['centroids']
+        elif self.cfg.DATA.TEXT.CODEBOOK:
+            # codebook indices (mobrecon/tools/text_codebook.py), the model gathers the embeddings
+            codebook = torch.load(self.cfg.DATA.TEXT.CODEBOOK)['sets'][text_set]
+            self.text_indices = dict(zip(codebook['ids'], codebook['indices'].long()))
+        else:
+            self.text_embeddings = np.load(store, allow_pickle=True).tolist()
         # if 'train' in self.phase:
         #     self.db_data_anno *= 4
         if writer is not None:
@@ -72,6 +91,19 @@ class FreiHAND(data.Dataset):
         else:
             raise Exception('phase error')
 
+    def get_text(self, idx):
+        """Finger embeddings of a sample, [5xD] PCA coordinates with cfg.DATA.TEXT.COMPRESS, [5] codebook indices
+        with cfg.DATA.TEXT.CODEBOOK, or its precomputed text token with cfg.DATA.TEXT.CACHE
+        """
+        key = '%08d.jpg' % idx
+        if self.text_tokens is not None:
+            return {'texttoken': self.text_tokens[key]}
+        if self.text_codes is not None:
+            return {'textembed': decode(self.text_codes[key], self.text_centroids)}
+        if self.text_indices is not None:
+            return {'textembed': self.text_indices[key]}
+        return {'textembed': finger_embedding(self.text_embeddings[key])}
+
     def get_contrastive_sample(self, idx):
         """Get contrastive FreiHAND samples for consistency learning
         """
@@ -79,11 +111,7 @@ class FreiHAND(data.Dataset):
         img = read_img_abs(idx, self.cfg.DATA.FREIHAND.ROOT, 'training')
         vert = read_mesh(idx, self.cfg.DATA.FREIHAND.ROOT,set_name='training').x.numpy()
         mask = read_mask_woclip(idx , self.cfg.DATA.FREIHAND.ROOT, 'training')
-        textembed = self.text_embeddings['%08d.jpg' % idx]
-        fingers = ["thumb", "index", "middle", "ring", "little"]
-        textembed = torch.stack(
-            [torch.as_tensor(textembed["angle"][f]) for f in fingers],
-            dim=0)
+        text = self.get_text(idx)
         contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         contours = list(contours)
         contours.sort(key=cnt_area, reverse=True)
@@ -174,7 +202,7 @@ class FreiHAND(data.Dataset):
 
         # out
         res = {'img': roi, 'joint_img': joint_img, 'joint_cam': joint_cam, 'verts': vert, 'mask': mask,
-               'root': root, 'calib': calib, 'aug_param': aug_param, 'bb2img_trans': bb2img_trans, "textembed": textembed}
+               'root': root, 'calib': calib, 'aug_param': aug_param, 'bb2img_trans': bb2img_trans, **text}
 
         return res
 
@@ -185,11 +213,7 @@ class FreiHAND(data.Dataset):
         img = read_img_abs(idx, self.cfg.DATA.FREIHAND.ROOT, 'training')
         vert = read_mesh(idx, self.cfg.DATA.FREIHAND.ROOT,set_name='training').x.numpy()
         mask = read_mask_woclip(idx, self.cfg.DATA.FREIHAND.ROOT, 'training')
-        textembed = self.text_embeddings['%08d.jpg' % idx]
-        fingers = ["thumb", "index", "middle", "ring", "little"]
-        textembed = torch.stack(
-            [torch.as_tensor(textembed["angle"][f]) for f in fingers],
-            dim=0)
+        text = self.get_text(idx)
 
         contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         contours = list(contours)
@@ -255,7 +279,7 @@ class FreiHAND(data.Dataset):
         vert = torch.from_numpy(vert).float()
 
         # out
-        res = {'img': roi, 'joint_img': joint_img, 'joint_cam': joint_cam, 'verts': vert, 'mask': mask, 'root': root, 'calib': calib, "textembed": textembed}
+        res = {'img': roi, 'joint_img': joint_img, 'joint_cam': joint_cam, 'verts': vert, 'mask': mask, 'root': root, 'calib': calib, **text}
 
         return res
 
@@ -266,11 +290,7 @@ class FreiHAND(data.Dataset):
         img = read_img_abs(idx, self.cfg.DATA.FREIHAND.ROOT, 'val')
         vert = read_mesh(idx, self.cfg.DATA.FREIHAND.ROOT,set_name='val').x.numpy()
         mask = read_mask_woclip(idx, self.cfg.DATA.FREIHAND.ROOT, 'val')
-        textembed = self.text_embeddings['%08d.jpg' % idx]
-        fingers = ["thumb", "index", "middle", "ring", "little"]
-        textembed = torch.stack(
-            [torch.as_tensor(textembed["angle"][f]) for f in fingers],
-            dim=0)
+        text = self.get_text(idx)
         contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         contours = list(contours)
         contours.sort(key=cnt_area, reverse=True)
@@ -335,7 +355,7 @@ class FreiHAND(data.Dataset):
         vert = torch.from_numpy(vert).float()
 
         # out
-        res = {'img': roi, 'joint_img': joint_img, 'joint_cam': joint_cam, 'verts': vert, 'mask': mask, 'root': root, 'calib': calib, "textembed": textembed}
+        res = {'img': roi, 'joint_img': joint_img, 'joint_cam': joint_cam, 'verts': vert, 'mask': mask, 'root': root, 'calib': calib, **text}
 
         return res
 
@@ -344,11 +364,7 @@ class FreiHAND(data.Dataset):
         """
         # read
         img = read_img(idx, self.cfg.DATA.FREIHAND.ROOT, 'evaluation', 'gs')
-        textembed = self.text_embeddings['%08d.jpg' % idx]
-        fingers = ["thumb", "index", "middle", "ring", "little"]
-        textembed = torch.stack(
-            [torch.as_tensor(textembed["angle"][f]) for f in fingers],
-            dim=0)
+        text = self.get_text(idx)
         K, scale = self.db_data_anno[idx]
         K = np.array(K)
         princpt = K[0:2, 2].astype(np.float32)
@@ -379,7 +395,7 @@ class FreiHAND(data.Dataset):
         calib[:2, 2:3] = princpt[:, None]
         calib = torch.from_numpy(calib).float()
 
-        return {'img': roi, 'calib': calib, "textembed": textembed}
+        return {'img': roi, 'calib': calib, **text}
 
     def __len__(self):
 
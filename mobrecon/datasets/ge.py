@@ -17,13 +17,16 @@ import cv2
 import numpy as np
 import torch
 import torch.utils.data
-from utils.vis import base_transform, inv_base_tranmsform, uv2map
+from utils.vis import inv_base_tranmsform, uv2map
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 from termcolor import cprint
 from mobrecon.build import DATA_REGISTRY
 from mobrecon.tools.vis import perspective
 
+# bump when preprocess changes, so that stale caches are rebuilt
+GE_CACHE_VERSION = 1
+
 @DATA_REGISTRY.register()
 class Ge(torch.utils.data.Dataset):
     def __init__(self, cfg, phase='eval', writer=None):
@@ -58,14 +61,31 @@ class Ge(torch.utils.data.Dataset):
         self.pose_gts = torch.from_numpy(mat_gt["pose_gt"])  # N x K x 3
         assert len(self.image_paths) == self.pose_gts.shape[0]
 
+        self.cache = self.load_cache(writer) if self.cfg.DATA.GE.CACHE else None
+
         if writer is not None:
             writer.print_str('Loaded Ge test {} samples'.format(len(self.image_paths)))
         cprint('Loaded Ge test {} samples'.format(len(self.image_paths)), 'red')
 
 
     def __getitem__(self, idx):
+        if self.cache is not None:
+            res = {key: val[idx] for key, val in self.cache.items()}
+        else:
+            res = self.preprocess(idx)
+        img = res.pop('img').float() / 255
+        img -= self.img_mean
+        img /= self.img_std
+        res['img'] = img.permute(2, 0, 1)
+
+        return res
+
+    def preprocess(self, idx):
+        """Read, flip and resize a frame, and compute its calibration and labels in the resized crop.
+        The image is returned as uint8 HxWx3 so that it can be cached compactly.
+        """
         img = cv2.imread(osp.join(self.root, self.image_paths[idx]))[:, ::-1, ::-1]
-        img = base_transform(img, self.size, std=self.img_std, mean=self.img_mean)
+        img = cv2.resize(np.ascontiguousarray(img), (self.size, self.size))
         bbox = self.bboxes[idx].clone()
         bbox[0] = 1280 - bbox[0] - bbox[2]
         xyz = self.pose_gts[idx].clone() / 100
@@ -84,16 +104,40 @@ class Ge(torch.utils.data.Dataset):
         calib[1, 2] = scale * (v0 - bbox[1] + 0.5) - 0.5
         calib = torch.from_numpy(calib).float()
         uv = perspective(xyz.clone().T.unsqueeze(0), calib.unsqueeze(0))[0].numpy().T[:, :2]
-        uv_map = uv2map(uv.astype(np.int32), img.shape[1:])
-        uv_map = cv2.resize(uv_map.transpose(1, 2, 0), (img.shape[2]//2, img.shape[1]//2)).transpose(2, 0, 1)
-        uv = uv / img.shape[1:][::-1]
+        uv_map = uv2map(uv.astype(np.int32), img.shape[:2])
+        uv_map = cv2.resize(uv_map.transpose(1, 2, 0), (img.shape[1]//2, img.shape[0]//2)).transpose(2, 0, 1)
+        uv = uv / img.shape[:2][::-1]
         xyz -= xyz_root
-        img, uv_point, uv_map = [torch.from_numpy(x).float() for x in [img, uv, uv_map]]
+        uv_point, uv_map = [torch.from_numpy(x).float() for x in [uv, uv_map]]
 
-        res = {'img': img, 'joint_img': uv_point, 'joint_cam': xyz, 'root': xyz_root, 'calib': calib, 'joint_img_map': uv_map}
+        res = {'img': torch.from_numpy(img), 'joint_img': uv_point, 'joint_cam': xyz, 'root': xyz_root, 'calib': calib, 'joint_img_map': uv_map}
 
         return res
 
+    def load_cache(self, writer=None):
+        """Load the preprocessed test set, building it on the first run.
+        All samples are stacked into tensors so that the dataset is served from memory.
+        """
+        cache_fp = os.path.join(self.cfg.DATA.GE.CACHE_DIR or self.root, 'cache_v{}_{}.pt'.format(GE_CACHE_VERSION, self.size))
+        if os.path.exists(cache_fp):
+            cache = torch.load(cache_fp)
+            if cache.pop('version', None) == GE_CACHE_VERSION and len(cache['img']) == len(self.image_paths):
+                return cache
+        cprint('Building Ge cache at {}'.format(cache_fp), 'red')
+        samples = [self.preprocess(idx) for idx in range(len(self.image_paths))]
+        cache = {key: torch.stack([s[key] for s in samples]) for key in samples[0]}
+        try:
+            os.makedirs(os.path.dirname(cache_fp), exist_ok=True)
+            torch.save(dict(cache, version=GE_CACHE_VERSION), cache_fp)
+        except OSError as e:
+            # read-only dataset mount, serve from memory and rebuild on the next run (see DATA.GE.CACHE_DIR)
+            cprint('Ge cache not saved: {}'.format(e), 'red')
+            return cache
+        if writer is not None:
+            writer.print_str('Saved Ge cache at {}'.format(cache_fp))
+
+        return cache
+
     def visualization(self, idx, data):
         gs = gridspec.GridSpec(1, 2)
         # xyz = (data['xyz_gt'] * self.std + data['xyz_root']).numpy()
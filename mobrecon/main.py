@@ -97,11 +97,11 @@ def main(args):
         writer.print_str('Train from 0 epoch')
 
     # data
-    kwargs = {"pin_memory": True, "num_workers": 8, "drop_last": True}
+    kwargs = {"pin_memory": True, "num_workers": 8}
     if cfg.PHASE in ['train',]:
         train_dataset = build_dataset(cfg, 'train', writer=writer)
         train_sampler = None
-        train_loader = DataLoader(train_dataset, batch_size=cfg.TRAIN.BATCH_SIZE, shuffle=(train_sampler is None), sampler=train_sampler, **kwargs)
+        train_loader = DataLoader(train_dataset, batch_size=cfg.TRAIN.BATCH_SIZE, shuffle=(train_sampler is None), sampler=train_sampler, drop_last=True, **kwargs)
     else:
         print('Need not trainloader')
         train_loader = None
@@ -13,7 +13,7 @@
 
 import torch
 import torch.nn as nn
-from mobrecon.models.modules import conv_layer, mobile_unit, linear_layer, Reorg
+from mobrecon.models.modules import conv_layer, mobile_unit, linear_layer, Reorg, concat_linear
 import os
 
 
@@ -259,11 +259,10 @@ class DenseStack_Backnone(nn.Module):
         stack2_out, stack2_mid = self.dense_stack2(thrink2)
         # latent = self.mid_proj(stack2_mid)
 
-        B, C, H, W = stack2_mid.shape  # C == 1024
-        txt_map = text_token.view(B, self.text_dim, 1, 1) \
-            .expand(-1, -1, H, W)  # (B,256,H,W)
-        merged = torch.cat([stack2_mid, txt_map], dim=1)  # (B,1280,H,W)
-        fused = self.txt_fusion(merged)  # (B,1024,H,W)
+        # 1x1 conv on [stack2_mid; text map] (1024+256 -> 1024), the text part is computed once per sample,
+        # then the BN and ReLU of txt_fusion
+        fused = concat_linear(stack2_mid, text_token, self.txt_fusion[0])
+        fused = self.txt_fusion[2](self.txt_fusion[1](fused))  # (B,1024,H,W)
         latent = self.mid_proj(fused)
 
         uv_reg = self.uv_reg(self.reduce(stack2_out).view(stack2_out.shape[0], 21, -1))
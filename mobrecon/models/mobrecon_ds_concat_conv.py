@@ -17,43 +17,20 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../.
 import torch.nn as nn
 import torch
 from mobrecon.models.densestack import DenseStack_Backnone
-from mobrecon.models.modules import Reg2DDecode3D
+from mobrecon.models.modules import Reg2DDecode3D, TextEmbeddingEncoder, concat_linear
 from mobrecon.models.loss import l1_loss, normal_loss, edge_length_loss, contrastive_loss_3d, contrastive_loss_2d
 from utils.read import spiral_tramsform
-from conv.spiralconv import SpiralConv
-from conv.dsconv import DSConv
+from conv import MESHCONV
 from mobrecon.build import MODEL_REGISTRY
-
-class TextEmbeddingEncoder(nn.Module):
-    def __init__(self, input_dim=768, output_dim=256):
-        super(TextEmbeddingEncoder, self).__init__()
-        # Define a simple feedforward network to encode the finger embeddings
-        self.fc1 = nn.Linear(input_dim * 5, 512)  # Input: 5 embeddings (768 each) -> Hidden layer with 512 units
-        self.fc2 = nn.Linear(512, output_dim)  # Hidden layer with 512 units -> Output with output_dim (e.g., 256)
-        self.relu = nn.ReLU()  # ReLU activation
-        self.layer_norm = nn.LayerNorm(512)  # Optional: normalization to stabilize learning
-
-    def forward(self, finger_embeddings):
-        """
-        :param finger_embeddings: A tensor of shape (batch_size, 5, 768) representing embeddings for each finger.
-        :return: A tensor of shape (batch_size, output_dim) representing the enriched feature vector.
-        """
-
-
-        # Flatten the input embeddings (concatenate all finger embeddings into a single vector)
-        x = finger_embeddings.reshape(finger_embeddings.size(0), -1)  # Shape: (batch_size, 5 * 768)
-
-        # Pass through the network
-        x = self.fc1(x)  # Shape: (batch_size, 512)
-        x = self.relu(x)
-        x = self.layer_norm(x)  # Normalize (optional)
-        x = self.fc2(x)  # Shape: (batch_size, output_dim)
-
-        return x
+from mobrecon.tools.text_codebook import load_codebook
+from mobrecon.tools.text_compress import load_projection
 
 
 @MODEL_REGISTRY.register()
 class MobRecon_DS_concat_conv(nn.Module):
+    # the single-view (3-channel) branch fuses the text as well
+    single_view_text = True
+
     def __init__(self, cfg):
         """Init a MobRecon-DenseStack model
 
@@ -62,7 +39,8 @@ class MobRecon_DS_concat_conv(nn.Module):
         """
         super(MobRecon_DS_concat_conv, self).__init__()
         # added by mub
-        self.text_embedding = TextEmbeddingEncoder()
+        self.text_embedding = TextEmbeddingEncoder(codebook=load_codebook(cfg.DATA.TEXT.CODEBOOK),
+                                                   projection=load_projection(cfg.DATA.TEXT.COMPRESS))
         C = 256
         self.txt_dim = 256
         self.fusion_conv = nn.Conv2d(C + self.txt_dim, C, kernel_size=1)
@@ -85,38 +63,39 @@ class MobRecon_DS_concat_conv(nn.Module):
                                        spiral_indices, 
                                        up_transform, 
                                        cfg.MODEL.KPTS_NUM,
-                                       meshconv=(SpiralConv, DSConv)[cfg.MODEL.SPIRAL.TYPE=='DSConv'])
+                                       meshconv=MESHCONV[cfg.MODEL.SPIRAL.TYPE],
+                                       upsample=cfg.MODEL.SPIRAL.UPSAMPLE,
+                                       upsample_cache=cfg.MODEL.SPIRAL.UPSAMPLE_CACHE)
 
-    def forward(self, x, finger_embeddings):
-        # added by mub
-        text_token = self.text_embedding(finger_embeddings)
+    def encode_text(self, finger_embeddings):
+        """Text token consumed by the fusion, fixed per sample at inference and can be precomputed (mobrecon/tools/text_cache.py)
 
-        if x.size(1) == 6:
-            pred3d_list = []
-            pred2d_pt_list = []
-            for i in range(2):
-                latent, pred2d_pt = self.backbone(x[:, 3*i:3*i+3])
-
-                B, C, H, W = latent.shape
-                text_map = text_token.unsqueeze(-1).unsqueeze(-1)  # (B, txt_dim, 1, 1)
-                text_map = text_map.expand(-1, -1, H, W)  # (B, txt_dim, H, W)
-                fused = torch.cat([latent, text_map], dim=1)  # (B, C+txt_dim, H, W)
-                latent = self.fusion_conv(fused)  # (B, C, H, W)
-
-                pred3d = self.decoder3d(pred2d_pt, latent)
-                pred3d_list.append(pred3d)
-                pred2d_pt_list.append(pred2d_pt)
-            pred2d_pt = torch.cat(pred2d_pt_list, -1)
-            pred3d = torch.cat(pred3d_list, -1)
-        else:
-            latent, pred2d_pt = self.backbone(x)
+        Args:
+            finger_embeddings (tensor): Bx5x768
+
+        Returns:
+            tensor: Bx256 text token
+        """
+        return self.text_embedding(finger_embeddings)
 
-            B, C, H, W = latent.shape
-            text_map = text_token.unsqueeze(-1).unsqueeze(-1).expand(-1, -1, H, W)
-            fused = torch.cat([latent, text_map], dim=1)
-            latent = self.fusion_conv(fused)
+    def forward(self, x, finger_embeddings=None, text_tokens=None):
+        text_token = self.encode_text(finger_embeddings) if text_tokens is None else text_tokens
 
-            pred3d = self.decoder3d(pred2d_pt, latent)
+        num = x.size(0)
+        if x.size(1) == 6:
+            # both views as one [2B, 3, H, W] batch, view-major
+            x = torch.cat(x.split(3, 1), 0)
+            text_token = text_token.repeat(2, 1)
+        latent, pred2d_pt = self.backbone(x)
+
+        # 1x1 conv on [latent; text map], the text part is computed once per sample
+        latent = concat_linear(latent, text_token, self.fusion_conv)  # (B, C, H, W)
+
+        pred3d = self.decoder3d(pred2d_pt, latent)
+        if latent.size(0) != num:
+            # back to the [..., 6] layout of the views
+            pred2d_pt = torch.cat(pred2d_pt.split(num, 0), -1)
+            pred3d = torch.cat(pred3d.split(num, 0), -1)
 
         return {'verts': pred3d,
                 'joint_img': pred2d_pt
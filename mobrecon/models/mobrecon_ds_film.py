@@ -17,53 +17,20 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../.
 import torch.nn as nn
 import torch
 from mobrecon.models.densestack import DenseStack_Backnone
-from mobrecon.models.modules import Reg2DDecode3D
+from mobrecon.models.modules import Reg2DDecode3D, TextEmbeddingEncoder, FiLM
 from mobrecon.models.loss import l1_loss, normal_loss, edge_length_loss, contrastive_loss_3d, contrastive_loss_2d
 from utils.read import spiral_tramsform
-from conv.spiralconv import SpiralConv
-from conv.dsconv import DSConv
+from conv import MESHCONV
 from mobrecon.build import MODEL_REGISTRY
+from mobrecon.tools.text_codebook import load_codebook
+from mobrecon.tools.text_compress import load_projection
 
-class TextEmbeddingEncoder(nn.Module):
-    def __init__(self, input_dim=768, output_dim=256):
-        super(TextEmbeddingEncoder, self).__init__()
-        # Define a simple feedforward network to encode the finger embeddings
-        self.fc1 = nn.Linear(input_dim * 5, 512)  # Input: 5 embeddings (768 each) -> Hidden layer with 512 units
-        self.fc2 = nn.Linear(512, output_dim)  # Hidden layer with 512 units -> Output with output_dim (e.g., 256)
-        self.relu = nn.ReLU()  # ReLU activation
-        self.layer_norm = nn.LayerNorm(512)  # Optional: normalization to stabilize learning
-
-    def forward(self, finger_embeddings):
-        """
-        :param finger_embeddings: A tensor of shape (batch_size, 5, 768) representing embeddings for each finger.
-        :return: A tensor of shape (batch_size, output_dim) representing the enriched feature vector.
-        """
-
-
-        # Flatten the input embeddings (concatenate all finger embeddings into a single vector)
-        x = finger_embeddings.reshape(finger_embeddings.size(0), -1)  # Shape: (batch_size, 5 * 768)
-
-        # Pass through the network
-        x = self.fc1(x)  # Shape: (batch_size, 512)
-        x = self.relu(x)
-        x = self.layer_norm(x)  # Normalize (optional)
-        x = self.fc2(x)  # Shape: (batch_size, output_dim)
-
-        return x
-
-class FiLM(nn.Module):
-    def __init__(self, txt_dim, c):
-        super().__init__()
-        self.gamma = nn.Linear(txt_dim, c)
-        self.beta = nn.Linear(txt_dim, c)
-
-    def forward(self, feat, txt):  # feat B×C×h×w
-        g = self.gamma(txt)[:, :, None, None]
-        b = self.beta(txt)[:, :, None, None]
-        return g * feat + b
 
 @MODEL_REGISTRY.register()
 class MobRecon_DS_film(nn.Module):
+    # only the contrastive (6-channel) branch fuses the text, single-view inference needs no text token
+    single_view_text = False
+
     def __init__(self, cfg):
         """Init a MobRecon-DenseStack model
 
@@ -72,7 +39,8 @@ class MobRecon_DS_film(nn.Module):
         """
         super(MobRecon_DS_film, self).__init__()
         # added by mub
-        self.text_embedding = TextEmbeddingEncoder()
+        self.text_embedding = TextEmbeddingEncoder(codebook=load_codebook(cfg.DATA.TEXT.CODEBOOK),
+                                                   projection=load_projection(cfg.DATA.TEXT.COMPRESS))
         C = 256
         txt_dim = 256
         self.txt_proj = nn.Linear(txt_dim, C)
@@ -96,24 +64,34 @@ class MobRecon_DS_film(nn.Module):
                                        spiral_indices, 
                                        up_transform, 
                                        cfg.MODEL.KPTS_NUM,
-                                       meshconv=(SpiralConv, DSConv)[cfg.MODEL.SPIRAL.TYPE=='DSConv'])
+                                       meshconv=MESHCONV[cfg.MODEL.SPIRAL.TYPE],
+                                       upsample=cfg.MODEL.SPIRAL.UPSAMPLE,
+                                       upsample_cache=cfg.MODEL.SPIRAL.UPSAMPLE_CACHE)
 
-    def forward(self, x, finger_embeddings):
-        # added by mub
-        text_token = self.text_embedding(finger_embeddings)
+    def encode_text(self, finger_embeddings):
+        """Text token consumed by the fusion, fixed per sample at inference and can be precomputed (mobrecon/tools/text_cache.py)
+
+        Args:
+            finger_embeddings (tensor): Bx5x768
+
+        Returns:
+            tensor: Bx512 FiLM [gamma, beta]
+        """
+        return self.fusion.modulation(self.txt_proj(self.text_embedding(finger_embeddings)))
 
+    def forward(self, x, finger_embeddings=None, text_tokens=None):
         if x.size(1) == 6:
-            pred3d_list = []
-            pred2d_pt_list = []
-            for i in range(2):
-                latent, pred2d_pt = self.backbone(x[:, 3*i:3*i+3])
-                latent = self.fusion(latent, self.txt_proj(text_token))
-                pred3d = self.decoder3d(pred2d_pt, latent)
-                pred3d_list.append(pred3d)
-                pred2d_pt_list.append(pred2d_pt)
-            pred2d_pt = torch.cat(pred2d_pt_list, -1)
-            pred3d = torch.cat(pred3d_list, -1)
+            text_token = self.encode_text(finger_embeddings) if text_tokens is None else text_tokens
+            # both views as one [2B, 3, H, W] batch, view-major, sharing the FiLM parameters
+            num = x.size(0)
+            latent, pred2d_pt = self.backbone(torch.cat(x.split(3, 1), 0))
+            latent = self.fusion.modulate(latent, text_token.repeat(2, 1))
+            pred3d = self.decoder3d(pred2d_pt, latent)
+            # back to the [..., 6] layout of the views
+            pred2d_pt = torch.cat(pred2d_pt.split(num, 0), -1)
+            pred3d = torch.cat(pred3d.split(num, 0), -1)
         else:
+            # the single-view branch does not use the text
             latent, pred2d_pt = self.backbone(x)
             pred3d = self.decoder3d(pred2d_pt, latent)
 
@@ -11,6 +11,10 @@
  * 
 """
 
+import os
+import json
+import time
+import tempfile
 import torch.nn as nn
 import torch
 from conv.spiralconv import SpiralConv
@@ -131,21 +135,167 @@ def Pool(x, trans, dim=1):
 
     Args:
         x (tensor): input tensor, BxNxD
-        trans (tuple): upsample indices and valus
+        trans (tuple): upsample indices and valus, on the device of x (Reg2DDecode3D keeps them as buffers)
         dim (int, optional): upsample axis. Defaults to 1.
 
     Returns:
         tensor: upsampled tensor, BxN'xD
     """
-    row, col, value = trans[0].to(x.device), trans[1].to(x.device), trans[2].to(x.device)
-    value = value.unsqueeze(-1)
-    out = torch.index_select(x, dim, col) * value
-    out2 = torch.zeros(x.size(0), row.size(0)//3, x.size(-1)).to(x.device)
-    idx = row.unsqueeze(0).unsqueeze(-1).expand_as(out)
+    row, col, value = trans[0], trans[1], trans[2]
+    out = torch.index_select(x, dim, col) * value.unsqueeze(-1)
+    out2 = x.new_zeros(x.size(0), row.size(0)//3, x.size(-1))
+    idx = row.view(1, -1, 1).expand_as(out)
     out2 = torch.scatter_add(out2, dim, idx, out)
     return out2
 
 
+def load_upsample_choices(path):
+    """Autotuned MeshUpsample backends of a json file, {} for an empty or missing path"""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+class MeshUpsample(nn.Module):
+    BACKENDS = ['scatter', 'dense', 'sparse', 'gather']
+
+    def __init__(self, trans, num_out, backend='scatter', cache_file=''):
+        """Upsample a mesh with a fixed sparse matrix U, out = U x, by one of
+        scatter: index_select * value and scatter_add, as Pool
+        dense: matmul with the dense U
+        sparse: torch.sparse.mm with U in CSR (COO on older torch)
+        gather: fixed fan-in, the input vertices of each output vertex gathered and weighted
+        With backend 'auto' every backend is timed once per input shape, device, dtype and grad mode, and the fastest
+        is kept, in cache_file when given so that the next run with the same config skips the timing.
+
+        Args:
+            trans (tuple): upsample row, col and value
+            num_out (int): output vertices
+            backend (str, optional): one of BACKENDS or 'auto'. Defaults to 'scatter'.
+            cache_file (str, optional): json of the autotuned backends. Defaults to ''.
+        """
+        super(MeshUpsample, self).__init__()
+        assert backend == 'auto' or backend in self.BACKENDS, backend
+        for name, val in zip(['row', 'col', 'value'], trans):
+            self.register_buffer(name, val)
+        self.num_out = num_out
+        self.backend = backend
+        self.cache_file = cache_file
+        self.choices = {}
+        self.timings = {}
+        self.operands = {}
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the upsampling matrices were buffers
+        for name, val in self._buffers.items():
+            state_dict.setdefault(prefix + name, val)
+        self.operands = {}
+        super(MeshUpsample, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def operand(self, backend, x):
+        """U in the layout of backend, built once per device, dtype and input vertices"""
+        key = (backend, x.device, x.dtype, x.size(1))
+        if key not in self.operands:
+            value = self.value.to(x.dtype)
+            if backend == 'scatter':
+                op = (self.row, self.col, value)
+            elif backend in ['dense', 'sparse']:
+                op = x.new_zeros(self.num_out, x.size(1)).index_put_((self.row, self.col), value, accumulate=True)
+                if backend == 'sparse':
+                    try:
+                        op = op.to_sparse_csr()
+                    except (AttributeError, RuntimeError):
+                        op = op.to_sparse()
+            else:
+                row, order = torch.sort(self.row, stable=True)
+                fan_in = torch.bincount(row, minlength=self.num_out)
+                slot = torch.arange(row.numel(), device=row.device) - (torch.cumsum(fan_in, 0) - fan_in)[row]
+                col = self.col.new_zeros(self.num_out, int(fan_in.max()))
+                weight = value.new_zeros(col.shape)  # padding slots point at vertex 0 with weight 0
+                col[row, slot] = self.col[order]
+                weight[row, slot] = value[order]
+                op = (col.view(-1), weight.unsqueeze(-1))
+            self.operands[key] = op
+        return self.operands[key]
+
+    def run(self, backend, x):
+        op = self.operand(backend, x)
+        if backend == 'scatter':
+            return Pool(x, op)
+        if backend == 'dense':
+            return torch.matmul(op, x)
+        if backend == 'sparse':
+            bs, n, c = x.size()
+            out = torch.sparse.mm(op, x.transpose(0, 1).reshape(n, bs * c))
+            return out.view(self.num_out, bs, c).transpose(0, 1)
+        col, weight = op
+        out = torch.index_select(x, 1, col).view(x.size(0), self.num_out, -1, x.size(-1))
+        return (out * weight).sum(2)
+
+    def shape_key(self, x):
+        device = torch.cuda.get_device_name(x.device) if x.device.type == 'cuda' else 'cpu{}'.format(torch.get_num_threads())
+        # batch sizes bucketed to powers of two, so that eval and last batches do not each trigger a timing
+        return '{}|{}|{}|{}->{}|B{}|C{}'.format(device, str(x.dtype).replace('torch.', ''), 'grad' if torch.is_grad_enabled() else 'nograd',
+                                                x.size(1), self.num_out, 1 << (x.size(0) - 1).bit_length(), x.size(-1))
+
+    def autotune(self, x, key, runs=20):
+        """Time every backend on a copy of x, in the current grad mode, and keep the fastest that matches scatter
+
+        Returns:
+            str: backend
+        """
+        choices = load_upsample_choices(self.cache_file)
+        if key not in choices:
+            grad = torch.is_grad_enabled()
+            x = x.detach().requires_grad_(grad)
+            sync = torch.cuda.synchronize if x.device.type == 'cuda' else (lambda: None)
+            ref = self.run('scatter', x).detach()
+            times = {}
+            for backend in self.BACKENDS:
+                try:
+                    if not torch.allclose(self.run(backend, x).detach(), ref, rtol=1e-3, atol=1e-5):
+                        continue
+                    sync()
+                    t = time.time()
+                    for _ in range(runs):
+                        out = self.run(backend, x)
+                        if grad:
+                            out.sum().backward()
+                    sync()
+                    times[backend] = (time.time() - t) / runs * 1000
+                except RuntimeError:
+                    continue
+            choices = load_upsample_choices(self.cache_file)
+            choices[key] = {'backend': min(times, key=times.get) if times else 'scatter', 'ms': times}
+            if self.cache_file:
+                # unique temp file, several processes (DDP ranks) may tune at once
+                cache_dir = os.path.dirname(os.path.abspath(self.cache_file))
+                os.makedirs(cache_dir, exist_ok=True)
+                fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(choices, f, indent=2, sort_keys=True)
+                os.replace(tmp_file, self.cache_file)
+        self.choices[key] = choices[key]['backend']
+        self.timings[key] = choices[key]['ms']
+        return self.choices[key]
+
+    def forward(self, x):
+        backend = self.backend
+        if backend == 'auto':
+            key = self.shape_key(x)
+            backend = self.choices.get(key)
+            if torch.jit.is_tracing():
+                # no timing inside a traced graph, and sparse ops do not export
+                backend = backend if backend in ['dense', 'gather'] else 'scatter'
+            elif backend is None:
+                backend = self.autotune(x, key)
+        return self.run(backend, x)
+
+    def extra_repr(self):
+        return 'num_out={}, backend={}'.format(self.num_out, self.backend)
+
+
 class SpiralDeblock(nn.Module):
     def __init__(self, in_channels, out_channels, indices, meshconv=SpiralConv):
         """Init a spiral conv block
@@ -165,13 +315,13 @@ class SpiralDeblock(nn.Module):
         self.conv.reset_parameters()
 
     def forward(self, x, up_transform):
-        out = Pool(x, up_transform)
+        out = up_transform(x) if isinstance(up_transform, nn.Module) else Pool(x, up_transform)
         out = self.relu(self.conv(out))
         return out
 
 # Advanced modules
 class Reg2DDecode3D(nn.Module):
-    def __init__(self, latent_size, out_channels, spiral_indices, up_transform, uv_channel, meshconv=SpiralConv):
+    def __init__(self, latent_size, out_channels, spiral_indices, up_transform, uv_channel, meshconv=SpiralConv, upsample='scatter', upsample_cache=''):
         """Init a 3D decoding with sprial convolution
 
         Args:
@@ -181,13 +331,16 @@ class Reg2DDecode3D(nn.Module):
             up_transform (list): upsampling matrix of each hand mesh level
             uv_channel (int): amount of 2D landmark 
             meshconv (optional): conv method, supporting SpiralConv, DSConv. Defaults to SpiralConv.
+            upsample (str, optional): MeshUpsample backend or 'auto'. Defaults to 'scatter'.
+            upsample_cache (str, optional): json of the autotuned MeshUpsample backends. Defaults to ''.
         """
         super(Reg2DDecode3D, self).__init__()
         self.latent_size = latent_size
         self.out_channels = out_channels
         self.spiral_indices = spiral_indices
-        self.up_transform = up_transform
-        self.num_vert = [u[0].size(0)//3 for u in self.up_transform] + [self.up_transform[-1][0].size(0)//6]
+        self.num_vert = [u[0].size(0)//3 for u in up_transform] + [up_transform[-1][0].size(0)//6]
+        # upsampling matrices as buffers of the upsampling layers, so that they move once with .to() and are saved in the state_dict
+        self.up = nn.ModuleList([MeshUpsample(trans, num_out, upsample, upsample_cache) for trans, num_out in zip(up_transform, self.num_vert)])
         self.uv_channel = uv_channel
         # self.de_layer_conv = conv_layer(self.latent_size, self.out_channels[- 1], 1, bn=False, relu=False)
         self.de_layer = nn.ModuleList()
@@ -200,6 +353,10 @@ class Reg2DDecode3D(nn.Module):
         self.upsample = nn.Parameter(torch.ones([self.num_vert[-1], self.uv_channel])*0.01, requires_grad=True)
 
 
+    @property
+    def up_transform(self):
+        return [(up.row, up.col, up.value) for up in self.up]
+
     def index(self, feat, uv):
         uv = uv.unsqueeze(2)  # [B, N, 1, 2]
         samples = torch.nn.functional.grid_sample(feat, uv, align_corners=True)  # [B, C, N, 1]
@@ -209,10 +366,201 @@ class Reg2DDecode3D(nn.Module):
         uv = torch.clamp((uv - 0.5) * 2, -1, 1)
         # x = self.de_layer_conv(x)
         x = self.index(x, uv).permute(0, 2, 1)
-        x = torch.bmm(self.upsample.repeat(x.size(0), 1, 1).to(x.device), x)
+        x = torch.matmul(self.upsample, x)
         num_features = len(self.de_layer)
         for i, layer in enumerate(self.de_layer):
-            x = layer(x, self.up_transform[num_features - i - 1])
+            x = layer(x, self.up[num_features - i - 1])
         pred = self.head(x)
 
         return pred
+
+
+# Text modules
+class TextEmbeddingEncoder(nn.Module):
+    def __init__(self, input_dim=768, output_dim=256, codebook=None, projection=None):
+        super(TextEmbeddingEncoder, self).__init__()
+        # PCA (mean, components) of the embeddings (mobrecon/tools/text_compress.py), fc1 then takes the reduced dim
+        # and full 768-d inputs are projected first
+        if projection is not None:
+            input_dim = projection[1].size(0)
+        self.register_buffer('proj_mean', None if projection is None else projection[0], persistent=False)
+        self.register_buffer('proj_components', None if projection is None else projection[1], persistent=False)
+        # Define a simple feedforward network to encode the finger embeddings
+        self.fc1 = nn.Linear(input_dim * 5, 512)  # Input: 5 embeddings (768 each) -> Hidden layer with 512 units
+        self.fc2 = nn.Linear(512, output_dim)  # Hidden layer with 512 units -> Output with output_dim (e.g., 256)
+        self.relu = nn.ReLU()  # ReLU activation
+        self.layer_norm = nn.LayerNorm(512)  # Optional: normalization to stabilize learning
+        # unique finger embeddings (mobrecon/tools/text_codebook.py), the inputs may then be [B, 5] indices;
+        # not persistent so that checkpoints stay independent of the codebook
+        self.register_buffer('codebook', codebook, persistent=False)
+        self.fc1_table = None
+        self.fc1_key = None
+
+    def project(self, emb):
+        """768-d embeddings to the fc1 input dim"""
+        if self.proj_components is None or emb.size(-1) == self.proj_components.size(0):
+            return emb
+        return torch.matmul(emb - self.proj_mean, self.proj_components.t())
+
+    def fc1_indexed(self, indices):
+        """fc1 of codebook indices: fc1(x) = b + sum_f W_f e_f with W_f the columns of finger f, so in eval W_f e
+        is tabulated once per codebook entry and fc1 becomes 5 gathers. The table follows in-place weight updates.
+        """
+        if self.training:
+            return self.fc1(self.project(self.codebook[indices]).reshape(indices.size(0), -1))
+        key = (self.fc1.weight.data_ptr(), self.fc1.weight._version, self.codebook.data_ptr())
+        if self.fc1_key != key:
+            with torch.no_grad():
+                weight = self.fc1.weight.view(self.fc1.out_features, indices.size(1), -1)  # [512, 5, 768]
+                self.fc1_table = torch.einsum('ofi,ki->fko', weight, self.project(self.codebook))  # [5, K, 512]
+            self.fc1_key = key
+        fingers = torch.arange(indices.size(1), device=indices.device)
+        return self.fc1_table[fingers, indices].sum(1) + self.fc1.bias
+
+    def forward(self, finger_embeddings):
+        """
+        :param finger_embeddings: A tensor of shape (batch_size, 5, 768) representing embeddings for each finger,
+                                  or of shape (batch_size, 5) with their codebook indices.
+        :return: A tensor of shape (batch_size, output_dim) representing the enriched feature vector.
+        """
+
+        if not finger_embeddings.is_floating_point():
+            x = self.fc1_indexed(finger_embeddings.long())  # Shape: (batch_size, 512)
+        else:
+            # Flatten the input embeddings (concatenate all finger embeddings into a single vector)
+            x = self.project(finger_embeddings).reshape(finger_embeddings.size(0), -1)  # Shape: (batch_size, 5 * 768)
+            x = self.fc1(x)  # Shape: (batch_size, 512)
+
+        # Pass through the network
+        x = self.relu(x)
+        x = self.layer_norm(x)  # Normalize (optional)
+        x = self.fc2(x)  # Shape: (batch_size, output_dim)
+
+        return x
+
+
+def concat_linear(feat, text, layer):
+    """Apply layer to [feat; text] with text broadcast over the spatial dims, without materializing the concat.
+    As W [f; t] = W_f f + W_t t, the text term is computed once per sample and broadcast-added.
+
+    Args:
+        feat (tensor): BxHxWxC for an nn.Linear, BxCxHxW for a 1x1 nn.Conv2d
+        text (tensor): BxT
+        layer (nn.Linear or nn.Conv2d): layer over C+T input features, feature first
+
+    Returns:
+        tensor: BxHxWxO or BxOxHxW
+    """
+    linear = isinstance(layer, nn.Linear)
+    c = feat.size(-1) if linear else feat.size(1)
+    weight = layer.weight.flatten(1)  # Ox(C+T)
+    text_term = torch.matmul(text, weight[:, c:].t())
+    if layer.bias is not None:
+        text_term = text_term + layer.bias
+    if linear:
+        return torch.matmul(feat, weight[:, :c].t()) + text_term.view(text.size(0), *([1] * (feat.dim() - 2)), -1)
+    return torch.nn.functional.conv2d(feat, layer.weight[:, :c]) + text_term[:, :, None, None]
+
+
+class FiLM(nn.Module):
+    def __init__(self, txt_dim, c):
+        super().__init__()
+        self.gamma = nn.Linear(txt_dim, c)
+        self.beta = nn.Linear(txt_dim, c)
+
+    def modulation(self, txt):
+        """[gamma, beta] of a text token, Bx2C"""
+        return torch.cat([self.gamma(txt), self.beta(txt)], -1)
+
+    def modulate(self, feat, modulation):  # feat B×C×h×w
+        g, b = modulation[:, :, None, None].chunk(2, 1)
+        return g * feat + b
+
+    def forward(self, feat, txt):
+        return self.modulate(feat, self.modulation(txt))
+
+
+if __name__ == '__main__':
+    def latency(func, runs=50):
+        with torch.no_grad():
+            func()
+            t = time.time()
+            for _ in range(runs):
+                func()
+        return (time.time() - t) / runs * 1000
+
+    # factorized concat fusion against the expanded concat, at the sizes of the MobRecon fusions
+    torch.manual_seed(0)
+    for name, batch, c, t, o, hw, layer in [('fusion_mlp', 64, 256, 256, 512, 4, nn.Linear(512, 512)),
+                                            ('fusion_conv', 64, 256, 256, 256, 4, nn.Conv2d(512, 256, 1)),
+                                            ('txt_fusion', 64, 1024, 256, 1024, 4, nn.Conv2d(1280, 1024, 1, bias=False))]:
+        text = torch.randn(batch, t)
+        if isinstance(layer, nn.Linear):
+            feat = torch.randn(batch, hw, hw, c)
+            concat = lambda: layer(torch.cat([feat, text[:, None, None].expand(-1, hw, hw, -1)], -1))
+        else:
+            feat = torch.randn(batch, c, hw, hw)
+            concat = lambda: layer(torch.cat([feat, text[:, :, None, None].expand(-1, -1, hw, hw)], 1))
+        factorized = lambda: concat_linear(feat, text, layer)
+        with torch.no_grad():
+            diff = (concat() - factorized()).abs().max().item()
+        assert diff < 1e-4, name
+        # bytes of the expanded text and of the concat against the per-sample text term
+        mem_concat = (batch * hw * hw * t + batch * hw * hw * (c + t)) * 4
+        mem_factorized = batch * o * 4
+        print('{}: max diff {:.1e}, intermediates {:.2f}MB -> {:.2f}MB, {:.3f}ms -> {:.3f}ms'.format(
+            name, diff, mem_concat / 2**20, mem_factorized / 2**20, latency(concat), latency(factorized)))
+
+    # decoder with device-resident topology against per-forward host-device copies of it (the former behaviour)
+    from utils.read import spiral_tramsform
+    template_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../template')
+    spiral_indices, _, up_transform, _ = spiral_tramsform(os.path.join(template_dir, 'transform.pkl'), os.path.join(template_dir, 'template.ply'),
+                                                          [2, 2, 2, 2], [9, 9, 9, 9], [1, 1, 1, 1])
+    up_transform = [(*u._indices(), u._values()) for u in up_transform]
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    decoder = Reg2DDecode3D(256, [32, 64, 128, 256], spiral_indices, up_transform, 21).to(device).eval()
+    topology = [[t.cpu() for t in trans] for trans in decoder.up_transform]
+    indices = [layer.conv.indices.cpu() for layer in decoder.de_layer] + [decoder.head.indices.cpu()]
+
+    def legacy(uv, x):
+        uv = torch.clamp((uv - 0.5) * 2, -1, 1)
+        x = decoder.index(x, uv).permute(0, 2, 1)
+        x = torch.bmm(decoder.upsample.repeat(x.size(0), 1, 1).to(x.device), x)
+        for i, layer in enumerate(decoder.de_layer + [decoder.head]):
+            if i < len(decoder.de_layer):
+                row, col, value = [t.to(x.device) for t in topology[len(decoder.de_layer) - i - 1]]
+                out = torch.index_select(x, 1, col) * value.unsqueeze(-1)
+                out2 = torch.zeros(x.size(0), row.size(0)//3, x.size(-1)).to(x.device)
+                x = torch.scatter_add(out2, 1, row.unsqueeze(0).unsqueeze(-1).expand_as(out), out)
+            conv = layer.conv if i < len(decoder.de_layer) else layer
+            x = torch.index_select(x, 1, indices[i].to(x.device).reshape(-1)).view(x.size(0), indices[i].size(0), -1)
+            x = conv.layer(x)
+            if i < len(decoder.de_layer):
+                x = layer.relu(x)
+        return x
+
+    for batch in [1, 32]:
+        uv, feat = torch.rand(batch, 21, 2, device=device), torch.randn(batch, 256, 4, 4, device=device)
+        with torch.no_grad():
+            diff = (decoder(uv, feat) - legacy(uv, feat)).abs().max().item()
+        assert diff < 1e-5
+        sync = torch.cuda.synchronize if device.type == 'cuda' else (lambda: None)
+        times = []
+        for func in [lambda: legacy(uv, feat), lambda: decoder(uv, feat)]:
+            times.append(latency(lambda: (func(), sync())))
+        print('decoder on {}, batch {}: max diff {:.1e}, {:.3f}ms -> {:.3f}ms'.format(device, batch, diff, *times))
+
+    # upsampling backends of every decoder level, at inference and training batch sizes, without and with gradients
+    n = len(decoder.up)
+    for j, up in enumerate(decoder.up):
+        tuner = MeshUpsample(decoder.up_transform[j], up.num_out, 'auto').to(device)
+        channels = decoder.out_channels[min(j + 1, n - 1)]
+        for batch in [1, 32]:
+            x = torch.randn(batch, decoder.num_vert[j + 1], channels, device=device)
+            for grad in [False, True]:
+                with torch.set_grad_enabled(grad):
+                    key = tuner.shape_key(x)
+                    backend = tuner.autotune(x, key)
+                    out = tuner(x)
+                assert torch.allclose(out, up.run('scatter', x), rtol=1e-3, atol=1e-5)
+                print('{}: {} ({})'.format(key, backend, ', '.join('{} {:.3f}ms'.format(k, v) for k, v in tuner.timings[key].items())))
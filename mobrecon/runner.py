@@ -1,19 +1,52 @@
 import os
+import copy
 import numpy as np
 import time
 import torch
 import cv2
 import json
+import tempfile
 from utils.warmup_scheduler import adjust_learning_rate
 from utils.vis import inv_base_tranmsform
 from utils.zimeval import EvalUtil
-from utils.transforms import rigid_align
-from mobrecon.tools.vis import perspective, compute_iou, cnt_area
-from mobrecon.tools.kinematics import mano_to_mpii, MPIIHandJoints
-from mobrecon.tools.registration import registration
+from utils.transforms import batch_rigid_align
+from mobrecon.tools.vis import perspective, compute_iou_batch, cnt_area
+from mobrecon.tools.kinematics import mano_to_mpii, MPIIHandJoints, MANO_TO_MPII
+from mobrecon.tools.registration import registration, batch_registration
+from utils.registration_pool import RegistrationPool
+from utils.fuse import fuse_for_inference
 import vctoolkit as vc
 
 
+def inference_model(cfg, model, onnx_dir=None, onnx_backend=None):
+    """Eager model, BN-folded copy of it with cfg.TEST.FUSE, or an ONNX Runtime session on the exported single-view
+    graph with cfg.TEST.BACKEND = 'onnx'. Shared by Runner and the server so that both run the same graph.
+
+    Args:
+        cfg : config file
+        model (nn.Module): MobRecon model, possibly DDP-wrapped
+        onnx_dir (str, optional): folder of the exported graph without cfg.TEST.ONNX_PATH. Defaults to a temp folder.
+        onnx_backend (OnnxBackend, optional): session of a previous call, reused with a fixed cfg.TEST.ONNX_PATH. Defaults to None.
+
+    Returns:
+        model or OnnxBackend
+    """
+    if cfg.TEST.BACKEND != 'onnx':
+        # folded again on every call, the weights change between epochs
+        return fuse_for_inference(copy.deepcopy(model)) if cfg.TEST.FUSE else model
+    from mobrecon.tools.export import export_onnx
+    from mobrecon.tools.onnx_backend import OnnxBackend
+    path = cfg.TEST.ONNX_PATH
+    if not path:
+        # exported again on every call from the current weights, as for TEST.FUSE
+        path = os.path.join(onnx_dir or tempfile.mkdtemp(prefix='mobrecon_onnx_'), 'model.onnx')
+        export_onnx(model.module if hasattr(model, 'module') else model, cfg.DATA.SIZE, path)
+        onnx_backend = None
+    if onnx_backend is None:
+        onnx_backend = OnnxBackend(path, cfg.TEST.ONNX_THREADS)
+    return onnx_backend
+
+
 class Runner(object):
     def __init__(self, cfg, args, model, train_loader, val_loader, test_loader, optimizer, writer, device, board, start_epoch=0):
         super(Runner, self).__init__()
@@ -90,6 +123,35 @@ class Runner(object):
                 pass
         return data
 
+    def mask_to_poly(self, mask, size):
+        """Largest external contour of a binary mask [HxW] resized to size (H', W'), None if not found
+        """
+        mask = cv2.resize(mask, (size[1], size[0]))
+        try:
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            contours.sort(key=cnt_area, reverse=True)
+            poly = contours[0].transpose(1, 0, 2).astype(np.int32)
+        except:
+            poly = None
+        return poly
+
+    def resize_mask(self, mask, size):
+        """Resize a batch of masks [BxHxW] to size (H', W') with cv2.resize, as the per-sample evaluation does, so that
+        the IoU matches it exactly (cv2 rounds uint8 in fixed point, torch bilinear + round would round half to even).
+        The batch is moved to the host once.
+        """
+        if tuple(mask.shape[1:]) == tuple(size):
+            return mask.float()
+        resized = np.stack([cv2.resize(m, (int(size[1]), int(size[0]))) for m in mask.cpu().numpy()])
+        return torch.from_numpy(resized).float().to(mask.device)
+
+    def inference_model(self):
+        """Model run by eval and pred, see inference_model"""
+        model = inference_model(self.cfg, self.model, self.args.out_dir, getattr(self, 'onnx_backend', None))
+        if self.cfg.TEST.BACKEND == 'onnx':
+            self.onnx_backend = model
+        return model
+
     def board_scalar(self, phase, n_iter, lr=None, **kwargs):
         split = '/'
         for key, val in kwargs.items():
@@ -210,13 +272,14 @@ class Runner(object):
     def eval(self):
         self.writer.print_str('EVALING ... Epoch {}/{}'.format(self.epoch, self.max_epochs))
         self.model.eval()
+        model = self.inference_model()
         evaluator_2d = EvalUtil()
         evaluator_rel = EvalUtil()
         evaluator_pa = EvalUtil()
+        j_reg = torch.from_numpy(self.j_reg[MANO_TO_MPII]).to(self.device, torch.float64)
         mask_iou = []
-        joint_cam_errors = []
-        pa_joint_cam_errors = []
-        joint_img_errors = []
+        joint_cam_pred_list, joint_cam_gt_list = [], []
+        joint_img_pred_list, joint_img_gt_list = [], []
         with torch.no_grad():
             for step, data in enumerate(self.val_loader):
                 if self.board is None and step % 100 == 0:
@@ -224,52 +287,57 @@ class Runner(object):
                 # get data then infernce
                 data = self.phrase_data(data)
                 #added by mub
-                out = self.model(data['img'], finger_embeddings = data["textembed"])
+                out = model(data['img'], finger_embeddings=data.get('textembed'), text_tokens=data.get('texttoken'))
+                batch_size, size = data['img'].size(0), data['img'].size(2)
 
                 # get vertex pred
-                verts_pred = out['verts'][0].cpu().numpy() * 0.2
-                joint_cam_pred = mano_to_mpii(np.matmul(self.j_reg, verts_pred)) * 1000.0
-
-                # get mask pred
-                mask_pred = out.get('mask')
-                if mask_pred is not None:
-                    mask_pred = (mask_pred[0] > 0.3).cpu().numpy().astype(np.uint8)
-                    mask_pred = cv2.resize(mask_pred, (data['img'].size(3), data['img'].size(2)))
-                else:
-                    mask_pred = np.zeros((data['img'].size(3), data['img'].size(2)), np.uint8)
+                verts_pred = (out['verts'] * 0.2).double()
+                joint_cam_pred_list.append(torch.matmul(j_reg, verts_pred) * 1000.0)
+                joint_cam_gt_list.append((data['joint_cam'] * 1000.0).double())
 
                 # get uv pred
                 joint_img_pred = out.get('joint_img')
                 if joint_img_pred is not None:
-                    joint_img_pred = joint_img_pred[0].cpu().numpy() * data['img'].size(2)
+                    joint_img_pred_list.append(joint_img_pred * size)
                 else:
-                    joint_img_pred = np.zeros((21, 2), dtype=np.float)
-
-                # pck
-                joint_cam_gt = data['joint_cam'][0].cpu().numpy() * 1000.0
-                joint_cam_align = rigid_align(joint_cam_pred, joint_cam_gt)
-                evaluator_2d.feed(data['joint_img'][0].cpu().numpy() * data['img'].size(2), joint_img_pred)
-                evaluator_rel.feed(joint_cam_gt, joint_cam_pred)
-                evaluator_pa.feed(joint_cam_gt, joint_cam_align)
+                    joint_img_pred_list.append(data['joint_img'].new_zeros(data['joint_img'].shape))
+                joint_img_gt_list.append(data['joint_img'] * size)
 
-                # error
+                # get mask pred and iou
                 if 'mask_gt' in data.keys():
-                    mask_iou.append(compute_iou(mask_pred, cv2.resize(data['mask_gt'][0].cpu().numpy(), (data['img'].size(3), data['img'].size(2)))))
+                    mask_pred = out.get('mask')
+                    if mask_pred is not None:
+                        mask_pred = self.resize_mask((mask_pred > 0.3).to(torch.uint8), data['img'].shape[2:])
+                    else:
+                        mask_pred = torch.zeros(batch_size, *data['img'].shape[2:], device=self.device)
+                    mask_gt = self.resize_mask(data['mask_gt'], data['img'].shape[2:])
+                    mask_iou.append(compute_iou_batch(mask_pred, mask_gt))
                 else:
-                    mask_iou.append(0)
-                joint_cam_errors.append(np.sqrt(np.sum((joint_cam_pred - joint_cam_gt) ** 2, axis=1)))
-                pa_joint_cam_errors.append(np.sqrt(np.sum((joint_cam_gt - joint_cam_align) ** 2, axis=1)))
-                joint_img_errors.append(np.sqrt(np.sum((data['joint_img'][0].cpu().numpy()*data['img'].size(2) - joint_img_pred) ** 2, axis=1)))
+                    mask_iou.append(torch.zeros(batch_size, device=self.device))
+
+            # align and move to cpu at once
+            joint_cam_pred = torch.cat(joint_cam_pred_list)
+            joint_cam_gt = torch.cat(joint_cam_gt_list)
+            joint_cam_align = batch_rigid_align(joint_cam_pred, joint_cam_gt)
+            joint_img_pred = torch.cat(joint_img_pred_list)
+            joint_img_gt = torch.cat(joint_img_gt_list)
+            joint_cam_pred, joint_cam_gt, joint_cam_align, joint_img_pred, joint_img_gt, mask_iou = \
+                [x.cpu().numpy() for x in [joint_cam_pred, joint_cam_gt, joint_cam_align, joint_img_pred, joint_img_gt, torch.cat(mask_iou)]]
+
+            # pck
+            evaluator_2d.feed(joint_img_gt, joint_img_pred)
+            evaluator_rel.feed(joint_cam_gt, joint_cam_pred)
+            evaluator_pa.feed(joint_cam_gt, joint_cam_align)
 
             # get auc
             _1, _2, _3, auc_rel, pck_curve_rel, thresholds2050 = evaluator_rel.get_measures(20, 50, 20)
             _1, _2, _3, auc_pa, pck_curve_pa, _ = evaluator_pa.get_measures(20, 50, 20)
             _1, _2, _3, auc_2d, pck_curve_2d, _ = evaluator_2d.get_measures(0, 30, 20)
             # get error
-            miou = np.array(mask_iou).mean()
-            mpjpe = np.array(joint_cam_errors).mean()
-            pampjpe = np.array(pa_joint_cam_errors).mean()
-            uve = np.array(joint_img_errors).mean()
+            miou = mask_iou.mean()
+            mpjpe = np.sqrt(np.sum((joint_cam_pred - joint_cam_gt) ** 2, axis=-1)).mean()
+            pampjpe = np.sqrt(np.sum((joint_cam_gt - joint_cam_align) ** 2, axis=-1)).mean()
+            uve = np.sqrt(np.sum((joint_img_gt - joint_img_pred) ** 2, axis=-1)).mean()
 
             if self.board is not None:
                 self.board_scalar('test', self.epoch, **{'auc_loss': auc_rel, 'pa_auc_loss': auc_pa, '2d_auc_loss': auc_2d, 'mIoU_loss': miou, 'uve': uve, 'mpjpe_loss': mpjpe, 'pampjpe_loss': pampjpe})
@@ -279,52 +347,73 @@ class Runner(object):
                 print('thresholds2050', thresholds2050)
                 print('pck_curve_all_pa', pck_curve_pa)
             self.writer.print_str( f'pampjpe: {pampjpe}, mpjpe: {mpjpe}, uve: {uve}, miou: {miou}, auc_rel: {auc_rel}, auc_pa: {auc_pa}, auc_2d: {auc_2d}')
+            self.metrics = {'pampjpe': pampjpe, 'mpjpe': mpjpe, 'uve': uve, 'miou': miou, 'auc_rel': auc_rel, 'auc_pa': auc_pa, 'auc_2d': auc_2d}
 
         return pampjpe
 
     def pred(self):
         self.writer.print_str('PREDICING ... Epoch {}/{}'.format(self.epoch, self.max_epochs))
         self.model.eval()
+        model = self.inference_model()
         xyz_pred_list, verts_pred_list = list(), list()
+
+        def track(meta, verts_pred):
+            # get joint_cam
+            joint_cam_pred = mano_to_mpii(np.matmul(self.j_reg, verts_pred))
+
+            # track data
+            if self.cfg.TEST.SAVE_PRED:
+                data, out = meta
+                draw = self.draw_results(data, out, {}, 0, aligned_verts=torch.from_numpy(verts_pred).float()[None, ...])[..., ::-1]
+                cv2.imwrite(os.path.join(self.args.out_dir, self.cfg.TEST.SAVE_DIR, f'{len(xyz_pred_list)}.png'), draw)
+            xyz_pred_list.append(joint_cam_pred)
+            verts_pred_list.append(verts_pred)
+
+        # slsqp registration runs in worker processes while the next batches are forwarded
+        pool = RegistrationPool(self.cfg.TEST.REGISTRATION_WORKERS, self.cfg.TEST.REGISTRATION_QUEUE) if self.cfg.TEST.REGISTRATION == 'slsqp' else None
         with torch.no_grad():
             for step, data in enumerate(self.test_loader):
                 if self.board is None and step % 100 == 0:
                     print(step, len(self.test_loader))
                 data = self.phrase_data(data)
                 #added by mub
-                out = self.model(data['img'], finger_embeddings = data["textembed"])
-                # get verts pred
-                verts_pred = out['verts'][0].cpu().numpy() * 0.2
+                out = model(data['img'], finger_embeddings=data.get('textembed'), text_tokens=data.get('texttoken'))
+                batch_size, size = data['img'].size(0), data['img'].size(2)
 
                 # get mask pred
                 mask_pred = out.get('mask')
                 if mask_pred is not None:
-                    mask_pred = (mask_pred[0] > 0.3).cpu().numpy().astype(np.uint8)
-                    mask_pred = cv2.resize(mask_pred, (data['img'].size(3), data['img'].size(2)))
-                    try:
-                        contours, _ = cv2.findContours(mask_pred, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                        contours.sort(key=cnt_area, reverse=True)
-                        poly = contours[0].transpose(1, 0, 2).astype(np.int32)
-                    except:
-                        poly = None
+                    mask_pred = (mask_pred > 0.3).cpu().numpy().astype(np.uint8)
+                    poly = [self.mask_to_poly(mask_pred[b], data['img'].shape[2:]) for b in range(batch_size)]
                 else:
-                    poly = None
+                    poly = [None, ] * batch_size
 
-                # get uv pred
+                # get verts pred, registered with uv pred
+                verts_pred = out['verts'] * 0.2
                 joint_img_pred = out.get('joint_img')
+                if joint_img_pred is not None and self.cfg.TEST.REGISTRATION == 'batch':
+                    verts_pred, align_state = batch_registration(verts_pred, joint_img_pred * size, self.j_reg, data['calib'], self.cfg.DATA.SIZE, poly=poly)
+                verts_pred = verts_pred.cpu().numpy()
+                calib = data['calib'].cpu().numpy()
                 if joint_img_pred is not None:
-                    joint_img_pred = joint_img_pred[0].cpu().numpy() * data['img'].size(2)
-                    verts_pred, align_state = registration(verts_pred, joint_img_pred, self.j_reg, data['calib'][0].cpu().numpy(), self.cfg.DATA.SIZE, poly=poly)
-
-                # get joint_cam
-                joint_cam_pred = mano_to_mpii(np.matmul(self.j_reg, verts_pred))
-
-                # track data
-                xyz_pred_list.append(joint_cam_pred)
-                verts_pred_list.append(verts_pred)
-                if self.cfg.TEST.SAVE_PRED:
-                    draw = self.draw_results(data, out, {}, 0, aligned_verts=torch.from_numpy(verts_pred).float()[None, ...])[..., ::-1]
-                    cv2.imwrite(os.path.join(self.args.out_dir, self.cfg.TEST.SAVE_DIR, f'{step}.png'), draw)
+                    joint_img_pred = joint_img_pred.cpu().numpy() * size
+
+                for b in range(batch_size):
+                    meta = None
+                    if self.cfg.TEST.SAVE_PRED:
+                        meta = ({k: v[b:b+1] for k, v in data.items() if isinstance(v, torch.Tensor)},
+                                {k: v[b:b+1] for k, v in out.items() if isinstance(v, torch.Tensor)})
+                    if joint_img_pred is not None and pool is not None:
+                        done = pool.submit(registration, verts_pred[b], joint_img_pred[b], self.j_reg, calib[b], self.cfg.DATA.SIZE, poly=poly[b], meta=meta)
+                        for m, (verts, align_state) in done:
+                            track(m, verts)
+                    else:
+                        track(meta, verts_pred[b])
+
+        if pool is not None:
+            for m, (verts, align_state) in pool.drain():
+                track(m, verts)
+            pool.close()
 
         # dump results
         xyz_pred_list = [x.tolist() for x in xyz_pred_list]
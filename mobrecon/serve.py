@@ -0,0 +1,250 @@
+"""
+ * @file serve.py
+ * @brief local HTTP inference server, concurrent requests are collected into micro-batches
+ *        and run with a single forward
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import base64
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import request as urlrequest
+import cv2
+import numpy as np
+import torch
+from mobrecon.build import build_model
+from mobrecon.configs.config import get_cfg
+from mobrecon.runner import inference_model
+from mobrecon.tools.registration import batch_registration
+from mobrecon.tools.text_cache import TextTokenCache
+from options.cfg_options import CFGOptions
+
+
+class MicroBatcher(object):
+    """Collects requests into batches of at most max_batch, the first request of a batch waits no more than
+    max_latency seconds for the others. One forward (and one batched registration) is run per batch.
+
+    Args:
+        cfg : config file
+        model (nn.Module): MobRecon model
+        j_reg (array): vertex -> joint
+        device (torch.device): device of the model
+    """
+    def __init__(self, cfg, model, j_reg, device):
+        self.cfg = cfg
+        # the inference path of Runner.eval (TEST.FUSE, TEST.BACKEND), so that served numbers match eval
+        self.model = inference_model(cfg, model.eval())
+        # text tokens only for models whose single-view branch consumes them, ONNX graphs take the embeddings
+        self.use_text = getattr(model, 'single_view_text', True)
+        self.j_reg = j_reg
+        self.device = device
+        self.max_batch = cfg.SERVE.MAX_BATCH
+        self.max_latency = cfg.SERVE.MAX_LATENCY
+        self.text_cache = TextTokenCache(self.model, cfg.DATA.TEXT.LRU) if self.use_text and hasattr(self.model, 'encode_text') else None
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.metrics = {'requests': 0, 'batches': 0, 'errors': 0}
+        self.latency = []
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def __call__(self, img, calib=None, textembed=None, sample_id=None):
+        """Blocking inference for one request
+
+        Args:
+            img (array): HxWx3 RGB hand crop, resized to cfg.DATA.SIZE
+            calib (array, optional): [4x4] intrinsics of the crop, the result is registered if given. Defaults to None.
+            textembed (array, optional): [5x768] finger text embeddings. Defaults to the cached token of sample_id, else zeros.
+            sample_id (str, optional): key of the text token LRU, textembed may be left out once it is cached. Defaults to None.
+
+        Returns:
+            dict: verts, joint_img and, with calib, verts_cam
+        """
+        job = {'img': img, 'calib': calib, 'textembed': textembed, 'id': sample_id, 't': time.time(), 'done': threading.Event()}
+        self.queue.put(job)
+        job['done'].wait()
+        if 'error' in job:
+            raise job['error']
+        return job['out']
+
+    def collect(self):
+        batch = [self.queue.get()]
+        deadline = batch[0]['t'] + self.max_latency
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def loop(self):
+        while True:
+            batch = self.collect()
+            try:
+                self.run(batch)
+            except Exception as e:
+                for job in batch:
+                    job['error'] = e
+                with self.lock:
+                    self.metrics['errors'] += len(batch)
+            now = time.time()
+            with self.lock:
+                self.metrics['requests'] += len(batch)
+                self.metrics['batches'] += 1
+                self.latency += [now - job['t'] for job in batch]
+                self.latency = self.latency[-10000:]
+            for job in batch:
+                job['done'].set()
+
+    def run(self, batch):
+        size = self.cfg.DATA.SIZE
+        img = np.stack([cv2.resize(job['img'], (size, size)) for job in batch]).astype(np.float32) / 255
+        img = torch.from_numpy((img - self.cfg.DATA.IMG_MEAN) / self.cfg.DATA.IMG_STD).permute(0, 3, 1, 2).to(self.device)
+        if not self.use_text:
+            with torch.no_grad():
+                out = self.model(img)
+        else:
+            textembed = torch.stack([torch.zeros(5, 768) if job['textembed'] is None else torch.as_tensor(job['textembed']).float() for job in batch]).to(self.device)
+            if self.text_cache is not None:
+                # requests without textembed get the token of their id if cached, else one of zeros that is not cached
+                text_tokens = self.text_cache([job['id'] for job in batch], textembed, [job['textembed'] is not None for job in batch])
+                with torch.no_grad():
+                    out = self.model(img, text_tokens=text_tokens)
+            else:
+                with torch.no_grad():
+                    out = self.model(img, finger_embeddings=textembed)
+        verts = out['verts'] * 0.2
+        joint_img = out['joint_img'] * size
+        verts_cam = [None] * len(batch)
+        registered = [i for i, job in enumerate(batch) if job['calib'] is not None]
+        if registered:
+            calib = torch.stack([torch.as_tensor(batch[i]['calib']) for i in registered]).to(self.device)
+            verts_cam, _ = batch_registration(verts[registered], joint_img[registered], self.j_reg, calib, size)
+            verts_cam = dict(zip(registered, verts_cam.cpu().numpy()))
+        verts, joint_img = verts.cpu().numpy(), joint_img.cpu().numpy()
+        for i, job in enumerate(batch):
+            job['out'] = {'verts': verts[i].tolist(), 'joint_img': joint_img[i].tolist()}
+            if job['calib'] is not None:
+                job['out']['verts_cam'] = verts_cam[i].tolist()
+
+    def get_metrics(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+            latency = np.array(self.latency)
+        metrics['mean_batch'] = metrics['requests'] / max(metrics['batches'], 1)
+        if self.text_cache is not None:
+            metrics['text_cache_hits'], metrics['text_cache_misses'] = self.text_cache.hits, self.text_cache.misses
+        if latency.size:
+            metrics['p50_ms'], metrics['p99_ms'] = (np.percentile(latency, [50, 99]) * 1000).tolist()
+        return metrics
+
+
+def make_handler(batcher):
+    class Handler(BaseHTTPRequestHandler):
+        """POST /predict with {"img": base64 jpg/png, "calib": 4x4 (optional), "textembed": 5x768 (optional), "id": str (optional)},
+        GET /health and GET /metrics
+        """
+        def reply(self, code, obj):
+            body = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.reply(200, {'status': 'ok' if batcher.thread.is_alive() else 'down'})
+            elif self.path == '/metrics':
+                self.reply(200, batcher.get_metrics())
+            else:
+                self.reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.reply(404, {'error': 'not found'})
+                return
+            try:
+                req = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                img = cv2.imdecode(np.frombuffer(base64.b64decode(req['img']), np.uint8), cv2.IMREAD_COLOR)[..., ::-1]
+                calib = np.array(req['calib'], dtype=np.float32) if 'calib' in req else None
+                textembed = np.array(req['textembed'], dtype=np.float32) if 'textembed' in req else None
+                sample_id = str(req['id']) if 'id' in req else None
+            except Exception as e:
+                self.reply(400, {'error': str(e)})
+                return
+            try:
+                self.reply(200, batcher(img, calib, textembed, sample_id))
+            except Exception as e:
+                self.reply(500, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def load_test(url, img, calib, clients, num):
+    """Closed-loop load generator, every client sends num requests one after another
+
+    Returns:
+        float: throughput in requests/s
+        array: per-request latency in seconds
+    """
+    body = json.dumps({'img': base64.b64encode(cv2.imencode('.jpg', img[..., ::-1])[1]).decode(), 'calib': calib.tolist()}).encode()
+    latency = []
+    lock = threading.Lock()
+
+    def client():
+        for _ in range(num):
+            t = time.time()
+            req = urlrequest.Request(url + '/predict', data=body, headers={'Content-Type': 'application/json'})
+            urlrequest.urlopen(req).read()
+            with lock:
+                latency.append(time.time() - t)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    t = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return clients * num / (time.time() - t), np.array(latency)
+
+
+if __name__ == '__main__':
+    args = CFGOptions().parse()
+    cfg = get_cfg()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+
+    device = torch.device('cpu') if -1 in cfg.TRAIN.GPU_ID or not torch.cuda.is_available() else torch.device('cuda', cfg.TRAIN.GPU_ID[0])
+    exec('from mobrecon.models.{} import {}'.format(cfg.MODEL.NAME.lower(), cfg.MODEL.NAME))
+    model = build_model(cfg).to(device)
+    if cfg.MODEL.RESUME:
+        checkpoint = torch.load(cfg.MODEL.RESUME, map_location=device)
+        model.load_state_dict(checkpoint['model_state_dict'])
+    j_reg = np.load(os.path.join(cfg.MODEL.MANO_PATH, 'j_reg.npy'))
+    server = ThreadingHTTPServer((cfg.SERVE.HOST, cfg.SERVE.PORT), make_handler(MicroBatcher(cfg, model, j_reg, device)))
+    print('serving on {}:{}'.format(cfg.SERVE.HOST, cfg.SERVE.PORT))
+
+    if cfg.SERVE.BENCH:
+        # latency against throughput for an increasing number of concurrent clients
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        img = np.random.randint(0, 255, [cfg.DATA.SIZE, cfg.DATA.SIZE, 3], dtype=np.uint8)
+        calib = np.eye(4)
+        calib[0, 0] = calib[1, 1] = 500 * cfg.DATA.SIZE / 224
+        calib[:2, 2] = cfg.DATA.SIZE / 2
+        for clients in [1, 2, 4, 8, 16, 32]:
+            throughput, latency = load_test('http://{}:{}'.format(cfg.SERVE.HOST, cfg.SERVE.PORT), img, calib, clients, 20)
+            print('clients: {:2d}, {:7.1f} req/s, p50: {:6.1f}ms, p99: {:6.1f}ms'.format(
+                clients, throughput, *(np.percentile(latency, [50, 99]) * 1000)))
+        server.shutdown()
+    else:
+        server.serve_forever()
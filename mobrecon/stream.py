@@ -0,0 +1,250 @@
+"""
+ * @file stream.py
+ * @brief real-time video inference: source -> crop -> forward -> registration -> sink,
+ *        every stage runs in its own thread and they are linked by bounded queues
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import glob
+import queue
+import threading
+import time
+import cv2
+import numpy as np
+import torch
+from mobrecon.build import build_model
+from mobrecon.configs.config import get_cfg
+from mobrecon.tools.kinematics import MPIIHandJoints, mano_to_mpii
+from mobrecon.tools.registration import RegistrationTracker
+from mobrecon.tools.vis import perspective_np
+from options.cfg_options import CFGOptions
+import vctoolkit as vc
+
+
+class Stage(threading.Thread):
+    """A pipeline stage, applies func to every item of in_q and puts the result to out_q.
+    None is the end-of-stream marker and is forwarded downstream.
+
+    Args:
+        name (str): stage name for the report
+        func (callable): item -> item, or None to skip the item
+        in_q (Queue): input queue
+        out_q (Queue): output queue, None for a sink
+        drop (bool, optional): drop the oldest item of a full out_q instead of blocking. Defaults to False.
+    """
+    def __init__(self, name, func, in_q, out_q, drop=False):
+        super(Stage, self).__init__(name=name, daemon=True)
+        self.func = func
+        self.in_q = in_q
+        self.out_q = out_q
+        self.drop = drop
+        self.durations = []
+        self.dropped = 0
+
+    def run(self):
+        while True:
+            item = self.in_q.get()
+            if item is None:
+                break
+            t = time.time()
+            item = self.func(item)
+            self.durations.append(time.time() - t)
+            if item is not None:
+                self.put(item)
+        if self.out_q is not None:
+            self.out_q.put(None)
+
+    def put(self, item):
+        if self.out_q is None:
+            return
+        while self.drop:
+            try:
+                self.out_q.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.out_q.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+        self.out_q.put(item)
+
+
+class StreamPipeline(object):
+    """Streaming MobRecon inference on CPU. The hand is cropped with the bbox of the previous frame, so that no
+    detector is needed once the hand is found; without a previous bbox the center square of the frame is used.
+
+    Args:
+        cfg : config file
+        model (nn.Module): MobRecon model or OnnxBackend
+        j_reg (array): vertex -> joint
+        finger_embeddings (tensor, optional): [5x768] finger text embeddings of the stream, read from cfg.STREAM.TEXT
+            if not given. Defaults to None.
+    """
+    def __init__(self, cfg, model, j_reg, finger_embeddings=None):
+        self.cfg = cfg
+        self.model = model.eval()
+        if finger_embeddings is None and cfg.STREAM.TEXT:
+            finger_embeddings = torch.from_numpy(np.load(cfg.STREAM.TEXT))
+        if finger_embeddings is None:
+            print('No finger embeddings for the stream (cfg.STREAM.TEXT), text-conditioned models get zeros')
+            finger_embeddings = torch.zeros(5, 768)
+        self.finger_embeddings = finger_embeddings.float()[None]
+        # the text is fixed for the stream, eager models encode it once
+        self.text_tokens = None
+        if hasattr(self.model, 'encode_text'):
+            with torch.no_grad():
+                self.text_tokens = self.model.encode_text(self.finger_embeddings)
+        self.size = cfg.DATA.SIZE
+        self.j_reg = j_reg
+        self.tracker = RegistrationTracker(j_reg, None, self.size)
+        self.bbox = None
+        self.K = None
+        self.results = []
+        self.writer = None
+        self.num_frames = 0
+
+    def frames(self):
+        """Frames of a video file or of an image folder, in RGB"""
+        source = self.cfg.STREAM.SOURCE
+        if os.path.isdir(source):
+            for path in sorted(glob.glob(os.path.join(source, '*.jpg')) + glob.glob(os.path.join(source, '*.png'))):
+                yield cv2.imread(path)[..., ::-1]
+        else:
+            cap = cv2.VideoCapture(source)
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                yield frame[..., ::-1]
+            cap.release()
+
+    def source(self, out_q, stage):
+        frames, i = self.frames(), 0
+        while True:
+            t = time.time()
+            frame = next(frames, None)
+            if frame is None:
+                break
+            stage.durations.append(time.time() - t)
+            if self.cfg.STREAM.OUTPUT and self.writer is None:
+                # sized from the first frame of the stream itself, no second reader is opened
+                self.writer = cv2.VideoWriter(self.cfg.STREAM.OUTPUT, cv2.VideoWriter_fourcc(*'mp4v'), 30, (frame.shape[1], frame.shape[0]))
+            if self.K is None:
+                focal = self.cfg.STREAM.FOCAL if self.cfg.STREAM.FOCAL > 0 else max(frame.shape[:2])
+                self.K = np.array([[focal, 0, frame.shape[1] / 2], [0, focal, frame.shape[0] / 2], [0, 0, 1]])
+            stage.put({'id': i, 't_src': time.time(), 'frame': frame})
+            i += 1
+        self.num_frames = i
+        out_q.put(None)
+
+    def crop(self, item):
+        frame = item['frame']
+        if self.bbox is None:
+            side = min(frame.shape[:2])
+            bbox = [(frame.shape[1] - side) / 2, (frame.shape[0] - side) / 2, side]
+        else:
+            bbox = self.bbox
+        # square bbox [x0, y0, side] -> crop and its intrinsics
+        scale = self.size / bbox[2]
+        mapping = np.array([[scale, 0, -scale * bbox[0]], [0, scale, -scale * bbox[1]]], dtype=np.float32)
+        roi = cv2.warpAffine(frame, mapping, (self.size, self.size), borderMode=cv2.BORDER_CONSTANT)
+        calib = np.eye(4)
+        calib[:2, :3] = np.matmul(mapping, self.K)
+        img = (roi.astype(np.float32) / 255 - self.cfg.DATA.IMG_MEAN) / self.cfg.DATA.IMG_STD
+        item.update({'img': torch.from_numpy(img.transpose(2, 0, 1)), 'calib': calib, 'bbox': bbox})
+        return item
+
+    def forward(self, item):
+        with torch.no_grad():
+            if self.text_tokens is not None:
+                out = self.model(item['img'][None], text_tokens=self.text_tokens)
+            else:
+                out = self.model(item['img'][None], finger_embeddings=self.finger_embeddings)
+        item['verts'] = out['verts'][0].numpy() * 0.2
+        item['joint_img'] = out['joint_img'][0].numpy() * self.size
+        return item
+
+    def register(self, item):
+        verts, success = self.tracker(item['verts'], item['joint_img'], calib=item['calib'])
+        item['verts'], item['success'] = verts, success
+        if success:
+            # bbox of the next crop from the registered joints in the full frame
+            joint_cam = mano_to_mpii(np.matmul(self.j_reg, verts))
+            uv = perspective_np(joint_cam.copy(), np.concatenate([np.concatenate([self.K, np.zeros([3, 1])], 1), [[0, 0, 0, 1]]]))[:, :2]
+            center = (uv.min(0) + uv.max(0)) / 2
+            side = (uv.max(0) - uv.min(0)).max() * self.cfg.STREAM.BASE_SCALE
+            self.bbox = [center[0] - side / 2, center[1] - side / 2, side]
+            item['uv'] = uv
+        else:
+            self.bbox = None
+        return item
+
+    def sink(self):
+        def func(item):
+            item['t_sink'] = time.time()
+            if self.writer is not None:
+                frame = np.ascontiguousarray(item['frame'])
+                if item['success']:
+                    frame = vc.render_bones_from_uv(np.flip(item['uv'], axis=-1).copy(), frame.copy(), MPIIHandJoints, thickness=2)
+                self.writer.write(frame[..., ::-1])
+            self.results.append({k: item[k] for k in ['id', 't_src', 't_sink', 'verts', 'success']})
+        return func
+
+    def run(self):
+        qsize = self.cfg.STREAM.QUEUE_SIZE
+        drop = self.cfg.STREAM.DROP
+        qs = [queue.Queue(qsize) for _ in range(4)]
+        self.writer = None
+        self.num_frames = 0
+        stages = [Stage('crop', self.crop, qs[0], qs[1], drop),
+                  Stage('forward', self.forward, qs[1], qs[2], drop),
+                  Stage('registration', self.register, qs[2], qs[3], drop),
+                  Stage('sink', self.sink(), qs[3], None)]
+        src = Stage('source', None, None, qs[0], drop)
+        t = time.time()
+        for stage in stages:
+            stage.start()
+        self.source(qs[0], src)
+        for stage in stages:
+            stage.join()
+        duration = time.time() - t
+        if self.writer is not None:
+            self.writer.release()
+
+        # report
+        num = len(self.results)
+        latency = [r['t_sink'] - r['t_src'] for r in self.results]
+        print('frames: {}, processed: {}, FPS: {:.1f}, end-to-end latency: {:.1f}ms'.format(
+            self.num_frames, num, num / duration, np.mean(latency) * 1000 if num else 0))
+        for stage in [src] + stages:
+            print('{:>12s}: {:6.1f}ms/frame, dropped {}'.format(
+                stage.name, np.mean(stage.durations) * 1000 if stage.durations else 0, stage.dropped))
+        return self.results
+
+
+if __name__ == '__main__':
+    args = CFGOptions().parse()
+    cfg = get_cfg()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    torch.set_num_threads(cfg.STREAM.THREADS)
+
+    exec('from mobrecon.models.{} import {}'.format(cfg.MODEL.NAME.lower(), cfg.MODEL.NAME))
+    model = build_model(cfg)
+    if cfg.MODEL.RESUME:
+        checkpoint = torch.load(cfg.MODEL.RESUME, map_location='cpu')
+        model.load_state_dict(checkpoint['model_state_dict'])
+    if cfg.TEST.BACKEND == 'onnx':
+        from mobrecon.tools.export import export_onnx
+        from mobrecon.tools.onnx_backend import OnnxBackend
+        path = cfg.TEST.ONNX_PATH
+        if not path:
+            path = 'mobrecon.onnx'
+            export_onnx(model, cfg.DATA.SIZE, path)
+        model = OnnxBackend(path, cfg.TEST.ONNX_THREADS or cfg.STREAM.THREADS)
+    j_reg = np.load(os.path.join(cfg.MODEL.MANO_PATH, 'j_reg.npy'))
+    StreamPipeline(cfg, model, j_reg).run()
@@ -0,0 +1,183 @@
+"""
+ * @file export.py
+ * @brief export a MobRecon model to a TorchScript, torch.export or ONNX graph for single-view inference
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import copy
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from conv.spiralconv import SpiralConv
+from conv.dsconv import DSConv
+
+
+# minimum torch versions of the export paths
+ONNX_MIN_TORCH = (1, 13)  # opset 16 GridSample and ScatterElements add reduction
+EXPORT_MIN_TORCH = (2, 1)  # torch.export
+
+
+def require_torch(version, feature):
+    """Fail early with a clear message instead of a deep exporter error on an older torch"""
+    current = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2])
+    if current < version:
+        raise RuntimeError('{} needs torch >= {}, found {}'.format(feature, '.'.join(map(str, version)), torch.__version__))
+
+
+def bake_topology(model):
+    """Register the spiral indices held as plain attributes as buffers, so that they are part of the exported graph.
+    SpiralConv, DSConv and Reg2DDecode3D register their topology as buffers themselves, this only covers modules
+    unpickled from older versions.
+
+    Args:
+        model (nn.Module): MobRecon model, modified in place
+
+    Returns:
+        nn.Module: model
+    """
+    for m in model.modules():
+        if isinstance(m, (SpiralConv, DSConv)) and 'indices' not in m._buffers:
+            indices = m.indices
+            del m.indices
+            m.register_buffer('indices', indices)
+    return model
+
+
+class SingleView(nn.Module):
+    """Single-view inference graph with tensor outputs
+
+    Args:
+        model (nn.Module): MobRecon model
+    """
+    def __init__(self, model):
+        super(SingleView, self).__init__()
+        self.model = model
+
+    def forward(self, x, finger_embeddings):
+        out = self.model(x, finger_embeddings=finger_embeddings)
+        return out['verts'], out['joint_img']
+
+
+def export(model, size, mode='trace'):
+    """Export a model for single-view inference on CPU
+
+    Args:
+        model (nn.Module): MobRecon model, left untouched
+        size (int): input image size
+        mode (str, optional): 'trace' for TorchScript, 'export' for torch.export. Defaults to 'trace'.
+
+    Returns:
+        exported graph, example inputs
+    """
+    if mode == 'export':
+        require_torch(EXPORT_MIN_TORCH, 'EXPORT.MODE=export (torch.export)')
+    model = bake_topology(copy.deepcopy(model).cpu().eval())
+    wrapper = SingleView(model).eval()
+    inputs = (torch.randn(1, 3, size, size), torch.randn(1, 5, 768))
+    with torch.no_grad():
+        if mode == 'trace':
+            graph = torch.jit.trace(wrapper, inputs)
+        elif mode == 'export':
+            graph = torch.export.export(wrapper, inputs)
+        else:
+            raise Exception('Unknown export mode ' + mode)
+    return graph, inputs
+
+
+def export_onnx(model, size, path, opset=16):
+    """Export a model to ONNX with a dynamic batch axis. Opset 16 is the first one with GridSample
+    (Reg2DDecode3D.index) and ScatterElements with add reduction (Pool).
+
+    Args:
+        model (nn.Module): MobRecon model, left untouched
+        size (int): input image size
+        path (str): .onnx file
+        opset (int, optional): Defaults to 16.
+    """
+    require_torch(ONNX_MIN_TORCH, 'ONNX export (opset {})'.format(opset))
+    model = bake_topology(copy.deepcopy(model).cpu().eval())
+    wrapper = SingleView(model).eval()
+    inputs = (torch.randn(1, 3, size, size), torch.randn(1, 5, 768))
+    with torch.no_grad():
+        torch.onnx.export(wrapper, inputs, path, opset_version=opset,
+                          input_names=['img', 'finger_embeddings'], output_names=['verts', 'joint_img'],
+                          dynamic_axes={'img': {0: 'batch'}, 'finger_embeddings': {0: 'batch'}, 'verts': {0: 'batch'}, 'joint_img': {0: 'batch'}})
+
+
+def save(graph, path):
+    if isinstance(graph, torch.jit.ScriptModule):
+        torch.jit.save(graph, path)
+    else:
+        torch.export.save(graph, path)
+
+
+def benchmark(func, inputs, runs=50, warmup=5):
+    """Median CPU latency in ms"""
+    with torch.no_grad():
+        for _ in range(warmup):
+            func(*inputs)
+        durations = []
+        for _ in range(runs):
+            t = time.time()
+            func(*inputs)
+            durations.append(time.time() - t)
+    return np.median(durations) * 1000
+
+
+if __name__ == '__main__':
+    from mobrecon.build import build_model
+    from mobrecon.configs.config import get_cfg
+    from options.cfg_options import CFGOptions
+
+    args = CFGOptions().parse()
+    cfg = get_cfg()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+
+    exec('from mobrecon.models.{} import {}'.format(cfg.MODEL.NAME.lower(), cfg.MODEL.NAME))
+    model = build_model(cfg).eval()
+    if cfg.MODEL.RESUME:
+        checkpoint = torch.load(cfg.MODEL.RESUME, map_location='cpu')
+        model.load_state_dict(checkpoint['model_state_dict'])
+
+    if cfg.EXPORT.MODE == 'onnx':
+        from mobrecon.tools.onnx_backend import OnnxBackend
+        path = cfg.EXPORT.PATH or 'mobrecon.onnx'
+        export_onnx(model, cfg.DATA.SIZE, path)
+        backend = OnnxBackend(path)
+        run = lambda x, emb: tuple(backend(x, emb).values())
+        inputs = (torch.randn(1, 3, cfg.DATA.SIZE, cfg.DATA.SIZE), torch.randn(1, 5, 768))
+    else:
+        graph, inputs = export(model, cfg.DATA.SIZE, cfg.EXPORT.MODE)
+        run = graph if cfg.EXPORT.MODE == 'trace' else graph.module()
+
+    # parity with eager mode, on a batch size different from the traced one
+    x, emb = torch.randn(4, 3, cfg.DATA.SIZE, cfg.DATA.SIZE), torch.randn(4, 5, 768)
+    with torch.no_grad():
+        out = model(x, finger_embeddings=emb)
+        verts, joint_img = run(x, emb)
+    print('max diff verts: {:.2e}, joint_img: {:.2e}'.format((out['verts'] - verts).abs().max().item(), (out['joint_img'] - joint_img).abs().max().item()))
+    assert torch.allclose(out['verts'], verts, atol=1e-4) and torch.allclose(out['joint_img'], joint_img, atol=1e-4)
+
+    # CPU latency
+    eager = lambda x, emb: model(x, finger_embeddings=emb)
+    if cfg.EXPORT.MODE == 'onnx':
+        # latency at batch 1 and throughput at batch 8 across thread counts
+        batch = (torch.randn(8, 3, cfg.DATA.SIZE, cfg.DATA.SIZE), torch.randn(8, 5, 768))
+        for threads in [1, 2, 4, 8]:
+            torch.set_num_threads(threads)
+            backend = OnnxBackend(path, threads)
+            run = lambda x, emb: backend(x, emb)
+            print('threads: {}, eager: {:.2f}ms {:.1f} img/s, onnxruntime: {:.2f}ms {:.1f} img/s'.format(
+                threads, benchmark(eager, inputs), 8000 / benchmark(eager, batch), benchmark(run, inputs), 8000 / benchmark(run, batch)))
+    else:
+        torch.set_num_threads(cfg.STREAM.THREADS)
+        print('eager: {:.2f}ms, {}: {:.2f}ms'.format(benchmark(eager, inputs), cfg.EXPORT.MODE, benchmark(run, inputs)))
+
+        if cfg.EXPORT.PATH:
+            save(graph, cfg.EXPORT.PATH)
+            print('saved to', cfg.EXPORT.PATH)
@@ -74,6 +74,10 @@ class MPIIHandJoints:
   ]
 
 
+# index of each MPIIHandJoints joint in MANOHandJoints order, i.e., mano_to_mpii(x) == x[MANO_TO_MPII]
+MANO_TO_MPII = [MANOHandJoints.labels.index(label) for label in MPIIHandJoints.labels]
+
+
 def mpii_to_mano(mpii):
   """
   Map data from MPIIHandJoints order to MANOHandJoints order.
@@ -0,0 +1,38 @@
+"""
+ * @file onnx_backend.py
+ * @brief ONNX Runtime execution backend with the call convention of MobRecon models
+"""
+
+import torch
+
+
+class OnnxBackend(object):
+    """Run an ONNX graph exported by mobrecon.tools.export.export_onnx on CPU
+
+    Args:
+        path (str): .onnx file
+        threads (int, optional): intra-op threads, 0 lets onnxruntime decide. Defaults to 0.
+    """
+    def __init__(self, path, threads=0):
+        import onnxruntime as ort
+        if tuple(int(v) for v in ort.__version__.split('.')[:2]) < (1, 11):
+            raise RuntimeError('The exported opset 16 graph needs onnxruntime >= 1.11, found {}'.format(ort.__version__))
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.embed_shape = {i.name: i.shape for i in self.session.get_inputs()}['finger_embeddings'][1:]
+
+    def __call__(self, x, finger_embeddings=None, text_tokens=None):
+        if text_tokens is not None:
+            raise Exception('The ONNX graph takes finger embeddings, precomputed text tokens are not supported')
+        if finger_embeddings is None:
+            # datasets without text (e.g. Ge)
+            finger_embeddings = torch.zeros(x.size(0), *self.embed_shape)
+        verts, joint_img = self.session.run(['verts', 'joint_img'], {'img': x.detach().cpu().numpy(),
+                                                                     'finger_embeddings': finger_embeddings.detach().float().cpu().numpy()})
+        return {'verts': torch.from_numpy(verts).to(x.device),
+                'joint_img': torch.from_numpy(joint_img).to(x.device)}
+
+    def eval(self):
+        return self
@@ -0,0 +1,117 @@
+"""
+ * @file quantize.py
+ * @brief post-training static int8 quantization of the DenseStack backbone (FX graph mode), the spiral decoder stays in float
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import copy
+import inspect
+import torch
+from torch.ao.quantization import get_default_qconfig
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+
+def quantize_backbone(model, loader, num=256, backend='fbgemm'):
+    """Quantize model.backbone to int8 with activation ranges calibrated on the first num samples of loader.
+    FX tracing turns the backbone into a graph, so that the Reorg view/permute, the torch.cat dense connections,
+    the residual adds and the SE products are quantized without QuantStub/FloatFunctional rewrites: shape ops
+    run on int8 tensors and the cat inputs share the output observer.
+
+    Args:
+        model (nn.Module): MobRecon model, left untouched
+        loader (DataLoader): calibration data, samples as returned by the registered datasets
+        num (int, optional): calibration samples. Defaults to 256.
+        backend (str, optional): 'fbgemm' for x86, 'qnnpack' for ARM. Defaults to 'fbgemm'.
+
+    Returns:
+        nn.Module: CPU model with a quantized backbone
+    """
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+
+    # backbone inputs of one batch as example inputs for tracing
+    example_inputs = []
+    handle = model.backbone.register_forward_pre_hook(lambda m, inputs: example_inputs.append(inputs))
+    calib = iter(loader)
+    data = next(calib)
+    with torch.no_grad():
+        model(data['img'], finger_embeddings=data.get('textembed'))
+    handle.remove()
+
+    qconfig = {'': get_default_qconfig(backend)}
+    if 'example_inputs' in inspect.signature(prepare_fx).parameters:
+        model.backbone = prepare_fx(model.backbone, qconfig, example_inputs=example_inputs[0])
+    else:
+        # torch < 1.13 takes no example inputs, its third argument is prepare_custom_config_dict
+        model.backbone = prepare_fx(model.backbone, qconfig)
+
+    seen = 0
+    with torch.no_grad():
+        while seen < num:
+            model(data['img'], finger_embeddings=data.get('textembed'))
+            seen += data['img'].size(0)
+            data = next(calib, None)
+            if data is None:
+                break
+    model.backbone = convert_fx(model.backbone)
+    return model
+
+
+if __name__ == '__main__':
+    from torch.utils.data import DataLoader
+    from mobrecon.build import build_model, DATA_REGISTRY, build_dataset
+    from mobrecon.configs.config import get_cfg
+    from mobrecon.runner import Runner
+    from mobrecon.tools.export import benchmark
+    from options.cfg_options import CFGOptions
+    from utils.writer import Writer
+
+    args = CFGOptions().parse()
+    cfg = get_cfg()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    torch.set_num_threads(cfg.STREAM.THREADS)
+
+    exec('from mobrecon.models.{} import {}'.format(cfg.MODEL.NAME.lower(), cfg.MODEL.NAME))
+    exec('from mobrecon.datasets.{} import {}'.format(cfg.QUANT.DATASET.lower(), cfg.QUANT.DATASET))
+    exec('from mobrecon.datasets.{} import {}'.format(cfg.VAL.DATASET.lower(), cfg.VAL.DATASET))
+    model = build_model(cfg).eval()
+    if cfg.MODEL.RESUME:
+        checkpoint = torch.load(cfg.MODEL.RESUME, map_location='cpu')
+        model.load_state_dict(checkpoint['model_state_dict'])
+
+    calib_loader = DataLoader(DATA_REGISTRY.get(cfg.QUANT.DATASET)(cfg, cfg.QUANT.PHASE), batch_size=cfg.VAL.BATCH_SIZE, shuffle=True, num_workers=4)
+    qmodel = quantize_backbone(model, calib_loader, cfg.QUANT.NUM, cfg.QUANT.BACKEND)
+    if cfg.QUANT.PATH:
+        torch.save(qmodel, cfg.QUANT.PATH)
+
+    # accuracy delta on the validation set
+    args.out_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'out', cfg.VAL.DATASET, args.exp_name)
+    os.makedirs(args.out_dir, exist_ok=True)
+    args.world_size = 1
+    writer = Writer(args)
+    val_loader = DataLoader(build_dataset(cfg, 'val', writer=writer), batch_size=cfg.VAL.BATCH_SIZE, shuffle=False, num_workers=4)
+    eval_cfg = cfg.clone()
+    eval_cfg.defrost()
+    eval_cfg.PHASE = 'eval'
+    metrics = {}
+    for name, m in [('fp32', model), ('int8', qmodel)]:
+        runner = Runner(eval_cfg, args, m, None, val_loader, None, None, writer, torch.device('cpu'), None)
+        runner.eval()
+        metrics[name] = runner.metrics
+    for key in ['pampjpe', 'mpjpe', 'auc_pa', 'auc_rel', 'auc_2d']:
+        print('{:>8s}: fp32 {:.4f}, int8 {:.4f}, delta {:+.4f}'.format(key, metrics['fp32'][key], metrics['int8'][key], metrics['int8'][key] - metrics['fp32'][key]))
+
+    # CPU latency of the backbone and of the whole model
+    inputs = (torch.randn(1, 3, cfg.DATA.SIZE, cfg.DATA.SIZE), torch.randn(1, 5, 768))
+    backbone_inputs = []
+    handle = model.backbone.register_forward_pre_hook(lambda m, x: backbone_inputs.append(x))
+    with torch.no_grad():
+        model(*inputs)
+    handle.remove()
+    for name, m in [('fp32', model), ('int8', qmodel)]:
+        print('{}: backbone {:.2f}ms, model {:.2f}ms'.format(name, benchmark(m.backbone, backbone_inputs[0]),
+                                                            benchmark(lambda x, emb: m(x, finger_embeddings=emb), inputs)))
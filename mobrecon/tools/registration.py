@@ -12,11 +12,15 @@
 """
 
 import numpy as np
-from mobrecon.tools.kinematics import mano_to_mpii
+import torch
+from mobrecon.tools.kinematics import mano_to_mpii, MANO_TO_MPII
 from mobrecon.tools.vis import perspective_np
 from scipy.optimize import minimize
 
 
+REGISTRATION_BOUNDS = ((None, None), (None, None), (0.05, 2))
+
+
 def registration(vertex, uv, j_regressor, calib, size, uv_conf=None, poly=None):
     """Adaptive 2D-1D registration
 
@@ -33,63 +37,351 @@ def registration(vertex, uv, j_regressor, calib, size, uv_conf=None, poly=None):
         array: camera-space vertex
     """
     t = np.array([0, 0, 0.6])
-    bounds = ((None, None), (None, None), (0.05, 2))
-    poly_protect = [0.06, 0.02]
-
     vertex2xyz = mano_to_mpii(np.matmul(j_regressor, vertex))
-    try_poly = True
+    t, success, _, _ = register_uv(t, uv, vertex2xyz, calib, uv_conf)
+    if poly is not None:
+        t, _ = register_poly(t, np.array([0, 0, 0.6]), poly, vertex, calib, size)
+
+    return vertex + t, success
+
+
+def register_uv(t, uv, vertex2xyz, calib, uv_conf=None, attempt=5):
+    """2D registration with outlier rejection rounds, starting from t
+
+    Args:
+        t (array): initial translation
+        uv (array): 2D landmarks
+        vertex2xyz (array): 3D joints in hand frame
+        calib (array): intrinsic camera parameters
+        uv_conf (array, optional): confidence of 2D landmarks. Defaults to None.
+        attempt (int, optional): max number of rejection rounds. Defaults to 5.
+
+    Returns:
+        array: translation
+        bool: success
+        float: mean reprojection residual of the selected landmarks
+        list: SLSQP iterations of each round
+    """
     if uv_conf is None:
         uv_conf = np.ones([uv.shape[0], 1])
     uv_select = uv_conf > 0.1
+    nit = []
     if uv_select.sum() == 0:
-        success = False
-    else:
-        loss = np.array([5, ])
-        attempt = 5
-        while loss.mean() > 2 and attempt:
-            attempt -= 1
-            uv = uv[uv_select.repeat(2, axis=1)].reshape(-1, 2)
-            uv_conf = uv_conf[uv_select].reshape(-1, 1)
-            vertex2xyz = vertex2xyz[uv_select.repeat(3, axis=1)].reshape(-1, 3)
-            sol = minimize(align_uv, t, method='SLSQP', bounds=bounds, args=(uv, vertex2xyz, calib))
-            t = sol.x
-            success = sol.success
-            xyz = vertex2xyz + t
-            proj = perspective_np(xyz, calib)[:, :2]
-            loss = abs((proj - uv).sum(axis=1))
-            uv_select = loss < loss.mean() + loss.std()
-            if uv_select.sum() < 13:
-                break
-            uv_select = uv_select[:, np.newaxis]
-
-    if poly is not None and try_poly:
-        poly = find_1Dproj(poly[0]) / size
-        sol = minimize(align_poly, np.array([0, 0, 0.6]), method='SLSQP', bounds=bounds, args=(poly, vertex, calib, size))
-        if sol.success:
-            t2 = sol.x
-            d = distance(t, t2)
-            if d > poly_protect[0]:
-                t = t2
-            elif d > poly_protect[1]:
-                t = t * (1 - (d - poly_protect[1]) / (poly_protect[0] - poly_protect[1])) + t2 * ((d - poly_protect[1]) / (poly_protect[0] - poly_protect[1]))
+        return t, False, np.inf, nit
+    loss = np.array([5, ])
+    while loss.mean() > 2 and attempt:
+        attempt -= 1
+        uv = uv[uv_select.repeat(2, axis=1)].reshape(-1, 2)
+        uv_conf = uv_conf[uv_select].reshape(-1, 1)
+        vertex2xyz = vertex2xyz[uv_select.repeat(3, axis=1)].reshape(-1, 3)
+        sol = minimize(align_uv, t, method='SLSQP', jac=align_uv_jac, bounds=REGISTRATION_BOUNDS, args=(uv, vertex2xyz, calib))
+        t = sol.x
+        success = sol.success
+        nit.append(sol.nit)
+        xyz = vertex2xyz + t
+        proj = perspective_np(xyz, calib)[:, :2]
+        loss = abs((proj - uv).sum(axis=1))
+        uv_select = loss < loss.mean() + loss.std()
+        if uv_select.sum() < 13:
+            break
+        uv_select = uv_select[:, np.newaxis]
 
-    return vertex + t, success
+    return t, success, loss.mean(), nit
+
+
+def register_poly(t, t0, poly, vertex, calib, size, poly_protect=(0.06, 0.02)):
+    """1D silhouette registration, blended with the 2D solution t according to their distance
+
+    Args:
+        t (array): translation from the 2D registration
+        t0 (array): initial translation of the silhouette term
+        poly (array): contours from silhouette
+        vertex (array): 3D vertex coordinates in hand frame
+        calib (array): intrinsic camera parameters
+        size (int): image shape
+        poly_protect (tuple, optional): distances between which the two solutions are blended. Defaults to (0.06, 0.02).
+
+    Returns:
+        array: translation
+        int: SLSQP iterations
+    """
+    poly = find_1Dproj(poly[0]) / size
+    sol = minimize(align_poly, t0, method='SLSQP', jac=align_poly_jac, bounds=REGISTRATION_BOUNDS, args=(poly, vertex, calib, size))
+    if sol.success:
+        t2 = sol.x
+        d = distance(t, t2)
+        if d > poly_protect[0]:
+            t = t2
+        elif d > poly_protect[1]:
+            t = t * (1 - (d - poly_protect[1]) / (poly_protect[0] - poly_protect[1])) + t2 * ((d - poly_protect[1]) / (poly_protect[0] - poly_protect[1]))
+
+    return t, sol.nit
+
+
+class RegistrationTracker(object):
+    """Registration for video streams. The translation of the previous frame warm-starts the solvers; if a single
+    solve already reaches a low residual the rejection rounds are skipped, and when the residual is too high or the
+    hand jumps, the tracking is considered lost and the full registration() is run from scratch.
+
+    Args:
+        j_regressor (array): vertex -> joint
+        calib (array): intrinsic camera parameters
+        size (int): image shape
+        residual_thresh (float, optional): residual under which rejection rounds are skipped. Defaults to 2.
+        lost_thresh (float, optional): residual above which the tracking is lost. Defaults to 10.
+        max_jump (float, optional): max translation between two frames, in meters. Defaults to 0.1.
+    """
+    def __init__(self, j_regressor, calib, size, residual_thresh=2, lost_thresh=10, max_jump=0.1):
+        self.j_regressor = j_regressor
+        self.calib = calib
+        self.size = size
+        self.residual_thresh = residual_thresh
+        self.lost_thresh = lost_thresh
+        self.max_jump = max_jump
+        self.reset()
+
+    def reset(self):
+        self.t = None
+        self.mode = None
+        self.nit = []
+
+    def __call__(self, vertex, uv, uv_conf=None, poly=None, calib=None):
+        """Register one frame
+
+        Args:
+            vertex (array): 3D vertex coordinates in hand frame
+            uv (array): 2D landmarks
+            uv_conf (array, optional): confidence of 2D landmarks. Defaults to None.
+            poly (array, optional): contours from silhouette. Defaults to None.
+            calib (array, optional): intrinsic camera parameters of this frame. Defaults to the ones of the tracker.
+
+        Returns:
+            array: camera-space vertex
+            bool: success
+        """
+        calib = self.calib if calib is None else calib
+        vertex2xyz = mano_to_mpii(np.matmul(self.j_regressor, vertex))
+        t, success, residual, self.nit = None, False, np.inf, []
+        if self.t is not None:
+            # one warm-started solve, then the rejection rounds only if it is not good enough
+            t, success, residual, self.nit = register_uv(self.t, uv, vertex2xyz, calib, uv_conf, attempt=1)
+            self.mode = 'track'
+            if success and self.residual_thresh < residual < self.lost_thresh:
+                t, success, residual, nit = register_uv(t, uv, vertex2xyz, calib, uv_conf)
+                self.nit += nit
+                self.mode = 'refine'
+        if not success or residual >= self.lost_thresh or distance(t, self.t) > self.max_jump:
+            t, success, residual, self.nit = register_uv(np.array([0, 0, 0.6]), uv, vertex2xyz, calib, uv_conf)
+            self.mode = 'full'
+        if poly is not None:
+            t, nit = register_poly(t, t if self.mode != 'full' else np.array([0, 0, 0.6]), poly, vertex, calib, self.size)
+            self.nit.append(nit)
+        self.t = t if success else None
+
+        return vertex + t, success
+
+
+def batch_registration(vertex, uv, j_regressor, calib, size, uv_conf=None, poly=None, iters=10):
+    """Batched adaptive 2D-1D registration, the torch counterpart of registration().
+    Each SLSQP solve is replaced by the closed-form linear least-squares translation followed by a few
+    Levenberg-Marquardt iterations, and the outlier rejection is done for the whole batch with joint weights.
+
+    Args:
+        vertex (tensor): [BxVx3] 3D vertex coordinates in hand frame
+        uv (tensor): [Bx21x2] 2D landmarks
+        j_regressor (array): vertex -> joint
+        calib (tensor): [Bx4x4] intrinsic camera parameters
+        size (int): image shape
+        uv_conf (tensor, optional): [Bx21x1] confidence of 2D landmarks. Defaults to None.
+        poly (list, optional): contours from silhouette for every sample, an item can be None. Defaults to None.
+        iters (int, optional): LM iterations for each solve. Defaults to 10.
+
+    Returns:
+        tensor: [BxVx3] camera-space vertex
+        tensor: [B] success of the 2D registration
+    """
+    dtype = vertex.dtype
+    vertex, uv, calib = vertex.double(), uv.double(), calib.double()
+    batch_size, device = vertex.size(0), vertex.device
+    bounds = (0.05, 2)
+    poly_protect = [0.06, 0.02]
+
+    j_regressor = torch.as_tensor(np.asarray(j_regressor)[MANO_TO_MPII], dtype=torch.float64, device=device)
+    vertex2xyz = torch.matmul(j_regressor, vertex)
+    if uv_conf is None:
+        uv_conf = torch.ones_like(uv[..., :1])
+    uv_select = uv_conf[..., 0] > 0.1
+    success = uv_select.any(1)
+    t = vertex.new_tensor([0, 0, 0.6]).repeat(batch_size, 1)
+
+    active = success.clone()
+    attempt = 5
+    while active.any() and attempt:
+        attempt -= 1
+        t_new = _solve_uv(vertex2xyz, uv, uv_select.double(), calib, bounds, iters)
+        t = torch.where(active[:, None], t_new, t)
+        proj = _project(vertex2xyz + t[:, None], calib)
+        loss = (proj - uv).sum(-1).abs()
+        # statistics over the joints selected in this round, np.std uses the population variance
+        num = uv_select.sum(1).clamp(min=1)
+        loss_mean = (loss * uv_select).sum(1) / num
+        loss_std = ((((loss - loss_mean[:, None]) ** 2) * uv_select).sum(1) / num).sqrt()
+        new_select = uv_select & (loss < (loss_mean + loss_std)[:, None])
+        keep = active & (new_select.sum(1) >= 13)
+        uv_select = torch.where(keep[:, None], new_select, uv_select)
+        active = keep & (loss_mean > 2)
+
+    if poly is not None:
+        has_poly = torch.tensor([p is not None for p in poly], device=device)
+        if has_poly.any():
+            poly = torch.stack([torch.as_tensor(find_1Dproj(p[0]) / size if p is not None else np.zeros([6, 4]), device=device) for p in poly])
+            t2 = _solve_poly(vertex, poly, calib, size, bounds, iters)
+            d = (t - t2).norm(dim=-1)
+            ratio = ((d - poly_protect[1]) / (poly_protect[0] - poly_protect[1])).clamp(0, 1)[:, None]
+            t_poly = t * (1 - ratio) + t2 * ratio
+            t = torch.where((has_poly & torch.isfinite(t2).all(-1))[:, None], t_poly, t)
+
+    return (vertex + t[:, None]).to(dtype), success
+
+
+def _project(xyz, calib):
+    """Perspective projection of [BxNx3] camera-space points with [Bx4x4] calibrations, see perspective_np"""
+    xy = xyz[..., :2] / xyz[..., 2:]
+    return torch.matmul(xy, calib[:, :2, :2].transpose(1, 2)) + (calib[:, None, :2, 2] + calib[:, None, :2, 3])
+
+
+def _project_jac(xyz, calib):
+    """Jacobian [BxNx2x3] of _project w.r.t. a translation added to xyz"""
+    z = xyz[..., 2:]
+    dxy = torch.zeros(xyz.shape[:-1] + (2, 3), dtype=xyz.dtype, device=xyz.device)
+    dxy[..., 0, 0] = 1 / z[..., 0]
+    dxy[..., 1, 1] = 1 / z[..., 0]
+    dxy[..., :, 2] = -xyz[..., :2] / z ** 2
+    return torch.matmul(calib[:, None, :2, :2], dxy)
+
+
+def _lm(residual, t, bounds, iters):
+    """Batched Levenberg-Marquardt on t [Bx3]. residual(t) returns [BxM] residuals and their [BxMx3] jacobian.
+    The depth bound is handled by projecting every step back into the box.
+    """
+    r, J = residual(t)
+    loss = (r ** 2).sum(-1)
+    damping = t.new_full((t.size(0),), 1e-3)
+    eye = torch.eye(3, dtype=t.dtype, device=t.device)
+    for _ in range(iters):
+        JtJ = torch.matmul(J.transpose(1, 2), J)
+        Jtr = torch.matmul(J.transpose(1, 2), r[..., None])[..., 0]
+        A = JtJ + damping[:, None, None] * (JtJ * eye + 1e-9 * eye)
+        step = torch.linalg.solve(A, -Jtr[..., None])[..., 0]
+        t_new = t + step
+        t_new[:, 2] = t_new[:, 2].clamp(*bounds)
+        r_new, J_new = residual(t_new)
+        loss_new = (r_new ** 2).sum(-1)
+        accept = loss_new < loss
+        t = torch.where(accept[:, None], t_new, t)
+        r = torch.where(accept[:, None], r_new, r)
+        J = torch.where(accept[:, None, None], J_new, J)
+        loss = torch.where(accept, loss_new, loss)
+        damping = torch.where(accept, damping * 0.1, damping * 10).clamp(1e-9, 1e9)
+    return t
+
+
+def _solve_uv(vertex2xyz, uv, weight, calib, bounds, iters):
+    """Batched counterpart of minimize(align_uv), with joints weighted by weight [BxN]"""
+    # closed-form init: multiplying the projection by the depth makes it linear in t
+    A, c = calib[:, None, :2, :2], calib[:, None, :2, 2] + calib[:, None, :2, 3]
+    uv_c = uv - c
+    M = torch.cat([A.expand(-1, uv.size(1), -1, -1), -uv_c[..., None]], -1)
+    rhs = uv_c * vertex2xyz[..., 2:] - torch.matmul(A, vertex2xyz[..., :2, None])[..., 0]
+    M, rhs = M.flatten(1, 2), rhs.flatten(1, 2)
+    w = weight.repeat_interleave(2, dim=1)
+    MtM = torch.matmul(M.transpose(1, 2), M * w[..., None]) + 1e-9 * torch.eye(3, dtype=M.dtype, device=M.device)
+    t = torch.linalg.solve(MtM, torch.matmul(M.transpose(1, 2), (rhs * w)[..., None]))[..., 0]
+    t[:, 2] = t[:, 2].clamp(*bounds)
+
+    sqrt_w = weight.sqrt()[..., None]
+    def residual(t):
+        xyz = vertex2xyz + t[:, None]
+        r = (_project(xyz, calib) - uv) * sqrt_w
+        J = _project_jac(xyz, calib) * sqrt_w[..., None]
+        return r.flatten(1), J.flatten(1, 2)
+
+    return _lm(residual, t, bounds, iters)
+
+
+def _solve_poly(vertex, poly, calib, size, bounds, iters):
+    """Batched counterpart of minimize(align_poly), poly is [Bx6x4] from find_1Dproj"""
+    axes = torch.as_tensor(POLY_AXES.reshape(12, 2), dtype=vertex.dtype, device=vertex.device)
+    batch_idx = torch.arange(vertex.size(0), device=vertex.device)[:, None]
+
+    def residual(t):
+        xyz = vertex + t[:, None]
+        proj = torch.matmul(_project(xyz, calib), axes.T)
+        proj_jac = torch.matmul(axes, _project_jac(xyz, calib))
+        # min/max are piecewise linear, differentiate through the extreme vertices
+        ext, idx = [], []
+        for v, i in [proj.min(1), proj.max(1)]:
+            ext.append(v)
+            idx.append(i)
+        # [Bx12x2] in (x/y axis, angle) x (min, max) -> [Bx6x4] in angle x (x min, x max, y min, y max)
+        ext = torch.stack(ext, -1).reshape(-1, 2, 6, 2).permute(0, 2, 1, 3).reshape(-1, 6, 4)
+        idx = torch.stack(idx, -1)
+        J = proj_jac[batch_idx[..., None], idx, torch.arange(12, device=vertex.device)[:, None]]
+        J = J.reshape(-1, 2, 6, 2, 3).permute(0, 2, 1, 3, 4).reshape(-1, 24, 3)
+        r = (ext / size - poly).flatten(1)
+        return r, J / size
+
+    t = vertex.new_tensor([0, 0, 0.6]).repeat(vertex.size(0), 1)
+    return _lm(residual, t, bounds, iters)
 
 
 def distance(x, y):
     return np.sqrt(((x - y)**2).sum())
 
 
-def find_1Dproj(points):
-    angles = [(0, 90), (-15, 75), (-30, 60), (-45, 45), (-60, 30), (-75, 15)]
-    axs = [(np.array([[np.cos(x/180*np.pi), np.sin(x/180*np.pi)]]), np.array([np.cos(y/180*np.pi), np.sin(y/180*np.pi)])) for x, y in angles]
-    proj = []
-    for ax in axs:
-        x = (points * ax[0]).sum(axis=1)
-        y = (points * ax[1]).sum(axis=1)
-        proj.append([x.min(), x.max(), y.min(), y.max()])
+# 1D projection axes of find_1Dproj, [2x6x2] for the x/y axis of each of the 6 angle pairs
+POLY_AXES = np.array([[[np.cos(a/180*np.pi), np.sin(a/180*np.pi)] for a in angles]
+                      for angles in zip(*[(0, 90), (-15, 75), (-30, 60), (-45, 45), (-60, 30), (-75, 15)])])
 
-    return np.array(proj)
+
+def find_1Dproj(points, return_index=False):
+    """Bounds of the points projected on 6 pairs of axes
+
+    Args:
+        points (array): [Nx2] or [BxNx2] 2D points
+        return_index (bool, optional): also return the index of the extreme points. Defaults to False.
+
+    Returns:
+        array: [6x4] or [Bx6x4] (x min, x max, y min, y max) for each pair of axes
+        array: [6x4] or [Bx6x4] index of the extreme points, only if return_index
+    """
+    proj = np.matmul(points, POLY_AXES.reshape(12, 2).T)
+    shape = proj.shape[:-2]
+    # (x/y axis, angle, min/max) -> (angle, x/y axis, min/max)
+    ext = np.stack([proj.min(-2), proj.max(-2)], -1)
+    ext = np.swapaxes(ext.reshape(shape + (2, 6, 2)), -3, -2).reshape(shape + (6, 4))
+    if return_index:
+        idx = np.stack([proj.argmin(-2), proj.argmax(-2)], -1)
+        idx = np.swapaxes(idx.reshape(shape + (2, 6, 2)), -3, -2).reshape(shape + (6, 4))
+        return ext, idx
+    return ext
+
+
+def perspective_jac_np(points, calib):
+    """Jacobian of perspective_np w.r.t. a translation added to the points
+
+    Args:
+        points (array): [Nx3] 3D points
+        calib (array): [4x4] projection matrix
+
+    Returns:
+        array: [Nx2x3] jacobian of the uv coordinates
+    """
+    z = points[:, 2:]
+    dxy = np.zeros([points.shape[0], 2, 3])
+    dxy[:, 0, 0] = dxy[:, 1, 1] = 1 / z[:, 0]
+    dxy[:, :, 2] = -points[:, :2] / z ** 2
+    return np.matmul(calib[:2, :2], dxy)
 
 
 def align_poly(t, poly, vertex, calib, size):
@@ -100,9 +392,90 @@ def align_poly(t, poly, vertex, calib, size):
     return loss.mean()
 
 
+def align_poly_jac(t, poly, vertex, calib, size):
+    """Analytic gradient of align_poly, min/max are differentiated through the extreme vertices"""
+    xyz = vertex + t
+    proj, idx = find_1Dproj(perspective_np(xyz.copy(), calib)[:, :2], return_index=True)
+    # d(axis . uv)/dt of the extreme vertex for each bound, [6x4x3]
+    axes = np.repeat(POLY_AXES.transpose(1, 0, 2), 2, axis=1)
+    proj_jac = np.einsum('akc,akcd->akd', axes, perspective_jac_np(xyz[idx.reshape(-1)], calib).reshape(6, 4, 2, 3))
+    diff = proj / size - poly
+
+    return 2 * (diff[..., None] * proj_jac).sum(axis=(0, 1)) / size / diff.size
+
+
 def align_uv(t, uv, vertex2xyz, calib):
     xyz = vertex2xyz + t
     proj = perspective_np(xyz, calib)[:, :2]
     loss = (proj - uv)**2
 
     return loss.mean()
+
+
+def align_uv_jac(t, uv, vertex2xyz, calib):
+    """Analytic gradient of align_uv"""
+    xyz = vertex2xyz + t
+    diff = perspective_np(xyz.copy(), calib)[:, :2] - uv
+
+    return 2 * (diff[..., None] * perspective_jac_np(xyz, calib)).sum(axis=(0, 1)) / diff.size
+
+if __name__ == '__main__':
+    import time
+    # regression set: random hands in front of the camera, with noisy and partially corrupted 2D landmarks
+    np.random.seed(0)
+    num, size = 64, 128
+    calib = np.eye(4)
+    calib[0, 0] = calib[1, 1] = 250
+    calib[0, 2] = calib[1, 2] = size / 2
+    j_regressor = np.eye(21)
+    vertex = np.random.randn(num, 21, 3) * 0.04
+    t_gt = np.stack([np.random.uniform(-0.05, 0.05, num), np.random.uniform(-0.05, 0.05, num), np.random.uniform(0.3, 0.8, num)], 1)
+    uv = np.stack([perspective_np(mano_to_mpii(v) + t, calib)[:, :2] for v, t in zip(vertex, t_gt)])
+    uv += np.random.randn(*uv.shape)
+    uv[::4, :3] += 20
+    poly = [perspective_np(v + t, calib)[None, :, :2] if i % 2 else None for i, (v, t) in enumerate(zip(vertex, t_gt))]
+
+    t0 = time.time()
+    res = np.stack([registration(vertex[i], uv[i], j_regressor, calib, size, poly=poly[i])[0] for i in range(num)])
+    t1 = time.time()
+    res_batch = batch_registration(torch.from_numpy(vertex), torch.from_numpy(uv), j_regressor,
+                                   torch.from_numpy(calib)[None].repeat(num, 1, 1), size, poly=poly)[0].numpy()
+    t2 = time.time()
+    diff = np.abs(res - res_batch).max(axis=(1, 2))
+    print('SLSQP: {:.1f}ms, batch: {:.1f}ms'.format((t1 - t0) * 1000, (t2 - t1) * 1000))
+    print('max translation diff: {:.2e}, median: {:.2e}'.format(diff.max(), np.median(diff)))
+    assert np.median(diff) < 1e-3
+
+    # analytic gradients vs finite differences, vectorized find_1Dproj vs the per-axis loop
+    from scipy.optimize import check_grad
+    t = np.array([0.01, -0.02, 0.5])
+    target = find_1Dproj(perspective_np(vertex[1] + t_gt[1], calib)[:, :2]) / size
+    print('align_uv grad err: {:.2e}'.format(check_grad(align_uv, align_uv_jac, t, uv[0], mano_to_mpii(vertex[0]), calib)))
+    print('align_poly grad err: {:.2e}'.format(check_grad(align_poly, align_poly_jac, t, target, vertex[1], calib, size)))
+    points = np.random.rand(100, 2)
+    ref = []
+    for x, y in [(0, 90), (-15, 75), (-30, 60), (-45, 45), (-60, 30), (-75, 15)]:
+        px = (points * [np.cos(x/180*np.pi), np.sin(x/180*np.pi)]).sum(axis=1)
+        py = (points * [np.cos(y/180*np.pi), np.sin(y/180*np.pi)]).sum(axis=1)
+        ref.append([px.min(), px.max(), py.min(), py.max()])
+    assert np.allclose(find_1Dproj(points), ref)
+    assert np.allclose(find_1Dproj(points[None].repeat(3, 0)), np.array(ref)[None])
+
+    # tracking on a continuous video: smooth hand motion, with one cut in the middle
+    frames = 200
+    t_video = np.stack([0.03 * np.sin(np.arange(frames) / 20), 0.02 * np.cos(np.arange(frames) / 30), 0.5 + 0.1 * np.sin(np.arange(frames) / 50)], 1)
+    t_video[frames // 2:] += [0.1, 0, 0.2]
+    uv_video = np.stack([perspective_np(mano_to_mpii(vertex[0]) + t, calib)[:, :2] for t in t_video]) + np.random.randn(frames, 21, 2) * 0.5
+    tracker = RegistrationTracker(j_regressor, calib, size)
+    t0 = time.time()
+    res = np.stack([registration(vertex[0], uv_video[i], j_regressor, calib, size)[0] for i in range(frames)])
+    t1 = time.time()
+    res_track, nit, modes = [], [], []
+    for i in range(frames):
+        res_track.append(tracker(vertex[0], uv_video[i])[0])
+        nit.append(sum(tracker.nit))
+        modes.append(tracker.mode)
+    t2 = time.time()
+    print('registration: {:.2f}ms/frame, tracker: {:.2f}ms/frame, {:.1f} iterations/frame, modes: {}'.format(
+        (t1 - t0) * 1000 / frames, (t2 - t1) * 1000 / frames, np.mean(nit), {m: modes.count(m) for m in set(modes)}))
+    print('max diff to registration: {:.2e}'.format(np.abs(np.stack(res_track) - res).max()))
@@ -0,0 +1,162 @@
+"""
+ * @file text_cache.py
+ * @brief precomputed text tokens: the finger embeddings of a sample are fixed at inference, so the output of
+ *        model.encode_text (TextEmbeddingEncoder and, for FiLM, txt_proj + gamma/beta) is computed once per sample
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+from collections import OrderedDict
+import threading
+import numpy as np
+import torch
+
+FINGERS = ['thumb', 'index', 'middle', 'ring', 'little']
+# FreiHAND embedding stores, one per set
+EMBED_STORES = {'train': 'training_embed_angle.npy', 'val': 'val_embed_angle.npy', 'test': 'evaluation_embed_angle.npy'}
+
+
+def finger_embedding(entry):
+    """[5x768] finger embeddings of an embedding store entry"""
+    return torch.stack([torch.as_tensor(entry['angle'][f]) for f in FINGERS], dim=0)
+
+
+def cache_path(cache_dir, store):
+    """Token file of an embedding store"""
+    return os.path.join(cache_dir, os.path.basename(store).replace('.npy', '.pt'))
+
+
+def build_text_cache(model, store, batch_size=512, device='cpu'):
+    """Run model.encode_text over a whole embedding store
+
+    Args:
+        model (nn.Module): MobRecon model with encode_text
+        store (dict): sample id -> {'angle': {finger: 768-d embedding}}
+        batch_size (int, optional): Defaults to 512.
+        device (str, optional): Defaults to 'cpu'.
+
+    Returns:
+        dict: ids (list) and tokens (tensor, NxD)
+    """
+    model = model.to(device).eval()
+    ids = sorted(store.keys())
+    tokens = []
+    with torch.no_grad():
+        for i in range(0, len(ids), batch_size):
+            emb = torch.stack([finger_embedding(store[k]) for k in ids[i:i + batch_size]]).float().to(device)
+            tokens.append(model.encode_text(emb).cpu())
+    return {'ids': ids, 'tokens': torch.cat(tokens)}
+
+
+def load_text_cache(path, cfg):
+    """Token file written by this tool, checked against the model it is used with
+
+    Args:
+        path (str): token file
+        cfg : config, the file must come from cfg.MODEL.NAME and cfg.MODEL.RESUME
+
+    Returns:
+        dict: ids (list) and tokens (tensor, NxD)
+    """
+    cache = torch.load(path)
+    if cache.get('model') != cfg.MODEL.NAME or cache.get('resume') != cfg.MODEL.RESUME:
+        raise ValueError('text tokens {} were computed by {} ({}), not by {} ({}), rebuild them with mobrecon/tools/text_cache.py'.format(
+            path, cache.get('model'), cache.get('resume'), cfg.MODEL.NAME, cfg.MODEL.RESUME))
+    return cache
+
+
+class TextTokenCache(object):
+    """Thread-safe LRU of text tokens keyed by sample id, for the serving path
+
+    Args:
+        model (nn.Module): MobRecon model with encode_text
+        capacity (int, optional): max tokens kept. Defaults to 4096.
+    """
+    def __init__(self, model, capacity=4096):
+        self.model = model
+        self.capacity = capacity
+        self.tokens = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path):
+        """Preload a token file written by this tool"""
+        cache = torch.load(path)
+        with self.lock:
+            for k, t in zip(cache['ids'][-self.capacity:], cache['tokens'][-self.capacity:]):
+                self.tokens[k] = t
+
+    def __call__(self, ids, finger_embeddings, cacheable=None):
+        """Text tokens of a batch
+
+        Args:
+            ids (list): sample ids, None for samples that are not cached
+            finger_embeddings (tensor): Bx5x768, only the rows of the misses are encoded
+            cacheable (list, optional): per sample, whether its row holds the real embeddings of its id, a miss
+                encoded from a placeholder row is not stored. Defaults to all True.
+
+        Returns:
+            tensor: BxD tokens on the device of finger_embeddings
+        """
+        out = [None] * len(ids)
+        with self.lock:
+            for i, k in enumerate(ids):
+                if k is not None and k in self.tokens:
+                    self.tokens.move_to_end(k)
+                    out[i] = self.tokens[k]
+            self.hits += sum(t is not None for t in out)
+        miss = [i for i, t in enumerate(out) if t is None]
+        if miss:
+            with torch.no_grad():
+                tokens = self.model.encode_text(finger_embeddings[miss])
+            with self.lock:
+                self.misses += len(miss)
+                for i, t in zip(miss, tokens):
+                    out[i] = t
+                    if ids[i] is not None and (cacheable is None or cacheable[i]):
+                        self.tokens[ids[i]] = t
+                        self.tokens.move_to_end(ids[i])
+                while len(self.tokens) > self.capacity:
+                    self.tokens.popitem(last=False)
+        return torch.stack([t.to(finger_embeddings.device) for t in out])
+
+
+if __name__ == '__main__':
+    import time
+    from mobrecon.build import build_model
+    from mobrecon.configs.config import get_cfg
+    from options.cfg_options import CFGOptions
+
+    args = CFGOptions().parse()
+    cfg = get_cfg()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+
+    exec('from mobrecon.models.{} import {}'.format(cfg.MODEL.NAME.lower(), cfg.MODEL.NAME))
+    model = build_model(cfg).eval()
+    if cfg.MODEL.RESUME:
+        checkpoint = torch.load(cfg.MODEL.RESUME, map_location='cpu')
+        model.load_state_dict(checkpoint['model_state_dict'])
+
+    # tokens of the val and test stores, the training ones change with the encoder
+    os.makedirs(cfg.DATA.TEXT.CACHE, exist_ok=True)
+    for phase in ['val', 'test']:
+        store_path = os.path.join(cfg.DATA.FREIHAND.ROOT, EMBED_STORES[phase])
+        if not os.path.exists(store_path):
+            continue
+        store = np.load(store_path, allow_pickle=True).tolist()
+        t = time.time()
+        cache = build_text_cache(model, store)
+        cache.update({'model': cfg.MODEL.NAME, 'resume': cfg.MODEL.RESUME})
+        torch.save(cache, cache_path(cfg.DATA.TEXT.CACHE, store_path))
+        print('{}: {} tokens of dim {} in {:.1f}s'.format(phase, len(cache['ids']), cache['tokens'].size(1), time.time() - t))
+
+        # parity: precomputed tokens against the encoder in the forward
+        x = torch.randn(4, 6, cfg.DATA.SIZE, cfg.DATA.SIZE)
+        emb = torch.stack([finger_embedding(store[k]) for k in cache['ids'][:4]]).float()
+        with torch.no_grad():
+            out, out_cached = model(x, finger_embeddings=emb), model(x, text_tokens=cache['tokens'][:4])
+        assert torch.allclose(out['verts'], out_cached['verts'], atol=1e-5)
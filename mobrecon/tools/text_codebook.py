@@ -0,0 +1,76 @@
+"""
+ * @file text_codebook.py
+ * @brief deduplicated finger embeddings: the *_embed_angle.npy stores hold one 768-d vector per finger and image,
+ *        but they come from templated angle descriptions, so a small codebook and [5] indices per sample cover them
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import numpy as np
+import torch
+from mobrecon.tools.text_cache import FINGERS, EMBED_STORES
+
+
+def build_codebook(stores):
+    """Codebook shared by several embedding stores
+
+    Args:
+        stores (dict): set name -> {sample id -> {'angle': {finger: 768-d embedding}}}
+
+    Returns:
+        dict: codebook (tensor, Kx768) and, per set, ids (list) and indices (int32 tensor, Nx5)
+    """
+    names = list(stores.keys())
+    ids = {name: sorted(stores[name].keys()) for name in names}
+    emb = np.concatenate([np.stack([np.stack([np.asarray(stores[name][k]['angle'][f], dtype=np.float32) for f in FINGERS]) for k in ids[name]])
+                          for name in names])  # [N, 5, 768]
+    codebook, inverse = np.unique(emb.reshape(-1, emb.shape[-1]), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1, len(FINGERS)).astype(np.int32)
+    out = {'codebook': torch.from_numpy(codebook), 'sets': {}}
+    start = 0
+    for name in names:
+        out['sets'][name] = {'ids': ids[name], 'indices': torch.from_numpy(inverse[start:start + len(ids[name])])}
+        start += len(ids[name])
+    return out
+
+
+def load_codebook(path):
+    """Codebook tensor of a file written by this tool, None for an empty path"""
+    if not path:
+        return None
+    return torch.load(path)['codebook']
+
+
+if __name__ == '__main__':
+    import time
+    from mobrecon.configs.config import get_cfg
+    from options.cfg_options import CFGOptions
+
+    args = CFGOptions().parse()
+    cfg = get_cfg()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+
+    stores = {}
+    for phase, name in EMBED_STORES.items():
+        path = os.path.join(cfg.DATA.FREIHAND.ROOT, name)
+        if os.path.exists(path):
+            stores[phase] = np.load(path, allow_pickle=True).tolist()
+    t = time.time()
+    out = build_codebook(stores)
+    path = cfg.DATA.TEXT.CODEBOOK or os.path.join(cfg.DATA.FREIHAND.ROOT, 'embed_angle_codebook.pt')
+    torch.save(out, path)
+
+    # exact reconstruction and storage
+    num = sum(len(s['ids']) for s in out['sets'].values())
+    for phase, store in stores.items():
+        s = out['sets'][phase]
+        for k, idx in zip(s['ids'][:100], s['indices'][:100]):
+            assert np.array_equal(out['codebook'][idx.long()].numpy(), np.stack([np.asarray(store[k]['angle'][f], dtype=np.float32) for f in FINGERS]))
+    raw = num * len(FINGERS) * out['codebook'].size(1) * 4
+    compact = out['codebook'].numel() * 4 + num * len(FINGERS) * 4
+    print('{} samples, {} unique embeddings, {:.1f}MB -> {:.2f}MB ({:.0f}x) in {:.1f}s, saved to {}'.format(
+        num, out['codebook'].size(0), raw / 2**20, compact / 2**20, raw / compact, time.time() - t, path))
+    print('per-sample loader payload: {}B -> {}B'.format(len(FINGERS) * out['codebook'].size(1) * 4, len(FINGERS) * 8))
@@ -0,0 +1,181 @@
+"""
+ * @file text_compress.py
+ * @brief offline compression of the finger embeddings: PCA to a few dims fit on the training split, optionally
+ *        product-quantized with 256 centroids per subspace. The models keep the PCA as a buffer and size fc1 to it.
+ *        The report covers memory, bandwidth, FLOPs and reconstruction error of every level in DATA.TEXT.COMPRESS_DIMS;
+ *        accuracy needs a checkpoint trained at each level and is reported only for the configured one
+ *        (DATA.TEXT.COMPRESS with MODEL.RESUME), run the tool once per trained level.
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import numpy as np
+import torch
+from scipy.cluster.vq import kmeans2
+from mobrecon.tools.text_cache import FINGERS, EMBED_STORES
+
+
+def stack_store(store):
+    """Sorted ids and [N, 5, 768] embeddings of an embedding store"""
+    ids = sorted(store.keys())
+    return ids, np.stack([np.stack([np.asarray(store[k]['angle'][f], dtype=np.float32) for f in FINGERS]) for k in ids])
+
+
+def fit_pca(emb, dim):
+    """
+    Args:
+        emb (array): Mx768 embeddings
+        dim (int): output dim
+
+    Returns:
+        array: mean, 768
+        array: components, dimx768
+        float: explained variance ratio
+    """
+    mean = emb.mean(0)
+    _, s, vt = np.linalg.svd(emb - mean, full_matrices=False)
+    var = s ** 2
+    return mean, vt[:dim], var[:dim].sum() / var.sum()
+
+
+def fit_pq(z, subspaces, iters=20, seed=0):
+    """Product quantizer of PCA codes, 256 centroids per subspace
+
+    Args:
+        z (array): Mxdim, dim divisible by subspaces
+        subspaces (int): number of subspaces
+
+    Returns:
+        array: centroids, subspaces x 256 x dim/subspaces
+    """
+    sub = z.reshape(z.shape[0], subspaces, -1)
+    k = min(256, z.shape[0])
+    return np.stack([kmeans2(sub[:, i].astype(np.float64), k, iter=iters, minit='++', seed=seed)[0] for i in range(subspaces)]).astype(np.float32)
+
+
+def pq_encode(z, centroids):
+    """[..., dim] -> [..., subspaces] uint8 codes"""
+    sub = z.reshape(-1, centroids.shape[0], centroids.shape[2])
+    codes = np.stack([((sub[:, i, None] - centroids[i][None]) ** 2).sum(-1).argmin(-1) for i in range(centroids.shape[0])], -1)
+    return codes.reshape(*z.shape[:-1], -1).astype(np.uint8)
+
+
+def pq_decode(codes, centroids):
+    """[..., subspaces] codes -> [..., dim]"""
+    codes = torch.as_tensor(codes).long()
+    centroids = torch.as_tensor(centroids)
+    out = centroids[torch.arange(centroids.size(0)), codes]  # [..., subspaces, dim/subspaces]
+    return out.reshape(*codes.shape[:-1], -1)
+
+
+def compress(stores, dim, subspaces=0):
+    """Fit on stores['train'] and encode every store
+
+    Args:
+        stores (dict): set name -> embedding store, with a 'train' one
+        dim (int): PCA dim
+        subspaces (int, optional): PQ subspaces, 0 keeps float16 PCA codes. Defaults to 0.
+
+    Returns:
+        dict: mean, components, centroids (or None), explained variance and, per set, ids and codes
+    """
+    embs = {name: stack_store(store) for name, store in stores.items()}
+    train = np.unique(embs['train'][1].reshape(-1, embs['train'][1].shape[-1]), axis=0)
+    mean, components, explained = fit_pca(train, dim)
+    centroids = fit_pq((train - mean) @ components.T, subspaces) if subspaces > 0 else None
+    out = {'mean': torch.from_numpy(mean), 'components': torch.from_numpy(components),
+           'centroids': None if centroids is None else torch.from_numpy(centroids), 'explained': float(explained), 'sets': {}}
+    for name, (ids, emb) in embs.items():
+        z = (emb - mean) @ components.T  # [N, 5, dim]
+        codes = torch.from_numpy(pq_encode(z, centroids)) if centroids is not None else torch.from_numpy(z).half()
+        out['sets'][name] = {'ids': ids, 'codes': codes}
+    return out
+
+
+def decode(codes, centroids=None):
+    """Codes of a sample, [5, dim] or [5, subspaces], to [5, dim] float PCA coordinates"""
+    if centroids is None:
+        return codes.float()
+    return pq_decode(codes, centroids)
+
+
+def load_projection(path):
+    """(mean, components) of a file written by this tool, None for an empty path"""
+    if not path:
+        return None
+    out = torch.load(path)
+    return out['mean'], out['components']
+
+
+if __name__ == '__main__':
+    import time
+    from mobrecon.configs.config import get_cfg
+    from options.cfg_options import CFGOptions
+
+    args = CFGOptions().parse()
+    cfg = get_cfg()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+
+    stores = {}
+    for phase, name in EMBED_STORES.items():
+        path = os.path.join(cfg.DATA.FREIHAND.ROOT, name)
+        if os.path.exists(path):
+            stores[phase] = np.load(path, allow_pickle=True).tolist()
+    num = sum(len(s) for s in stores.values())
+    _, val = stack_store(stores.get('val', stores['train']))
+
+    # memory, loader bandwidth, fc1 FLOPs and reconstruction error at several compression levels
+    def report(name, dim, sample_bytes, store_bytes, rel_err):
+        print('{:>12s}: store {:8.1f}MB, loader {:6d}B/sample, fc1 {:6.2f}MFLOPs, rel. reconstruction error {:.4f}'.format(
+            name, store_bytes / 2**20, sample_bytes, 2 * len(FINGERS) * dim * 512 / 1e6, rel_err))
+
+    report('raw', 768, len(FINGERS) * 768 * 4, num * len(FINGERS) * 768 * 4, 0)
+    for dim in cfg.DATA.TEXT.COMPRESS_DIMS:
+        for subspaces in [0, dim // 8, dim // 4]:
+            t = time.time()
+            out = compress({'train': stores['train']}, dim, subspaces)
+            mean, components, centroids = out['mean'].numpy(), out['components'].numpy(), out['centroids']
+            z = (val - mean) @ components.T
+            z = pq_decode(pq_encode(z, centroids.numpy()), centroids).numpy() if centroids is not None else z.astype(np.float16).astype(np.float32)
+            rel_err = np.linalg.norm(z @ components + mean - val) / np.linalg.norm(val)
+            code_bytes = len(FINGERS) * (subspaces if subspaces > 0 else dim * 2)
+            table_bytes = (mean.size + components.size + (centroids.numel() if centroids is not None else 0)) * 4
+            report('pca{}{}'.format(dim, '+pq{}'.format(subspaces) if subspaces else ''), dim, code_bytes, num * code_bytes + table_bytes, rel_err)
+
+    # the configured level for training; an existing DATA.TEXT.COMPRESS file is what MODEL.RESUME was trained
+    # against, it is reused as is and never refit or overwritten
+    if cfg.DATA.TEXT.COMPRESS and os.path.exists(cfg.DATA.TEXT.COMPRESS):
+        print('explained variance {:.4f}, using {}'.format(torch.load(cfg.DATA.TEXT.COMPRESS)['explained'], cfg.DATA.TEXT.COMPRESS))
+    else:
+        out = compress(stores, cfg.DATA.TEXT.COMPRESS_DIM, cfg.DATA.TEXT.COMPRESS_PQ)
+        path = cfg.DATA.TEXT.COMPRESS or os.path.join(cfg.DATA.FREIHAND.ROOT, 'embed_angle_pca{}{}.pt'.format(
+            cfg.DATA.TEXT.COMPRESS_DIM, '_pq{}'.format(cfg.DATA.TEXT.COMPRESS_PQ) if cfg.DATA.TEXT.COMPRESS_PQ else ''))
+        torch.save(out, path)
+        print('explained variance {:.4f}, saved to {}'.format(out['explained'], path))
+
+    # accuracy of a model trained with this compression level, the other levels need their own trained checkpoint
+    if not (cfg.MODEL.RESUME and cfg.DATA.TEXT.COMPRESS):
+        print('accuracy not reported: it needs a checkpoint trained at the configured level (MODEL.RESUME and DATA.TEXT.COMPRESS)')
+    if cfg.MODEL.RESUME and cfg.DATA.TEXT.COMPRESS:
+        from torch.utils.data import DataLoader
+        from mobrecon.build import build_model, build_dataset
+        from mobrecon.runner import Runner
+        from utils.writer import Writer
+        exec('from mobrecon.models.{} import {}'.format(cfg.MODEL.NAME.lower(), cfg.MODEL.NAME))
+        exec('from mobrecon.datasets.{} import {}'.format(cfg.VAL.DATASET.lower(), cfg.VAL.DATASET))
+        model = build_model(cfg)
+        model.load_state_dict(torch.load(cfg.MODEL.RESUME, map_location='cpu')['model_state_dict'])
+        args.out_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'out', cfg.VAL.DATASET, args.exp_name)
+        os.makedirs(args.out_dir, exist_ok=True)
+        args.world_size = 1
+        eval_cfg = cfg.clone()
+        eval_cfg.defrost()
+        eval_cfg.PHASE = 'eval'
+        writer = Writer(args)
+        val_loader = DataLoader(build_dataset(eval_cfg, 'val', writer=writer), batch_size=cfg.VAL.BATCH_SIZE, shuffle=False, num_workers=4)
+        runner = Runner(eval_cfg, args, model, None, val_loader, None, None, writer, torch.device('cpu'), None)
+        runner.eval()
+        print('pca{}: {}'.format(cfg.DATA.TEXT.COMPRESS_DIM, ', '.join('{}: {:.4f}'.format(k, v) for k, v in runner.metrics.items())))
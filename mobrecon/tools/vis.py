@@ -79,6 +79,26 @@ def compute_iou(pred, gt):
     return IoU
 
 
+def compute_iou_batch(pred, gt):
+    """Mask IoU of a batch
+
+    Args:
+        pred (tensor): [BxHxW] prediction masks
+        gt (tensor): [BxHxW] ground-truth masks
+
+    Returns:
+        tensor: [B] IoU
+    """
+    area_pred = pred.sum((1, 2))
+    area_gt = gt.sum((1, 2))
+    union_area = (pred + gt).clamp(max=1).sum((1, 2))
+    inter_area = area_pred + area_gt - union_area
+    IoU = inter_area / union_area
+    IoU[(area_pred == 0) & (area_gt == 0)] = 1
+
+    return IoU
+
+
 def cnt_area(cnt):
     """Compute area of a contour
 
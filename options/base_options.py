@@ -45,6 +45,10 @@ class BaseOptions():
         parser.add_argument('--epochs', type=int, default=38)
         parser.add_argument('--resume', type=str, default='')
 
+        # registration
+        parser.add_argument('--registration_workers', type=int, default=4)
+        parser.add_argument('--registration_queue', type=int, default=32)
+
         # others
         # parser.add_argument('--seed', type=int, default=1)
 
@@ -0,0 +1,115 @@
+"""
+Inference-time module fusion: eval-mode BatchNorm layers are folded into the preceding Conv2d/Linear and the
+activations that follow them run in place. The fused model is numerically equivalent in eval mode only.
+"""
+
+import torch
+import torch.nn as nn
+
+# attribute pairs (conv, norm) of blocks that do not chain their layers in an nn.Sequential
+# (cmr ConvBlock, torchvision-style ResNet, BasicBlock and Bottleneck)
+FUSE_PAIRS = [('conv', 'norm'), ('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')]
+
+
+def _foldable(layer, bn):
+    if isinstance(layer, nn.Conv2d):
+        return isinstance(bn, nn.BatchNorm2d) and bn.track_running_stats and bn.num_features == layer.out_channels
+    if isinstance(layer, nn.Linear):
+        # Linear->BatchNorm1d on [B, C] inputs, as in linear_layer
+        return isinstance(bn, nn.BatchNorm1d) and bn.track_running_stats and bn.num_features == layer.out_features
+    return False
+
+
+@torch.no_grad()
+def fold_bn(layer, bn):
+    """
+    Fold an eval-mode BatchNorm into the weight and bias of layer, in place
+    :param layer: nn.Conv2d or nn.Linear
+    :param bn: nn.BatchNorm2d or nn.BatchNorm1d following layer
+    """
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        scale = scale * bn.weight
+        shift = shift * bn.weight + bn.bias
+    layer.weight.mul_(scale.view(-1, *([1] * (layer.weight.dim() - 1))))
+    if layer.bias is None:
+        layer.bias = nn.Parameter(shift.clone())
+    else:
+        layer.bias.mul_(scale).add_(shift)
+
+
+def fuse_for_inference(model):
+    """
+    Fold every BatchNorm that directly follows a Conv2d/Linear, in nn.Sequential (conv_layer, linear_layer,
+    ResNet downsample) or as one of FUSE_PAIRS, and make the ReLU/Hardtanh after a fused layer in place.
+    The model is modified in place and put in eval mode, apply it to a copy of a model that is still trained.
+    :param model: nn.Module
+    :return: model
+    """
+    model.eval()
+    # a pair can be reachable from two parents (cmr models alias backbone.conv1/bn1), fold it once
+    folded = set()
+
+    def fold(layer, bn):
+        if id(bn) not in folded:
+            fold_bn(layer, bn)
+            folded.add(id(bn))
+
+    for m in list(model.modules()):
+        if isinstance(m, nn.Sequential):
+            layers = list(m)
+            for i in range(len(layers) - 1):
+                if _foldable(layers[i], layers[i + 1]):
+                    fold(layers[i], layers[i + 1])
+                    m[i + 1] = nn.Identity()
+                    # the activation input is the fresh output of the fused layer
+                    if i + 2 < len(layers) and isinstance(layers[i + 2], (nn.ReLU, nn.Hardtanh)):
+                        layers[i + 2].inplace = True
+        for conv, norm in FUSE_PAIRS:
+            if _foldable(getattr(m, conv, None), getattr(m, norm, None)):
+                fold(getattr(m, conv), getattr(m, norm))
+                setattr(m, norm, nn.Identity())
+    return model
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import copy
+    import time
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    from mobrecon.models.densestack import DenseStack_Backnone
+    from cmr.models.resnet import resnet18, resnet50
+    from cmr.models.network import ConvBlock
+
+    def randomize_bn(model):
+        for m in model.modules():
+            if isinstance(m, nn.modules.batchnorm._BatchNorm):
+                m.running_mean.uniform_(-0.5, 0.5)
+                m.running_var.uniform_(0.5, 2)
+                m.weight.data.uniform_(0.5, 1.5)
+                m.bias.data.uniform_(-0.5, 0.5)
+        return model.eval()
+
+    def latency(model, x, runs=20):
+        with torch.no_grad():
+            model(x)
+            t = time.time()
+            for _ in range(runs):
+                model(x)
+        return (time.time() - t) / runs * 1000
+
+    torch.manual_seed(0)
+    x = torch.randn(4, 3, 128, 128)
+    for name, model in [('DenseStack_Backnone', DenseStack_Backnone(pretrain=False)), ('resnet18', resnet18()), ('resnet50', resnet50()),
+                        ('ConvBlock', nn.Sequential(ConvBlock(3, 16, relu=True), ConvBlock(16, 16)))]:
+        model = randomize_bn(model)
+        fused = fuse_for_inference(copy.deepcopy(model))
+        assert not any(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in fused.modules()), name
+        with torch.no_grad():
+            out, out_fused = model(x), fused(x)
+        out, out_fused = (out, out_fused) if isinstance(out, tuple) else ((out, ), (out_fused, ))
+        diff = max((a - b).abs().max().item() / max(a.abs().max().item(), 1) for a, b in zip(out, out_fused))
+        print('{}: max rel diff {:.2e}, {:.2f}ms -> {:.2f}ms'.format(name, diff, latency(model, x), latency(fused, x)))
+        assert diff < 1e-4, name
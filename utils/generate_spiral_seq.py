@@ -1,57 +1,127 @@
-import openmesh as om
 from sklearn.neighbors import KDTree
 import numpy as np
 
 
-def _next_ring(mesh, last_ring, other):
+def _next_ring(adjacency, last_ring, other):
+    # adjacency: one-ring of every vertex in circulator order, other: set of the vertices already in the spiral
     res = []
-
-    def is_new_vertex(idx):
-        return (idx not in last_ring and idx not in other and idx not in res)
+    last = set(last_ring)
+    seen = last | other
 
     for vh1 in last_ring:
-        vh1 = om.VertexHandle(vh1)
+        neighbours = adjacency[vh1]
         after_last_ring = False
-        for vh2 in mesh.vv(vh1):
+        for vh2 in neighbours:
             if after_last_ring:
-                if is_new_vertex(vh2.idx()):
-                    res.append(vh2.idx())
-            if vh2.idx() in last_ring:
+                if vh2 not in seen:
+                    res.append(vh2)
+                    seen.add(vh2)
+            if vh2 in last:
                 after_last_ring = True
-        for vh2 in mesh.vv(vh1):
-            if vh2.idx() in last_ring:
+        for vh2 in neighbours:
+            if vh2 in last:
                 break
-            if is_new_vertex(vh2.idx()):
-                res.append(vh2.idx())
+            if vh2 not in seen:
+                res.append(vh2)
+                seen.add(vh2)
     return res
 
 
 def extract_spirals(mesh, seq_length, dilation=1):
     # output: spirals.size() = [N, seq_length]
+    adjacency = [row[row >= 0].tolist() for row in mesh.vertex_vertex_indices()]
+    length = seq_length * dilation
     spirals = []
-    for vh0 in mesh.vertices():
-        reference_one_ring = []
-        for vh1 in mesh.vv(vh0):
-            reference_one_ring.append(vh1.idx())
-        spiral = [vh0.idx()]
-        one_ring = list(reference_one_ring)
-        last_ring = one_ring
-        next_ring = _next_ring(mesh, last_ring, spiral)
+    # vertices whose rings run out before length, their spiral is the nearest vertices instead
+    fallback = []
+    for vh0 in range(len(adjacency)):
+        spiral = [vh0]
+        in_spiral = {vh0}
+        last_ring = list(adjacency[vh0])
+        next_ring = _next_ring(adjacency, last_ring, in_spiral)
         spiral.extend(last_ring)
-        while len(spiral) + len(next_ring) < seq_length * dilation:
+        in_spiral.update(last_ring)
+        while len(spiral) + len(next_ring) < length:
             if len(next_ring) == 0:
                 break
             last_ring = next_ring
-            next_ring = _next_ring(mesh, last_ring, spiral)
+            next_ring = _next_ring(adjacency, last_ring, in_spiral)
             spiral.extend(last_ring)
+            in_spiral.update(last_ring)
         if len(next_ring) > 0:
             spiral.extend(next_ring)
         else:
-            kdt = KDTree(mesh.points(), metric='euclidean')
-            spiral = kdt.query(np.expand_dims(mesh.points()[spiral[0]],
-                                              axis=0),
-                               k=seq_length * dilation,
-                               return_distance=False).tolist()
-            spiral = [item for subspiral in spiral for item in subspiral]
-        spirals.append(spiral[:seq_length * dilation][::dilation])
+            fallback.append(vh0)
+        spirals.append(spiral[:length][::dilation])
+    if fallback:
+        kdt = KDTree(mesh.points(), metric='euclidean')
+        nearest = kdt.query(mesh.points()[fallback], k=length, return_distance=False)
+        for vh0, spiral in zip(fallback, nearest.tolist()):
+            spirals[vh0] = spiral[:length][::dilation]
     return spirals
+
+
+if __name__ == '__main__':
+    import os
+    import time
+    import openmesh as om
+
+    # the former list-based traversal with a KDTree per fallback vertex, as reference
+    def next_ring_reference(mesh, last_ring, other):
+        res = []
+
+        def is_new_vertex(idx):
+            return (idx not in last_ring and idx not in other and idx not in res)
+
+        for vh1 in last_ring:
+            vh1 = om.VertexHandle(vh1)
+            after_last_ring = False
+            for vh2 in mesh.vv(vh1):
+                if after_last_ring:
+                    if is_new_vertex(vh2.idx()):
+                        res.append(vh2.idx())
+                if vh2.idx() in last_ring:
+                    after_last_ring = True
+            for vh2 in mesh.vv(vh1):
+                if vh2.idx() in last_ring:
+                    break
+                if is_new_vertex(vh2.idx()):
+                    res.append(vh2.idx())
+        return res
+
+    def extract_spirals_reference(mesh, seq_length, dilation=1):
+        spirals = []
+        for vh0 in mesh.vertices():
+            spiral = [vh0.idx()]
+            last_ring = [vh1.idx() for vh1 in mesh.vv(vh0)]
+            next_ring = next_ring_reference(mesh, last_ring, spiral)
+            spiral.extend(last_ring)
+            while len(spiral) + len(next_ring) < seq_length * dilation:
+                if len(next_ring) == 0:
+                    break
+                last_ring = next_ring
+                next_ring = next_ring_reference(mesh, last_ring, spiral)
+                spiral.extend(last_ring)
+            if len(next_ring) > 0:
+                spiral.extend(next_ring)
+            else:
+                kdt = KDTree(mesh.points(), metric='euclidean')
+                spiral = kdt.query(np.expand_dims(mesh.points()[spiral[0]], axis=0),
+                                   k=seq_length * dilation, return_distance=False).tolist()
+                spiral = [item for subspiral in spiral for item in subspiral]
+            spirals.append(spiral[:seq_length * dilation][::dilation])
+        return spirals
+
+    template_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../template')
+    for template in ['template.ply', 'template_body.ply']:
+        mesh = om.read_trimesh(os.path.join(template_dir, template))
+        for seq_length, dilation in [(9, 1), (9, 2), (27, 1)]:
+            times = []
+            outs = []
+            for func in [extract_spirals_reference, extract_spirals]:
+                t = time.time()
+                outs.append(func(mesh, seq_length, dilation))
+                times.append(time.time() - t)
+            assert outs[0] == outs[1], (template, seq_length, dilation)
+            print('{} ({} verts), seq_length {}, dilation {}: {:.2f}s -> {:.2f}s'.format(
+                template, mesh.n_vertices(), seq_length, dilation, *times))
@@ -1,14 +1,20 @@
 import torch
-from torch_geometric.data import Data
-from torch_geometric.utils import to_undirected
-import openmesh as om
 from os import path as osp
-from utils import utils, mesh_sampling
-from psbody.mesh import Mesh
+from utils import utils
+import os
+import hashlib
+import tempfile
+import json
 import pickle
 
+# bump when the spiral or sparse matrix computation changes, so that stale caches are not loaded
+SPIRAL_CACHE_VERSION = 2
+
 
 def read_mesh(path):
+    import openmesh as om
+    from torch_geometric.data import Data
+    from torch_geometric.utils import to_undirected
     mesh = om.read_trimesh(path)
     face = torch.from_numpy(mesh.face_vertex_indices()).T.type(torch.long)
     x = torch.tensor(mesh.points().astype('float32'))
@@ -18,6 +24,7 @@ def read_mesh(path):
 
 
 def save_mesh(fp, x, f):
+    import openmesh as om
     om.write_mesh(fp, om.TriMesh(x, f))
 
 
@@ -30,8 +37,47 @@ def save_obj(v, f, file_name='output.obj'):
     obj_file.close()
 
 
+def spiral_cache_path(transform_fp, template_fp, ds_factors, seq_length, dilation):
+    """
+    Cache file of spiral_tramsform, keyed by the template and transform files and the spiral parameters
+    :return: path next to transform_fp
+    """
+    h = hashlib.sha1()
+    for fp in [template_fp, transform_fp]:
+        with open(fp, 'rb') as f:
+            h.update(f.read())
+    h.update(json.dumps([SPIRAL_CACHE_VERSION, list(ds_factors), list(seq_length), list(dilation)]).encode())
+    return osp.join(osp.dirname(transform_fp), 'spiral_cache_{}.pt'.format(h.hexdigest()[:16]))
+
+
+def load_spiral_cache(cache_fp):
+    """
+    Spiral indices of a cache file, None if it is missing, stale or unreadable
+    :param cache_fp: cache file
+    :return: list of spiral index tensors or None
+    """
+    if not osp.exists(cache_fp):
+        return None
+    try:
+        # tensors only, loadable with the weights_only default of torch >= 2.6
+        cache = torch.load(cache_fp)
+    except Exception as e:
+        print('Ignoring spiral cache {}: {}'.format(cache_fp, e))
+        return None
+    if not isinstance(cache, dict) or cache.get('version') != SPIRAL_CACHE_VERSION:
+        return None
+    return cache['spiral_indices']
+
+
 def spiral_tramsform(transform_fp, template_fp, ds_factors, seq_length, dilation):
+    """
+    Spiral indices and up/down sampling matrices of each mesh level. The spiral indices, whose traversal is the
+    slow part, are cached in a .pt next to transform_fp, a cached call runs without openmesh/psbody.
+    :return: spiral indices, down transforms, up transforms, the transform.pkl dict
+    """
     if not osp.exists(transform_fp):
+        from psbody.mesh import Mesh
+        from utils import mesh_sampling
         print('Generating transform matrices...')
         mesh = Mesh(filename=template_fp)
         # ds_factors = [3.5, 3.5, 3.5, 3.5]
@@ -53,10 +99,18 @@ def spiral_tramsform(transform_fp, template_fp, ds_factors, seq_length, dilation
         with open(transform_fp, 'rb') as f:
             tmp = pickle.load(f, encoding='latin1')
 
-    spiral_indices_list = [
-        utils.preprocess_spiral(tmp['face'][idx], seq_length[idx], tmp['vertices'][idx], dilation[idx])#.to(device)
-        for idx in range(len(tmp['face']) - 1)
-    ]
+    cache_fp = spiral_cache_path(transform_fp, template_fp, ds_factors, seq_length, dilation)
+    spiral_indices_list = load_spiral_cache(cache_fp)
+    if spiral_indices_list is None:
+        spiral_indices_list = [
+            utils.preprocess_spiral(tmp['face'][idx], seq_length[idx], tmp['vertices'][idx], dilation[idx])#.to(device)
+            for idx in range(len(tmp['face']) - 1)
+        ]
+        # unique temp file, several processes (DDP ranks) may build the cache at once
+        fd, tmp_fp = tempfile.mkstemp(dir=osp.dirname(osp.abspath(cache_fp)), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            torch.save({'version': SPIRAL_CACHE_VERSION, 'spiral_indices': spiral_indices_list}, f)
+        os.replace(tmp_fp, cache_fp)
 
     down_transform_list = [
         utils.to_sparse(down_transform)#.to(device)
@@ -71,5 +125,17 @@ def spiral_tramsform(transform_fp, template_fp, ds_factors, seq_length, dilation
 
 
 if __name__ == '__main__':
-    mesh = read_mesh('../data/FreiHAND/template/template.obj')
-    save_mesh('../data/FreiHAND/template/template.obj', mesh.x.numpy(), mesh.face.numpy().T)
+    import sys
+    import time
+    sys.path.insert(0, osp.abspath(osp.join(osp.dirname(__file__), '..')))
+    template_dir = osp.join(osp.dirname(osp.realpath(__file__)), '../template')
+    args = (osp.join(template_dir, 'transform.pkl'), osp.join(template_dir, 'template.ply'), [2, 2, 2, 2], [9, 9, 9, 9], [1, 1, 1, 1])
+    if osp.exists(args[0]) and osp.exists(spiral_cache_path(*args)):
+        os.remove(spiral_cache_path(*args))
+    outs = []
+    for name in ['computed', 'cached']:
+        t = time.time()
+        outs.append(spiral_tramsform(*args))
+        print('{}: {:.1f}ms'.format(name, (time.time() - t) * 1000))
+    assert all(torch.equal(a, b) for a, b in zip(outs[0][0], outs[1][0]))
+    assert all(torch.equal(a.to_dense(), b.to_dense()) for a, b in zip(outs[0][2], outs[1][2]))
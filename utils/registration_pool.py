@@ -0,0 +1,98 @@
+"""
+Asynchronous registration: the per-sample SciPy registration runs in worker processes while the main
+process keeps on with the next forward passes. Results come back in submission order.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+class RegistrationPool(object):
+    """
+    Bounded process pool for registration functions.
+    :param workers: number of worker processes, 0 runs every job inline on the main process
+    :param max_pending: max number of jobs in flight, submit() blocks on the oldest one beyond it (backpressure)
+    """
+    def __init__(self, workers=4, max_pending=None):
+        self.workers = workers
+        self.max_pending = max_pending if max_pending is not None else 2 * max(workers, 1)
+        self.executor = ProcessPoolExecutor(workers) if workers > 0 else None
+        self.pending = deque()
+
+    def submit(self, func, *args, meta=None, **kwargs):
+        """
+        Queue func(*args, **kwargs), meta is handed back with the result
+        :return: list of (meta, result) finished in submission order, may be empty
+        """
+        if self.executor is None:
+            self.pending.append((meta, func(*args, **kwargs)))
+            return self._pop(ready_only=False)
+        self.pending.append((meta, self.executor.submit(func, *args, **kwargs)))
+        done = self._pop(ready_only=True)
+        while len(self.pending) >= self.max_pending:
+            done += self._pop(ready_only=False, num=1)
+        return done
+
+    def drain(self):
+        """
+        Wait for all the jobs in flight
+        :return: list of (meta, result) in submission order
+        """
+        return self._pop(ready_only=False)
+
+    def _pop(self, ready_only, num=None):
+        done = []
+        while self.pending and (num is None or len(done) < num):
+            meta, res = self.pending[0]
+            if self.executor is not None:
+                if ready_only and not res.done():
+                    break
+                res = res.result()
+            self.pending.popleft()
+            done.append((meta, res))
+        return done
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import time
+    import numpy as np
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    from mobrecon.tools.kinematics import mano_to_mpii
+    from mobrecon.tools.registration import registration
+    from mobrecon.tools.vis import perspective_np
+
+    # end-to-end: a fake 10ms forward per batch of 8, then registration of every sample
+    np.random.seed(0)
+    num, batch, size = 256, 8, 128
+    calib = np.eye(4)
+    calib[0, 0] = calib[1, 1] = 250
+    calib[0, 2] = calib[1, 2] = size / 2
+    vertex = np.random.randn(num, 21, 3) * 0.04
+    uv = np.stack([perspective_np(mano_to_mpii(v) + [0, 0, 0.5], calib)[:, :2] for v in vertex]) + np.random.randn(num, 21, 2)
+
+    results = {}
+    for workers in [0, 2, 4, 8]:
+        t0 = time.time()
+        out = []
+        with RegistrationPool(workers) as pool:
+            for i in range(0, num, batch):
+                time.sleep(0.01)
+                for b in range(i, i + batch):
+                    out += pool.submit(registration, vertex[b], uv[b], np.eye(21), calib, size, meta=b)
+            out += pool.drain()
+        assert [m for m, _ in out] == list(range(num))
+        results[workers] = np.stack([r[0] for _, r in out])
+        print('workers: {}, {:.1f} samples/s'.format(workers, num / (time.time() - t0)))
+        assert np.allclose(results[workers], results[0])
@@ -1,7 +1,6 @@
 import torch
 import os
 import numpy as np
-import openmesh as om
 
 
 def makedirs(folder):
@@ -25,6 +24,7 @@ def to_sparse(spmat):
 
 
 def preprocess_spiral(face, seq_length, vertices=None, dilation=1):
+    import openmesh as om
     from .generate_spiral_seq import extract_spirals
     assert face.shape[1] == 3
     if vertices is not None:
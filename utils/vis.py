@@ -73,7 +73,7 @@ def registration(vertex, uv, j_regressor, K, size, uv_conf=None, poly=None):
             uv = uv[uv_select.repeat(2, axis=1)].reshape(-1, 2)
             uv_conf = uv_conf[uv_select].reshape(-1, 1)
             vertex2xyz = vertex2xyz[uv_select.repeat(3, axis=1)].reshape(-1, 3)
-            sol = minimize(align_uv, t, method='SLSQP', bounds=bounds, args=(uv, vertex2xyz, K))
+            sol = minimize(align_uv, t, method='SLSQP', jac=align_uv_jac, bounds=bounds, args=(uv, vertex2xyz, K))
             t = sol.x
             success = sol.success
             xyz = vertex2xyz + t
@@ -87,7 +87,7 @@ def registration(vertex, uv, j_regressor, K, size, uv_conf=None, poly=None):
 
     if poly is not None and try_poly:
         poly = find_1Dproj(poly[0]) / size
-        sol = minimize(align_poly, np.array([0, 0, 0.6]), method='SLSQP', bounds=bounds, args=(poly, vertex, K, size))
+        sol = minimize(align_poly, np.array([0, 0, 0.6]), method='SLSQP', jac=align_poly_jac, bounds=bounds, args=(poly, vertex, K, size))
         if sol.success:
             t2 = sol.x
             d = distance(t, t2)
@@ -103,16 +103,28 @@ def distance(x, y):
     return np.sqrt(((x - y)**2).sum())
 
 
-def find_1Dproj(points):
-    angles = [(0, 90), (-15, 75), (-30, 60), (-45, 45), (-60, 30), (-75, 15)]
-    axs = [(np.array([[np.cos(x/180*np.pi), np.sin(x/180*np.pi)]]), np.array([np.cos(y/180*np.pi), np.sin(y/180*np.pi)])) for x, y in angles]
-    proj = []
-    for ax in axs:
-        x = (points * ax[0]).sum(axis=1)
-        y = (points * ax[1]).sum(axis=1)
-        proj.append([x.min(), x.max(), y.min(), y.max()])
+# 1D projection axes of find_1Dproj, [2x6x2] for the x/y axis of each of the 6 angle pairs
+POLY_AXES = np.array([[[np.cos(a/180*np.pi), np.sin(a/180*np.pi)] for a in angles]
+                      for angles in zip(*[(0, 90), (-15, 75), (-30, 60), (-45, 45), (-60, 30), (-75, 15)])])
 
-    return np.array(proj)
+
+def find_1Dproj(points, return_index=False):
+    """
+    Bounds of the points projected on 6 pairs of axes
+    :param points: [Nx2] or [BxNx2] 2D points
+    :param return_index: also return the index of the extreme points
+    :return: [6x4] or [Bx6x4] (x min, x max, y min, y max) for each pair of axes
+    """
+    proj = np.matmul(points, POLY_AXES.reshape(12, 2).T)
+    shape = proj.shape[:-2]
+    # (x/y axis, angle, min/max) -> (angle, x/y axis, min/max)
+    ext = np.stack([proj.min(-2), proj.max(-2)], -1)
+    ext = np.swapaxes(ext.reshape(shape + (2, 6, 2)), -3, -2).reshape(shape + (6, 4))
+    if return_index:
+        idx = np.stack([proj.argmin(-2), proj.argmax(-2)], -1)
+        idx = np.swapaxes(idx.reshape(shape + (2, 6, 2)), -3, -2).reshape(shape + (6, 4))
+        return ext, idx
+    return ext
 
 
 def align_poly(t, poly, vertex, K, size):
@@ -124,6 +136,26 @@ def align_poly(t, poly, vertex, K, size):
     return loss.mean()
 
 
+def align_poly_jac(t, poly, vertex, K, size):
+    """
+    Analytic gradient of align_poly, min/max are differentiated through the extreme vertices
+    """
+    xyz = vertex + t
+    proj = np.matmul(K, xyz.T).T
+    proj, idx = find_1Dproj((proj / proj[:, 2:])[:, :2], return_index=True)
+    # d(uv)/dt of the extreme vertices, [6x4x2x3]
+    xyz = xyz[idx.reshape(-1)]
+    dxy = np.zeros([xyz.shape[0], 2, 3])
+    dxy[:, 0, 0] = dxy[:, 1, 1] = 1 / xyz[:, 2]
+    dxy[:, :, 2] = -xyz[:, :2] / xyz[:, 2:] ** 2
+    uv_jac = np.matmul(K[:2, :2], dxy).reshape(6, 4, 2, 3)
+    axes = np.repeat(POLY_AXES.transpose(1, 0, 2), 2, axis=1)
+    proj_jac = np.einsum('akc,akcd->akd', axes, uv_jac)
+    diff = proj / size - poly
+
+    return 2 * (diff[..., None] * proj_jac).sum(axis=(0, 1)) / size / diff.size
+
+
 def align_uv(t, uv, vertex2xyz, K):
     xyz = vertex2xyz + t
     proj = np.matmul(K, xyz.T).T
@@ -133,6 +165,20 @@ def align_uv(t, uv, vertex2xyz, K):
     return loss.mean()
 
 
+def align_uv_jac(t, uv, vertex2xyz, K):
+    """
+    Analytic gradient of align_uv, the residual is linear in t
+    """
+    xyz = vertex2xyz + t
+    uv1 = np.concatenate((uv, np.ones([uv.shape[0], 1])), axis=1)
+    diff = np.matmul(K, xyz.T).T - uv1 * xyz[:, 2:]
+    # d(diff)/dt = K - uv1 e_z^T
+    grad = np.matmul(diff, K).sum(axis=0)
+    grad[2] -= (diff * uv1).sum()
+
+    return 2 * grad / diff.size
+
+
 def map2uv(map, size=(224, 224)):
     if map.ndim == 4:
         uv = np.zeros((map.shape[0], map.shape[1], 2))